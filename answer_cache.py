@@ -0,0 +1,112 @@
+import asyncio
+import hashlib
+import logging
+import random
+import re
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Dict, Any, List, Optional, Tuple
+
+from sqlalchemy.exc import IntegrityError
+
+from database import get_cached_answers, save_cached_answers, touch_cached_answer, evict_cached_answers
+from write_buffer import WriteBehindBuffer
+
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+def normalize_review_text(text: str) -> str:
+    """Нормализация текста отзыва для ключа кэша: регистр, ё, пунктуация, эмодзи и пробелы"""
+    return _NON_WORD.sub(' ', text.lower().replace('ё', 'е')).strip()
+
+
+class AnswerCache:
+    """
+    Кэш ответов LLM на типовые отзывы ("Всё отлично", отзывы только с оценкой).
+    Ключ - хэш промпта магазина, нормализованного текста и оценки. Записи хранятся
+    в таблице answer_cache (срок жизни ANSWER_CACHE_TTL_HOURS, вытеснение давно
+    не используемых сверх ANSWER_CACHE_MAX_ENTRIES), самые частые - еще и в LRU в памяти.
+    Для каждого ключа копится до ANSWER_CACHE_VARIANTS разных ответов, и попадание
+    возвращает случайный из них, чтобы ответы не выглядели скопированными.
+    Запросы к базе выполняются в отдельном потоке, попадания пишутся пакетами
+    через буфер отложенной записи.
+    """
+    def __init__(self, config: Dict[str, Any], write_buffer: Optional[WriteBehindBuffer] = None):
+        self.config = config
+        self.write_buffer = write_buffer
+        self.enabled = config["ANSWER_CACHE_ENABLED"]
+        self.ttl = timedelta(hours=config["ANSWER_CACHE_TTL_HOURS"])
+        self.variants = max(1, config["ANSWER_CACHE_VARIANTS"])
+        # cache_key -> (время загрузки, варианты ответа)
+        self._memory: 'OrderedDict[str, Tuple[float, List[str]]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, prompt: str, review_text: str, product_valuation: Optional[int]) -> Optional[str]:
+        """Ключ кэша или None, если отзыв слишком длинный, чтобы повториться"""
+        if not self.enabled or len(review_text) > self.config["ANSWER_CACHE_MAX_TEXT_LENGTH"]:
+            return None
+        prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        raw = f"{prompt_hash}\n{normalize_review_text(review_text)}\n{product_valuation}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    async def _answers(self, cache_key: str) -> List[str]:
+        entry = self._memory.get(cache_key)
+        if entry and time.monotonic() - entry[0] < self.ttl.total_seconds():
+            self._memory.move_to_end(cache_key)
+            return entry[1]
+        answers = await asyncio.to_thread(get_cached_answers, cache_key, self.ttl)
+        self._remember(cache_key, answers)
+        return answers
+
+    def _remember(self, cache_key: str, answers: List[str]) -> None:
+        self._memory[cache_key] = (time.monotonic(), answers)
+        self._memory.move_to_end(cache_key)
+        while len(self._memory) > self.config["ANSWER_CACHE_MEMORY_ENTRIES"]:
+            self._memory.popitem(last=False)
+
+    async def get(self, cache_key: str) -> Optional[str]:
+        """Готовый ответ или None, если вариантов для выборки пока недостаточно"""
+        answers = await self._answers(cache_key)
+        if len(answers) < self.variants:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.write_buffer is not None:
+            self.write_buffer.add_cache_hit(cache_key)
+        else:
+            await asyncio.to_thread(touch_cached_answer, cache_key)
+        return random.choice(answers)
+
+    async def put(self, store_id: int, cache_key: str, answer: str) -> None:
+        """Добавление сгенерированного ответа в варианты для ключа"""
+        answers = await self._answers(cache_key)
+        if len(answers) >= self.variants or answer in answers:
+            return
+        answers = answers + [answer]
+        try:
+            await asyncio.to_thread(save_cached_answers, store_id, cache_key, answers)
+        except IntegrityError:
+            # Первый вариант для ключа одновременно сохранил другой поток: варианты перечитаются из базы
+            self._memory.pop(cache_key, None)
+            return
+        self._remember(cache_key, answers)
+
+    def evict(self) -> None:
+        """Очистка устаревших и лишних записей в базе данных"""
+        if not self.enabled:
+            return
+        removed = evict_cached_answers(self.ttl, self.config["ANSWER_CACHE_MAX_ENTRIES"])
+        if removed:
+            logging.info(f"Из кэша ответов удалено записей: {removed}")
+        self._memory.clear()
+
+    def metrics(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'memory_entries': len(self._memory)
+        }
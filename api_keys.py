@@ -0,0 +1,54 @@
+import hashlib
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+import jwt
+
+
+@dataclass(frozen=True)
+class ApiKeyInfo:
+    """Данные из JWT ключа API Wildberries"""
+    # Время истечения срока действия (naive UTC)
+    expires_at: datetime
+    # Идентификатор продавца (claim sid)
+    seller_id: Optional[str]
+    # Битовая маска разрешенных категорий API (claim s)
+    scopes: Optional[int]
+
+    def is_valid(self, now: Optional[datetime] = None) -> bool:
+        return (now or datetime.utcnow()) < self.expires_at
+
+
+def api_key_hash(api_key: str) -> str:
+    """SHA-256 ключа API: ключ памяти и индексируемое значение для поиска"""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+
+# Разобранные ключи по хэшу; ключи магазинов меняются редко, поэтому кэш не вытесняется
+_key_info_cache: Dict[str, Optional[ApiKeyInfo]] = {}
+
+def introspect_api_key(api_key: str) -> Optional[ApiKeyInfo]:
+    """Разбор JWT ключа без проверки подписи (с кэшированием). None - ключ некорректен"""
+    key_hash = api_key_hash(api_key)
+    if key_hash in _key_info_cache:
+        return _key_info_cache[key_hash]
+
+    info = None
+    try:
+        decoded = jwt.decode(api_key, options={"verify_signature": False})
+        exp_timestamp = decoded.get('exp')
+        if exp_timestamp:
+            info = ApiKeyInfo(
+                expires_at=datetime.fromtimestamp(exp_timestamp, tz=timezone.utc).replace(tzinfo=None),
+                seller_id=decoded.get('sid'),
+                scopes=decoded.get('s')
+            )
+        else:
+            logging.error("В API ключе отсутствует время истечения срока действия")
+    except Exception as e:
+        logging.error(f"Ошибка при разборе API ключа: {e}")
+
+    _key_info_cache[key_hash] = info
+    return info
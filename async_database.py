@@ -0,0 +1,192 @@
+import logging
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from sqlalchemy import and_, func, or_, select, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import joinedload
+
+from api_keys import api_key_hash
+from database import (
+    CYCLE_METRIC_FIELDS,
+    DATABASE_URL,
+    ROLLUP_DAY,
+    ROLLUP_HOUR,
+    CycleMetricRollup,
+    Store,
+    StoreStatistics,
+    enable_sqlite_foreign_keys,
+    rollup_bucket_start,
+)
+
+# Асинхронные драйверы для синхронных URL из DATABASE_URL
+ASYNC_DRIVERS = {
+    'mysql': 'mysql+aiomysql',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def async_database_url(url: str) -> str:
+    """URL базы данных с асинхронным драйвером (mysql+pymysql -> mysql+aiomysql и т.д.)"""
+    parsed = make_url(url)
+    driver = ASYNC_DRIVERS.get(parsed.get_backend_name())
+    if driver is None:
+        raise ValueError(f"Нет асинхронного драйвера для базы данных {parsed.get_backend_name()}")
+    return parsed.set(drivername=driver).render_as_string(hide_password=False)
+
+
+# Асинхронный движок для обработчиков Telegram: запросы не блокируют event loop бота
+async_engine = create_async_engine(os.getenv("ASYNC_DATABASE_URL") or async_database_url(DATABASE_URL))
+enable_sqlite_foreign_keys(async_engine.sync_engine)
+
+# Объекты остаются доступными после завершения сессии
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+@asynccontextmanager
+async def async_session_scope() -> AsyncIterator[AsyncSession]:
+    """Асинхронный контекстный менеджер для работы с сессией базы данных"""
+    async with AsyncSessionLocal() as session:
+        try:
+            yield session
+            await session.commit()
+        except Exception as e:
+            await session.rollback()
+            raise e
+
+async def add_store(name: str, wb_api_key: str, prompt: str, telegram_user_id: str) -> bool:
+    """Добавление нового магазина"""
+    try:
+        async with async_session_scope() as session:
+            store = Store(
+                name=name,
+                wb_api_key=wb_api_key,
+                prompt=prompt,
+                telegram_user_id=str(telegram_user_id)
+            )
+            store.set_key_info()
+            session.add(store)
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка при добавлении магазина: {e}")
+        return False
+
+async def get_store(name: str) -> Optional[Store]:
+    """Получение магазина по имени"""
+    async with async_session_scope() as session:
+        return await session.scalar(select(Store).filter_by(name=name))
+
+async def get_store_by_api_key(wb_api_key: str) -> Optional[Store]:
+    """Получение магазина по API-ключу"""
+    async with async_session_scope() as session:
+        return await session.scalar(select(Store).filter_by(wb_api_key_hash=api_key_hash(wb_api_key)))
+
+async def get_user_stores(telegram_user_id: Optional[str]) -> List[Store]:
+    """Получение всех магазинов пользователя или всех магазинов, если id не указан"""
+    query = select(Store).order_by(Store.id)
+    if telegram_user_id is not None:
+        query = query.filter_by(telegram_user_id=str(telegram_user_id))
+    async with async_session_scope() as session:
+        return list(await session.scalars(query))
+
+async def get_user_stores_with_statistics(telegram_user_id: str) -> List[Store]:
+    """Магазины пользователя вместе со статистикой (Store.statistics) одним запросом"""
+    query = (
+        select(Store)
+        .options(joinedload(Store.statistics))
+        .filter_by(telegram_user_id=str(telegram_user_id))
+        .order_by(Store.id)
+    )
+    async with async_session_scope() as session:
+        return list(await session.scalars(query))
+
+async def get_user_store(name: str, telegram_user_id: str) -> Optional[Store]:
+    """Получение магазина пользователя по имени"""
+    async with async_session_scope() as session:
+        return await session.scalar(select(Store).filter_by(name=name, telegram_user_id=str(telegram_user_id)))
+
+async def delete_store(name: str, telegram_user_id: str) -> bool:
+    """Удаление магазина"""
+    try:
+        async with async_session_scope() as session:
+            store = await session.scalar(select(Store).filter_by(name=name, telegram_user_id=str(telegram_user_id)))
+            if store:
+                await session.delete(store)
+                return True
+            return False
+    except Exception as e:
+        logging.error(f"Ошибка при удалении магазина: {e}")
+        return False
+
+async def delete_user_store(store_id: int, telegram_user_id: str) -> Optional[str]:
+    """Удаление магазина пользователя по id. Возвращает название удаленного магазина"""
+    async with async_session_scope() as session:
+        store = await session.scalar(select(Store).filter_by(id=store_id, telegram_user_id=str(telegram_user_id)))
+        if not store:
+            return None
+        await session.delete(store)
+        return store.name
+
+async def update_store_prompt(name: str, telegram_user_id: str, prompt: str) -> bool:
+    """Обновление промпта магазина пользователя"""
+    async with async_session_scope() as session:
+        store = await session.scalar(select(Store).filter_by(name=name, telegram_user_id=str(telegram_user_id)))
+        if not store:
+            return False
+        store.prompt = prompt
+        return True
+
+async def get_store_statistics(store_id: int) -> Optional[StoreStatistics]:
+    """Получение статистики магазина"""
+    async with async_session_scope() as session:
+        return await session.scalar(select(StoreStatistics).filter_by(store_id=store_id))
+
+async def get_stores_throughput(store_ids: List[int], now: Optional[datetime] = None) -> Dict[int, Dict[str, Dict[str, Any]]]:
+    """
+    Суммы метрик циклов магазинов за 24 часа (по часовым агрегатам) и за 7 дней
+    (по дневным, включая текущий день): {store_id: {'24h': {...}, '7d': {...}}}
+    """
+    now = now or datetime.utcnow()
+    hour_since = rollup_bucket_start(now, ROLLUP_HOUR) - timedelta(hours=23)
+    day_since = rollup_bucket_start(now, ROLLUP_DAY) - timedelta(days=6)
+    fields = ('cycles',) + CYCLE_METRIC_FIELDS
+    query = (
+        select(
+            CycleMetricRollup.store_id,
+            CycleMetricRollup.period,
+            *(func.sum(getattr(CycleMetricRollup, field)).label(field) for field in fields)
+        )
+        .filter(
+            CycleMetricRollup.store_id.in_(store_ids),
+            or_(
+                and_(CycleMetricRollup.period == ROLLUP_HOUR, CycleMetricRollup.bucket_start >= hour_since),
+                and_(CycleMetricRollup.period == ROLLUP_DAY, CycleMetricRollup.bucket_start >= day_since)
+            )
+        )
+        .group_by(CycleMetricRollup.store_id, CycleMetricRollup.period)
+    )
+    throughput: Dict[int, Dict[str, Dict[str, Any]]] = {}
+    async with async_session_scope() as session:
+        for row in await session.execute(query):
+            window = '24h' if row.period == ROLLUP_HOUR else '7d'
+            throughput.setdefault(row.store_id, {})[window] = {field: int(getattr(row, field) or 0) for field in fields}
+    return throughput
+
+async def get_stores_with_expiring_keys(expires_before: datetime) -> List[Store]:
+    """Магазины, ключ API которых истекает до expires_before, а владелец еще не предупрежден"""
+    query = select(Store).filter(
+        Store.key_expires_at <= expires_before,
+        Store.key_expiry_warned_at.is_(None),
+        Store.telegram_user_id.isnot(None)
+    )
+    async with async_session_scope() as session:
+        return list(await session.scalars(query))
+
+async def mark_key_expiry_warned(store_id: int):
+    """Отметка об отправленном предупреждении об истечении ключа"""
+    async with async_session_scope() as session:
+        await session.execute(
+            update(Store).filter_by(id=store_id).values(key_expiry_warned_at=datetime.utcnow())
+        )
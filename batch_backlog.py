@@ -0,0 +1,85 @@
+"""
+Ответы на накопившиеся отзывы через OpenAI Batch API.
+
+Отзывы старше LLM_BACKLOG_MIN_AGE_HOURS (например, весь неотвеченный архив
+нового магазина) не генерируются по одному, а собираются в JSONL-файл запросов
+chat.completions, загружаются в Files API и отправляются пакетом с окном
+выполнения 24 часа за половину цены. Пакеты и их отзывы хранятся в базе
+(llm_batches), в следующих циклах магазина пакет проверяется, и готовые ответы
+передаются на отправку в WB. Свежие отзывы по-прежнему отвечаются сразу.
+"""
+import json
+import logging
+from typing import Any, Dict, Iterable, NamedTuple, Tuple
+
+import openai
+
+BATCH_ENDPOINT = '/v1/chat/completions'
+COMPLETION_WINDOW = '24h'
+# Статусы пакета, после которых новых результатов не будет
+FINAL_BATCH_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+
+class BatchResults(NamedTuple):
+    """Результаты пакета: ответы по custom_id (id отзыва) и токены"""
+    answers: Dict[str, str]
+    prompt_tokens: int
+    completion_tokens: int
+    cached_tokens: int
+
+
+def build_batch_file(requests: Iterable[Tuple[str, Dict[str, Any]]]) -> bytes:
+    """JSONL-файл пакета из пар (custom_id, тело запроса chat.completions)"""
+    lines = [
+        json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': BATCH_ENDPOINT, 'body': body},
+                   ensure_ascii=False)
+        for custom_id, body in requests
+    ]
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def parse_batch_output(content: str) -> BatchResults:
+    """Разбор выходного JSONL-файла пакета; запросы с ошибкой и пустые ответы пропускаются"""
+    answers: Dict[str, str] = {}
+    prompt_tokens = completion_tokens = cached_tokens = 0
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            logging.warning("Некорректная строка в результатах пакета")
+            continue
+        response = item.get('response') or {}
+        if item.get('error') or response.get('status_code') != 200:
+            continue
+        body = response.get('body') or {}
+        usage = body.get('usage') or {}
+        prompt_tokens += usage.get('prompt_tokens') or 0
+        completion_tokens += usage.get('completion_tokens') or 0
+        cached_tokens += (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
+        choices = body.get('choices') or []
+        answer = (choices[0].get('message') or {}).get('content') if choices else None
+        if item.get('custom_id') and isinstance(answer, str) and answer.strip():
+            answers[item['custom_id']] = answer.strip()
+    return BatchResults(answers, prompt_tokens, completion_tokens, cached_tokens)
+
+
+async def submit_batch(client: openai.AsyncOpenAI, requests: Iterable[Tuple[str, Dict[str, Any]]],
+                       metadata: Dict[str, str]) -> Any:
+    """Загрузка файла запросов и создание пакета; возвращает пакет провайдера"""
+    upload = await client.files.create(file=('backlog.jsonl', build_batch_file(requests)), purpose='batch')
+    return await client.batches.create(
+        input_file_id=upload.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=COMPLETION_WINDOW,
+        metadata=metadata
+    )
+
+
+async def fetch_batch_results(client: openai.AsyncOpenAI, batch: Any) -> BatchResults:
+    """Результаты завершенного пакета (у просроченного - выполненная часть)"""
+    if not batch.output_file_id:
+        return BatchResults({}, 0, 0, 0)
+    content = await client.files.content(batch.output_file_id)
+    return parse_batch_output(content.text)
@@ -0,0 +1,501 @@
+"""
+Офлайн-бенчмарк обработки отзывов без Wildberries и OpenAI.
+
+Фейковый сервер (aiohttp) отдает отзывы WB с пагинацией, принимает ответы
+и отвечает на chat.completions и Batch API (files, batches); задержки и доля
+ответов 429 настраиваются.
+Каждый сценарий (число магазинов) запускается в отдельном процессе со своей
+временной SQLite базой и прогоняет process_all_stores. Результат - JSON:
+отзывы в секунду, p50/p99 по этапам, пиковый RSS и число HTTP-вызовов.
+
+    python benchmark.py --stores 1 100 5000 --reviews 20 --output benchmark.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+import aiohttp
+from aiohttp import web
+
+BASE_DIR = Path(__file__).resolve().parent
+
+
+class FakeServices:
+    """
+    Заглушка API Wildberries и OpenAI. Каждый новый ключ API (заголовок
+    Authorization) получает свой набор из reviews_per_store неотвеченных отзывов
+    """
+    def __init__(self, reviews_per_store: int, wb_latency_ms: float = 0, llm_latency_ms: float = 0,
+                 rate_limit_ratio: float = 0, seed: int = 1):
+        self.reviews_per_store = reviews_per_store
+        self.wb_latency = wb_latency_ms / 1000
+        self.llm_latency = llm_latency_ms / 1000
+        self.rate_limit_ratio = rate_limit_ratio
+        self.random = random.Random(seed)
+        # ключ API -> отзывы магазина от новых к старым
+        self.stores: Dict[str, List[Dict[str, Any]]] = {}
+        self.calls = {'wb_feedbacks': 0, 'wb_feedback': 0, 'wb_answer': 0, 'wb_rate_limited': 0, 'llm': 0,
+                      'llm_batches': 0}
+        # Файлы и пакеты Batch API; пакет выполняется при первой проверке статуса
+        self.files: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        # custom_id запросов, которые пакет возвращает с ошибкой
+        self.batch_error_ids: Set[str] = set()
+
+    def _store_reviews(self, request: web.Request) -> List[Dict[str, Any]]:
+        key = request.headers.get('Authorization', '')
+        if key not in self.stores:
+            base = datetime(2025, 1, 1)
+            self.stores[key] = [{
+                'id': f"fb{len(self.stores)}-{i}",
+                'text': f"Отзыв {i}: товар {'понравился' if i % 3 else 'не подошел по размеру'}",
+                'productValuation': 5 if i % 3 else 2,
+                'createdDate': (base + timedelta(minutes=i)).isoformat() + 'Z',
+                'answer': None
+            } for i in reversed(range(self.reviews_per_store))]
+        return self.stores[key]
+
+    async def _wb_delay(self) -> Optional[web.Response]:
+        if self.wb_latency:
+            await asyncio.sleep(self.wb_latency)
+        if self.rate_limit_ratio and self.random.random() < self.rate_limit_ratio:
+            self.calls['wb_rate_limited'] += 1
+            return web.json_response({'title': 'too many requests'}, status=429, headers={'X-Ratelimit-Retry': '1'})
+        return None
+
+    async def feedbacks(self, request: web.Request) -> web.Response:
+        self.calls['wb_feedbacks'] += 1
+        limited = await self._wb_delay()
+        if limited:
+            return limited
+        answered = request.query.get('isAnswered') == 'true'
+        skip, take = int(request.query.get('skip', 0)), int(request.query.get('take', 100))
+        reviews = [review for review in self._store_reviews(request) if bool(review['answer']) == answered]
+        return web.json_response({'data': {'feedbacks': reviews[skip:skip + take]}})
+
+    async def feedback(self, request: web.Request) -> web.Response:
+        self.calls['wb_feedback'] += 1
+        feedback_id = request.query.get('id')
+        review = next((r for r in self._store_reviews(request) if r['id'] == feedback_id), None)
+        return web.json_response({'data': review})
+
+    async def answer(self, request: web.Request) -> web.Response:
+        self.calls['wb_answer'] += 1
+        limited = await self._wb_delay()
+        if limited:
+            return limited
+        body = await request.json()
+        for review in self._store_reviews(request):
+            if review['id'] == body['id']:
+                review['answer'] = {'text': body['text']}
+                return web.Response(status=204)
+        return web.json_response({'title': 'feedback not found'}, status=404)
+
+    async def chat_completions(self, request: web.Request) -> web.Response:
+        self.calls['llm'] += 1
+        body = await request.json()
+        if self.llm_latency:
+            await asyncio.sleep(self.llm_latency)
+        return web.json_response(self.completion(body))
+
+    def completion(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        messages = body.get('messages', [])
+        prompt_tokens = sum(len(message.get('content') or '') for message in messages) // 4
+        content = 'Спасибо за отзыв! Рады, что вы выбрали наш магазин.'
+        completion_tokens = 15
+        batch = self.batch_reviews(messages[-1].get('content') if messages else None)
+        if batch is not None:
+            # Пакетный запрос: JSON-объект с ответом на каждый отзыв
+            content = json.dumps({'answers': [{'id': item['id'], 'answer': content} for item in batch]},
+                                 ensure_ascii=False)
+            completion_tokens *= len(batch)
+        return {
+            'id': f"chatcmpl-{self.calls['llm']}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'fake'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': 'stop'
+            }],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens}
+        }
+
+    def _save_file(self, data: bytes, filename: str, purpose: str) -> Dict[str, Any]:
+        file_id = f"file-{len(self.files) + 1}"
+        self.files[file_id] = data
+        return {'id': file_id, 'object': 'file', 'bytes': len(data), 'created_at': int(time.time()),
+                'filename': filename, 'purpose': purpose, 'status': 'processed'}
+
+    async def upload_file(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        upload = form['file']
+        return web.json_response(self._save_file(upload.file.read(), upload.filename, form.get('purpose', 'batch')))
+
+    async def file_content(self, request: web.Request) -> web.Response:
+        data = self.files.get(request.match_info['file_id'])
+        if data is None:
+            return web.json_response({'error': {'message': 'file not found'}}, status=404)
+        return web.Response(body=data, content_type='application/jsonl')
+
+    async def create_batch(self, request: web.Request) -> web.Response:
+        self.calls['llm_batches'] += 1
+        body = await request.json()
+        if body.get('input_file_id') not in self.files:
+            return web.json_response({'error': {'message': 'input file not found'}}, status=400)
+        requests_count = len(self.files[body['input_file_id']].splitlines())
+        batch = {
+            'id': f"batch_{len(self.batches) + 1}",
+            'object': 'batch',
+            'endpoint': body['endpoint'],
+            'input_file_id': body['input_file_id'],
+            'completion_window': body['completion_window'],
+            'status': 'in_progress',
+            'created_at': int(time.time()),
+            'metadata': body.get('metadata'),
+            'output_file_id': None,
+            'error_file_id': None,
+            'request_counts': {'total': requests_count, 'completed': 0, 'failed': 0}
+        }
+        self.batches[batch['id']] = batch
+        return web.json_response(batch)
+
+    async def get_batch(self, request: web.Request) -> web.Response:
+        batch = self.batches.get(request.match_info['batch_id'])
+        if batch is None:
+            return web.json_response({'error': {'message': 'batch not found'}}, status=404)
+        if batch['status'] == 'in_progress':
+            self.complete_batch(batch)
+        return web.json_response(batch)
+
+    def complete_batch(self, batch: Dict[str, Any]) -> None:
+        """Выполнение всех запросов пакета и запись выходного JSONL-файла"""
+        lines, failed = [], 0
+        for index, line in enumerate(self.files[batch['input_file_id']].decode('utf-8').splitlines()):
+            item = json.loads(line)
+            if item['custom_id'] in self.batch_error_ids:
+                failed += 1
+                response = {'status_code': 500, 'request_id': f"req-{index}", 'body': {'error': {'message': 'fake'}}}
+            else:
+                response = {'status_code': 200, 'request_id': f"req-{index}", 'body': self.completion(item['body'])}
+            lines.append(json.dumps({'id': f"batch_req_{index}", 'custom_id': item['custom_id'],
+                                     'response': response, 'error': None}, ensure_ascii=False))
+        output = self._save_file(('\n'.join(lines) + '\n').encode('utf-8'), 'output.jsonl', 'batch_output')
+        batch.update(status='completed', completed_at=int(time.time()), output_file_id=output['id'],
+                     request_counts={'total': len(lines), 'completed': len(lines) - failed, 'failed': failed})
+
+    @staticmethod
+    def batch_reviews(content: Optional[str]) -> Optional[List[Dict[str, Any]]]:
+        """Отзывы пакетного запроса (JSON-массив с id после инструкции) или None для обычного запроса"""
+        payload = content.rsplit('\n\n', 1)[-1] if content else ''
+        if not payload.startswith('['):
+            return None
+        try:
+            items = json.loads(payload)
+        except ValueError:
+            return None
+        if not all(isinstance(item, dict) and 'id' in item for item in items):
+            return None
+        return items
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.calls)
+
+    async def reset(self, request: web.Request) -> web.Response:
+        self.stores.clear()
+        self.files.clear()
+        self.batches.clear()
+        self.calls = {name: 0 for name in self.calls}
+        return web.json_response(self.calls)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/api/v1/feedbacks', self.feedbacks)
+        app.router.add_get('/api/v1/feedback', self.feedback)
+        app.router.add_post('/api/v1/feedbacks/answer', self.answer)
+        app.router.add_post('/v1/chat/completions', self.chat_completions)
+        app.router.add_post('/v1/files', self.upload_file)
+        app.router.add_get('/v1/files/{file_id}/content', self.file_content)
+        app.router.add_post('/v1/batches', self.create_batch)
+        app.router.add_get('/v1/batches/{batch_id}', self.get_batch)
+        app.router.add_get('/_stats', self.stats)
+        app.router.add_post('/_reset', self.reset)
+        return app
+
+
+class StageTimer:
+    """Длительности этапов обработки для перцентилей"""
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        return {stage: {
+            'count': len(values),
+            'p50_ms': round(percentile(values, 50) * 1000, 3),
+            'p99_ms': round(percentile(values, 99) * 1000, 3),
+            'max_ms': round(max(values) * 1000, 3)
+        } for stage, values in self.samples.items() if values}
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль по методу ближайшего ранга"""
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Пиковый RSS процесса (ru_maxrss: КБ в Linux, байты в macOS); None, где модуля resource нет (Windows)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+async def run_scenario(stores: int, reviews_per_store: int, server_url: str) -> Dict[str, Any]:
+    """
+    Прогон process_all_stores для stores магазинов. База данных, WB_API_URL
+    и OPENAI_BASE_URL должны быть заданы в окружении до вызова
+    """
+    # Модули бота создают движок базы данных при импорте, поэтому импортируются после настройки окружения
+    import jwt
+    import database
+    import wb_bot
+    from clients import ClientRegistry
+
+    timer = StageTimer()
+
+    class TimedFeedbackBot(wb_bot.WBFeedbackBot):
+        async def _fetch_page(self, skip, take, is_answered):
+            started = time.perf_counter()
+            try:
+                return await super()._fetch_page(skip, take, is_answered)
+            finally:
+                timer.add('fetch_page', time.perf_counter() - started)
+
+        async def generate_ai_response(self, review_text, product_valuation):
+            started = time.perf_counter()
+            try:
+                return await super().generate_ai_response(review_text, product_valuation)
+            finally:
+                timer.add('generate', time.perf_counter() - started)
+
+        async def generate_batch_response(self, prepared_reviews):
+            started = time.perf_counter()
+            try:
+                return await super().generate_batch_response(prepared_reviews)
+            finally:
+                timer.add('generate_batch', time.perf_counter() - started)
+
+        async def send_response(self, feedback_id, text):
+            started = time.perf_counter()
+            try:
+                return await super().send_response(feedback_id, text)
+            finally:
+                timer.add('send_response', time.perf_counter() - started)
+
+        async def process_reviews(self):
+            started = time.perf_counter()
+            try:
+                return await super().process_reviews()
+            finally:
+                timer.add('store_cycle', time.perf_counter() - started)
+
+    database.init_db()
+    expires = int(time.time()) + 30 * 86400
+    with database.session_scope() as session:
+        for index in range(stores):
+            store = database.Store(
+                name=f"bench-{index}",
+                wb_api_key=jwt.encode({'exp': expires, 'sid': f"bench-seller-{index}"}, 'benchmark'),
+                prompt="Ты вежливый помощник магазина. Ответь на отзыв покупателя коротко.",
+                telegram_user_id="0"
+            )
+            store.set_key_info()
+            session.add(store)
+
+    async with aiohttp.ClientSession() as session:
+        await session.post(f"{server_url}/_reset")
+
+    original_bot = wb_bot.WBFeedbackBot
+    wb_bot.WBFeedbackBot = TimedFeedbackBot
+    clients = ClientRegistry(wb_bot.load_config())
+    await clients.start()
+    started = time.perf_counter()
+    try:
+        await wb_bot.process_all_stores(clients)
+        processed = time.perf_counter() - started
+        client_metrics = clients.metrics()
+    finally:
+        wb_bot.WBFeedbackBot = original_bot
+        # Ответ считается обработанным, когда результат записан в базу
+        await clients.close()
+    duration = time.perf_counter() - started
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{server_url}/_stats") as response:
+            calls = await response.json()
+
+    with database.session_scope() as session:
+        answered = session.query(database.ProcessedReview).filter_by(
+            status=database.REVIEW_STATUS_ANSWERED
+        ).count()
+
+    return {
+        'stores': stores,
+        'reviews_per_store': reviews_per_store,
+        'reviews_total': stores * reviews_per_store,
+        'answered': answered,
+        'duration_seconds': round(duration, 3),
+        'processing_seconds': round(processed, 3),
+        'reviews_per_second': round(answered / duration, 2) if duration else None,
+        'stages': timer.summary(),
+        'peak_rss_mb': peak_rss_mb(),
+        'http_calls': calls,
+        'connections': {name: client_metrics.get(name) for name in
+                        ('http_requests', 'connections_created', 'connections_reused', 'rate_limit_throttled')}
+    }
+
+
+def serve(args: argparse.Namespace) -> None:
+    """Запуск фейкового сервера до завершения процесса"""
+    services = FakeServices(args.reviews, args.wb_latency_ms, args.llm_latency_ms, args.rate_limit_ratio)
+    web.run_app(services.app(), host='127.0.0.1', port=args.port, print=None, access_log=None)
+
+
+def scenario_main(args: argparse.Namespace) -> None:
+    """Один сценарий в отдельном процессе: результат печатается в stdout одной строкой JSON"""
+    logging.basicConfig(level=getattr(logging, args.log_level), stream=sys.stderr)
+    print(json.dumps(asyncio.run(run_scenario(args.scenario, args.reviews, args.server_url)), ensure_ascii=False))
+
+
+def scenario_env(args: argparse.Namespace, server_url: str, db_dir: str) -> Dict[str, str]:
+    return {
+        **os.environ,
+        # Переменные окружения важнее .env: бенчмарк никогда не пишет в рабочую базу
+        'DATABASE_URL': f"sqlite:///{Path(db_dir) / 'benchmark.db'}",
+        'WB_API_URL': f"{server_url}/api/v1",
+        'OPENAI_BASE_URL': f"{server_url}/v1",
+        'OPENAI_API_KEY': 'sk-benchmark',
+        'REVIEWS_PER_PAGE': str(args.page_size),
+        'WB_RATE_LIMIT_PER_SECOND': os.getenv('WB_RATE_LIMIT_PER_SECOND', '1000'),
+        'WB_RATE_LIMIT_BURST': os.getenv('WB_RATE_LIMIT_BURST', '1000'),
+        'RETRY_DELAY_SECONDS': os.getenv('RETRY_DELAY_SECONDS', '0.1'),
+        'ANSWER_CACHE_ENABLED': os.getenv('ANSWER_CACHE_ENABLED', 'false'),
+        'METRICS_PORT': '0',
+        'LLM_BATCH_SIZE': str(args.llm_batch_size),
+    }
+
+
+def wait_for_server(server_url: str, process: subprocess.Popen, timeout: float = 10) -> None:
+    async def ping() -> bool:
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"{server_url}/_stats") as response:
+                    return response.status == 200
+        except aiohttp.ClientError:
+            return False
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Фейковый сервер завершился при запуске")
+        if asyncio.run(ping()):
+            return
+        time.sleep(0.1)
+    raise RuntimeError("Фейковый сервер не запустился")
+
+
+def main(args: argparse.Namespace) -> Dict[str, Any]:
+    server_url = f"http://127.0.0.1:{args.port}"
+    server = subprocess.Popen([
+        sys.executable, __file__, '--serve', '--port', str(args.port), '--reviews', str(args.reviews),
+        '--wb-latency-ms', str(args.wb_latency_ms), '--llm-latency-ms', str(args.llm_latency_ms),
+        '--rate-limit-ratio', str(args.rate_limit_ratio)
+    ], cwd=str(BASE_DIR))
+    scenarios = []
+    try:
+        wait_for_server(server_url, server)
+        for stores in args.stores:
+            with tempfile.TemporaryDirectory(prefix='wb_benchmark_') as db_dir:
+                result = subprocess.run(
+                    [sys.executable, __file__, '--scenario', str(stores), '--reviews', str(args.reviews),
+                     '--server-url', server_url, '--log-level', args.log_level],
+                    cwd=str(BASE_DIR), env=scenario_env(args, server_url, db_dir),
+                    stdout=subprocess.PIPE, text=True
+                )
+            if result.returncode != 0:
+                raise RuntimeError(f"Сценарий на {stores} магазинов завершился с кодом {result.returncode}")
+            scenario = json.loads(result.stdout.strip().splitlines()[-1])
+            print(f"{stores} магазинов: {scenario['reviews_per_second']} отзывов/с, "
+                  f"{scenario['duration_seconds']} с, RSS {scenario['peak_rss_mb']} МБ", file=sys.stderr)
+            scenarios.append(scenario)
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {
+        'created_at': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': {
+            'reviews_per_store': args.reviews,
+            'page_size': args.page_size,
+            'wb_latency_ms': args.wb_latency_ms,
+            'llm_latency_ms': args.llm_latency_ms,
+            'rate_limit_ratio': args.rate_limit_ratio,
+            'llm_batch_size': args.llm_batch_size
+        },
+        'scenarios': scenarios
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк обработки отзывов")
+    parser.add_argument('--stores', type=int, nargs='+', default=[1, 100, 5000], help="Число магазинов в сценариях")
+    parser.add_argument('--reviews', type=int, default=20, help="Неотвеченных отзывов на магазин")
+    parser.add_argument('--page-size', type=int, default=100, help="REVIEWS_PER_PAGE")
+    parser.add_argument('--wb-latency-ms', type=float, default=0, help="Задержка ответов фейкового WB")
+    parser.add_argument('--llm-latency-ms', type=float, default=0, help="Задержка ответов фейкового LLM")
+    parser.add_argument('--rate-limit-ratio', type=float, default=0, help="Доля запросов к WB с ответом 429")
+    parser.add_argument('--llm-batch-size', type=int, default=1, help="LLM_BATCH_SIZE (1 - без пакетов)")
+    parser.add_argument('--port', type=int, default=8765, help="Порт фейкового сервера")
+    parser.add_argument('--output', help="Файл для результатов в JSON (по умолчанию stdout)")
+    parser.add_argument('--log-level', default='WARNING', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    # Внутренние режимы: процессы сервера и сценария
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--scenario', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--server-url', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.serve:
+        serve(args)
+    elif args.scenario is not None:
+        scenario_main(args)
+    else:
+        report = json.dumps(main(args), ensure_ascii=False, indent=2)
+        if args.output:
+            Path(args.output).write_text(report + '\n', encoding='utf-8')
+        else:
+            print(report)
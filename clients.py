@@ -0,0 +1,116 @@
+import logging
+from typing import Dict, Any, Optional
+
+import aiohttp
+import httpx
+
+from answer_cache import AnswerCache
+from llm_backends import LLMRouter
+from llm_requests import RequestBuilder
+from metrics import HTTP_RESPONSES_TOTAL
+from rate_limiter import RateLimiterRegistry
+from write_buffer import WriteBehindBuffer
+
+
+class ClientRegistry:
+    """
+    Общие для всех магазинов сетевые клиенты: пул соединений aiohttp к Wildberries
+    и бэкенды LLM с маршрутизацией. Создаются один раз на время работы воркера, поэтому
+    TLS-рукопожатия и прогрев пула не повторяются для каждого магазина.
+    """
+    def __init__(self, config: Dict[str, Any]):
+        self.config = config
+        self.http: Optional[aiohttp.ClientSession] = None
+        self.llm: Optional[LLMRouter] = None
+        self._connector: Optional[aiohttp.TCPConnector] = None
+        # Лимиты запросов к WB по продавцам, общие для всех магазинов воркера
+        self.rate_limiters = RateLimiterRegistry(config)
+        # Отложенная пакетная запись статистики и журнала отзывов
+        self.write_buffer = WriteBehindBuffer(config)
+        # Кэш ответов LLM на типовые отзывы
+        self.answer_cache = AnswerCache(config, self.write_buffer)
+        # Префиксы запросов к LLM по версиям промптов магазинов
+        self.request_builder = RequestBuilder(config)
+        self._counters = {
+            'http_requests': 0,
+            'connections_created': 0,
+            'connections_reused': 0,
+            'dns_cache_hits': 0,
+            'dns_cache_misses': 0
+        }
+
+    async def start(self) -> None:
+        """Создание пула соединений и клиентов LLM, запуск отложенной записи в базу"""
+        if self.http is not None:
+            return
+        self.write_buffer.start()
+
+        self._connector = aiohttp.TCPConnector(
+            limit=self.config["HTTP_POOL_LIMIT"],
+            limit_per_host=self.config["HTTP_POOL_LIMIT_PER_HOST"],
+            ttl_dns_cache=self.config["HTTP_DNS_CACHE_SECONDS"],
+            keepalive_timeout=self.config["HTTP_KEEPALIVE_SECONDS"]
+        )
+        self.http = aiohttp.ClientSession(
+            connector=self._connector,
+            trace_configs=[self._build_trace_config()]
+        )
+
+        # Задержки и исправность бэкендов накапливаются по всем магазинам воркера
+        self.llm = LLMRouter(self.config, http_limits=httpx.Limits(
+            max_connections=self.config["LLM_MAX_CONCURRENCY"],
+            max_keepalive_connections=self.config["LLM_MAX_CONCURRENCY"],
+            keepalive_expiry=self.config["HTTP_KEEPALIVE_SECONDS"]
+        ))
+        logging.info(
+            f"Создан общий пул соединений: limit={self.config['HTTP_POOL_LIMIT']}, "
+            f"limit_per_host={self.config['HTTP_POOL_LIMIT_PER_HOST']}"
+        )
+
+    async def close(self) -> None:
+        """Запись накопленного в базу, закрытие пула соединений и клиентов LLM"""
+        await self.write_buffer.close()
+        if self.http is not None:
+            await self.http.close()
+            self.http = None
+            self._connector = None
+        if self.llm is not None:
+            await self.llm.close()
+            self.llm = None
+
+    def _build_trace_config(self) -> aiohttp.TraceConfig:
+        """Счетчики запросов и соединений для подбора размера пула"""
+        trace_config = aiohttp.TraceConfig()
+
+        def count(name: str):
+            async def handler(session, context, params):
+                self._counters[name] += 1
+            return handler
+
+        async def response_received(session, context, params):
+            HTTP_RESPONSES_TOTAL.inc(method=params.method, status=str(params.response.status))
+
+        trace_config.on_request_start.append(count('http_requests'))
+        trace_config.on_request_end.append(response_received)
+        trace_config.on_connection_create_end.append(count('connections_created'))
+        trace_config.on_connection_reuseconn.append(count('connections_reused'))
+        trace_config.on_dns_cache_hit.append(count('dns_cache_hits'))
+        trace_config.on_dns_cache_miss.append(count('dns_cache_misses'))
+        return trace_config
+
+    def metrics(self) -> Dict[str, float]:
+        """Текущее состояние пула соединений и лимитов запросов к Wildberries"""
+        metrics = dict(self._counters)
+        metrics['pool_limit'] = self.config["HTTP_POOL_LIMIT"]
+        metrics['pool_limit_per_host'] = self.config["HTTP_POOL_LIMIT_PER_HOST"]
+        metrics.update({f"rate_limit_{name}": value for name, value in self.rate_limiters.metrics().items()})
+        metrics.update({f"answer_cache_{name}": value for name, value in self.answer_cache.metrics().items()})
+        metrics.update({f"write_buffer_{name}": value for name, value in self.write_buffer.metrics().items()})
+        metrics.update({f"llm_{name}": value for name, value in self.request_builder.metrics().items()})
+        if self.llm is not None:
+            metrics.update({f"llm_{name}": value for name, value in self.llm.metrics().items()})
+        if self._connector is not None:
+            # У TCPConnector нет публичного API для занятых и простаивающих соединений
+            metrics['pool_in_use'] = len(getattr(self._connector, '_acquired', ()))
+            metrics['pool_idle'] = sum(len(conns) for conns in getattr(self._connector, '_conns', {}).values())
+        return metrics
@@ -1,15 +1,19 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy import create_engine, event, Column, Integer, String, Text, DateTime, ForeignKey, Index, Table, UniqueConstraint, bindparam, func, or_
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.dialects import mysql, sqlite
 from sqlalchemy.orm import sessionmaker, relationship, Session
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from contextlib import contextmanager
 import os
+import json
+import hashlib
 from dotenv import load_dotenv
-<<<<<<< HEAD
-from typing import List, Optional
-=======
->>>>>>> 3fbc23b31498ea9f04595cfef8c26548fdc8465c
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from api_keys import api_key_hash, introspect_api_key
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -23,8 +27,23 @@ DB_NAME = "u3132037_default"
 # Создание URL для подключения к базе данных
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+def enable_sqlite_foreign_keys(engine: Engine) -> None:
+    """
+    Включение внешних ключей в SQLite (по умолчанию выключены), чтобы ON DELETE CASCADE
+    удалял строки магазина в базе, как в MySQL, без загрузки их в ORM
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, "connect")
+    def _foreign_keys_on(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
 # Создание движка SQLAlchemy с явным указанием драйвера
 engine = create_engine(DATABASE_URL)
+enable_sqlite_foreign_keys(engine)
 
 # Создание базового класса для моделей
 Base = declarative_base()
@@ -32,22 +51,49 @@ Base = declarative_base()
 # Определение моделей
 class Store(Base):
     __tablename__ = 'stores'
+    __table_args__ = (
+        Index('uq_stores_wb_api_key_hash', 'wb_api_key_hash', unique=True),
+    )
     
     id = Column(Integer, primary_key=True)
-    name = Column(String(255), nullable=False)
+    name = Column(String(255), nullable=False, index=True)
     wb_api_key = Column(String(255), nullable=False)
+    # SHA-256 ключа API для поиска магазина по ключу по индексу
+    wb_api_key_hash = Column(String(64))
     prompt = Column(Text, nullable=False)
-    telegram_user_id = Column(String(255))
+    telegram_user_id = Column(String(255), index=True)
+    # Данные из JWT ключа API: заполняются при добавлении магазина, чтобы не разбирать ключ при каждом запросе
+    key_expires_at = Column(DateTime, index=True)
+    seller_id = Column(String(64))
+    key_scopes = Column(Integer)
+    # Когда владельцу отправлено предупреждение об истечении ключа
+    key_expiry_warned_at = Column(DateTime)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
-    statistics = relationship("StoreStatistics", back_populates="store", uselist=False)
+    statistics = relationship("StoreStatistics", back_populates="store", uselist=False, cascade="all, delete-orphan")
+    review_cursor = relationship("StoreReviewCursor", cascade="all, delete-orphan", uselist=False)
+    # Журнал может быть большим: строки удаляет база (ON DELETE CASCADE), а не ORM по одной
+    processed_reviews = relationship("ProcessedReview", cascade="all, delete-orphan", passive_deletes=True)
+    cached_answers = relationship("CachedAnswer", cascade="all, delete-orphan")
+    llm_batches = relationship("LLMBatch", cascade="all, delete-orphan")
+
+    def set_key_info(self):
+        """Заполнение данных ключа API из JWT"""
+        self.wb_api_key_hash = api_key_hash(self.wb_api_key)
+        info = introspect_api_key(self.wb_api_key)
+        self.key_expires_at = info.expires_at if info else None
+        self.seller_id = info.seller_id if info else None
+        self.key_scopes = info.scopes if info else None
 
 class StoreStatistics(Base):
     __tablename__ = 'store_statistics'
+    __table_args__ = (
+        Index('uq_store_statistics_store_id', 'store_id', unique=True),
+    )
     
     id = Column(Integer, primary_key=True)
-    store_id = Column(Integer, ForeignKey('stores.id'), nullable=False)
+    store_id = Column(Integer, ForeignKey('stores.id', ondelete='CASCADE'), nullable=False)
     total_reviews = Column(Integer, default=0)
     answered_reviews = Column(Integer, default=0)
     last_check_time = Column(DateTime)
@@ -56,6 +102,153 @@ class StoreStatistics(Base):
     
     store = relationship("Store", back_populates="statistics")
 
+class StoreReviewCursor(Base):
+    """Курсор инкрементальной загрузки отзывов: самый новый обработанный отзыв магазина"""
+    __tablename__ = 'store_review_cursors'
+    
+    id = Column(Integer, primary_key=True)
+    store_id = Column(Integer, ForeignKey('stores.id', ondelete='CASCADE'), nullable=False, unique=True)
+    # Дробные секунды обязательны: обычный DATETIME в MySQL округляет до секунды
+    last_created_date = Column(DateTime().with_variant(mysql.DATETIME(fsp=6), 'mysql'))
+    # JSON-список id всех отзывов с датой last_created_date
+    last_feedback_ids = Column(Text)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ProcessedReview(Base):
+    """Журнал обработанных отзывов: защищает от повторной генерации и отправки ответов"""
+    __tablename__ = 'processed_reviews'
+    __table_args__ = (
+        UniqueConstraint('store_id', 'feedback_id', name='uq_processed_reviews_store_feedback'),
+        # Очистка журнала от старых завершенных записей
+        Index('ix_processed_reviews_status_updated', 'status', 'updated_at'),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    store_id = Column(Integer, ForeignKey('stores.id', ondelete='CASCADE'), nullable=False)
+    feedback_id = Column(String(64), nullable=False)
+    status = Column(String(32), nullable=False)
+    answer_hash = Column(String(64))
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class CachedAnswer(Base):
+    """Кэш ответов LLM на типовые отзывы: ключ - хэш промпта, нормализованного текста и оценки"""
+    __tablename__ = 'answer_cache'
+    
+    id = Column(Integer, primary_key=True)
+    cache_key = Column(String(64), nullable=False, unique=True)
+    store_id = Column(Integer, ForeignKey('stores.id', ondelete='CASCADE'), nullable=False)
+    # JSON-список вариантов ответа
+    answers = Column(Text, nullable=False)
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class WorkerHeartbeat(Base):
+    """Живые воркеры обработки отзывов: по этому списку магазины делятся между воркерами"""
+    __tablename__ = 'worker_heartbeats'
+    
+    id = Column(Integer, primary_key=True)
+    worker_id = Column(String(255), nullable=False, unique=True)
+    started_at = Column(DateTime, default=datetime.utcnow)
+    heartbeat_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class CycleMetric(Base):
+    """Метрики цикла обработки магазина (только добавление записей)"""
+    __tablename__ = 'cycle_metrics'
+    __table_args__ = (
+        Index('ix_cycle_metrics_store_started', 'store_id', 'started_at'),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    store_id = Column(Integer, ForeignKey('stores.id', ondelete='CASCADE'), nullable=False)
+    started_at = Column(DateTime, nullable=False, index=True)
+    finished_at = Column(DateTime, nullable=False)
+    fetched = Column(Integer, default=0)
+    answered = Column(Integer, default=0)
+    skipped = Column(Integer, default=0)
+    errors = Column(Integer, default=0)
+    llm_calls = Column(Integer, default=0)
+    # Суммарная задержка запросов к LLM за цикл
+    llm_latency_ms = Column(Integer, default=0)
+    prompt_tokens = Column(Integer, default=0)
+    completion_tokens = Column(Integer, default=0)
+    # Часть prompt_tokens, взятая из кэша префиксов провайдера
+    cached_tokens = Column(Integer, default=0)
+
+class CycleMetricRollup(Base):
+    """Суммы метрик циклов магазина по часам и по дням, обновляются при записи циклов"""
+    __tablename__ = 'cycle_metric_rollups'
+    __table_args__ = (
+        UniqueConstraint('store_id', 'period', 'bucket_start', name='uq_cycle_metric_rollups_bucket'),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    store_id = Column(Integer, ForeignKey('stores.id', ondelete='CASCADE'), nullable=False)
+    # ROLLUP_HOUR или ROLLUP_DAY
+    period = Column(String(8), nullable=False)
+    bucket_start = Column(DateTime, nullable=False)
+    cycles = Column(Integer, default=0)
+    fetched = Column(Integer, default=0)
+    answered = Column(Integer, default=0)
+    skipped = Column(Integer, default=0)
+    errors = Column(Integer, default=0)
+    llm_calls = Column(Integer, default=0)
+    llm_latency_ms = Column(Integer, default=0)
+    prompt_tokens = Column(Integer, default=0)
+    completion_tokens = Column(Integer, default=0)
+    # Часть prompt_tokens, взятая из кэша префиксов провайдера
+    cached_tokens = Column(Integer, default=0)
+
+class LLMBatch(Base):
+    """Пакет запросов к OpenAI Batch API с накопившимися отзывами магазина"""
+    __tablename__ = 'llm_batches'
+    __table_args__ = (
+        Index('ix_llm_batches_store_finished', 'store_id', 'finished_at'),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    store_id = Column(Integer, ForeignKey('stores.id', ondelete='CASCADE'), nullable=False)
+    # id пакета у провайдера
+    batch_id = Column(String(64), nullable=False, unique=True)
+    # Последний полученный статус пакета у провайдера
+    status = Column(String(32), nullable=False)
+    request_count = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Когда результаты переданы на отправку ответов; NULL - пакет еще ожидается
+    finished_at = Column(DateTime)
+    
+    reviews = relationship("LLMBatchReview", cascade="all, delete-orphan")
+
+class LLMBatchReview(Base):
+    """Отзыв в пакете Batch API: данные для отправки ответа и повторной генерации"""
+    __tablename__ = 'llm_batch_reviews'
+    
+    id = Column(Integer, primary_key=True)
+    llm_batch_id = Column(Integer, ForeignKey('llm_batches.id', ondelete='CASCADE'), nullable=False, index=True)
+    feedback_id = Column(String(64), nullable=False)
+    review_text = Column(Text, nullable=False)
+    valuation = Column(Integer)
+    created_date = Column(DateTime)
+
+# Периоды агрегатов метрик циклов
+ROLLUP_HOUR = 'hour'
+ROLLUP_DAY = 'day'
+# Суммируемые метрики цикла
+CYCLE_METRIC_FIELDS = ('fetched', 'answered', 'skipped', 'errors', 'llm_calls', 'llm_latency_ms',
+                       'prompt_tokens', 'completion_tokens', 'cached_tokens')
+
+# Статусы записей журнала обработанных отзывов
+REVIEW_STATUS_PROCESSING = 'processing'
+REVIEW_STATUS_ANSWERED = 'answered'
+REVIEW_STATUS_SKIPPED = 'skipped'
+REVIEW_STATUS_FAILED = 'failed'
+# Отзыв отправлен в пакет Batch API и ждет результата (повторно не захватывается)
+REVIEW_STATUS_BATCHED = 'batched'
+# Отзывы с этими статусами больше никогда не обрабатываются
+FINAL_REVIEW_STATUSES = (REVIEW_STATUS_ANSWERED, REVIEW_STATUS_SKIPPED)
+
 # Создание сессии
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -73,8 +266,15 @@ def session_scope():
         session.close()
 
 def init_db():
-    """Инициализация базы данных"""
-    Base.metadata.create_all(bind=engine)
+    """Инициализация базы данных: создание таблиц и применение миграций схемы"""
+    from migrations import migrate
+    migrate(engine)
+
+def backfill_store_key_info():
+    """Заполнение данных ключа API у магазинов, добавленных до появления этих колонок"""
+    with session_scope() as session:
+        for store in session.query(Store).filter(or_(Store.key_expires_at.is_(None), Store.wb_api_key_hash.is_(None))):
+            store.set_key_info()
 
 def add_store(name: str, wb_api_key: str, prompt: str, telegram_user_id: str) -> bool:
     """Добавление нового магазина"""
@@ -86,6 +286,7 @@ def add_store(name: str, wb_api_key: str, prompt: str, telegram_user_id: str) ->
                 prompt=prompt,
                 telegram_user_id=telegram_user_id
             )
+            store.set_key_info()
             session.add(store)
         return True
     except Exception as e:
@@ -120,22 +321,399 @@ def delete_store(name: str, telegram_user_id: str) -> bool:
 def get_store_by_api_key(wb_api_key: str) -> Store:
     """Получение магазина по API-ключу"""
     with session_scope() as session:
-        return session.query(Store).filter_by(wb_api_key=wb_api_key).first()
+        return session.query(Store).filter_by(wb_api_key_hash=api_key_hash(wb_api_key)).first()
 
-def update_store_statistics(store_id: int, total_reviews: int, answered_reviews: int, last_check_time: datetime):
-    """Обновление статистики магазина"""
-    with session_scope() as session:
-        stats = session.query(StoreStatistics).filter(StoreStatistics.store_id == store_id).first()
-        if not stats:
-            stats = StoreStatistics(store_id=store_id)
-            session.add(stats)
-        
-            stats.total_reviews = total_reviews
-            stats.answered_reviews = answered_reviews
-        stats.last_check_time = last_check_time
-        session.commit()
+@contextmanager
+def _use_session(session: Optional[Session]):
+    """Сессия вызывающего кода (одна транзакция на несколько записей) или собственная"""
+    if session is not None:
+        yield session
+    else:
+        with session_scope() as own_session:
+            yield own_session
+
+def _bulk_upsert(session: Session, table: Table, rows: List[Dict[str, Any]], conflict_columns: List[str],
+                 update: Callable[[Any], Dict[str, Any]]):
+    """
+    Пакетная вставка строк с обновлением существующих одним executemany:
+    INSERT ... ON DUPLICATE KEY UPDATE в MySQL и INSERT ... ON CONFLICT DO UPDATE в SQLite.
+    update получает новые значения строки (inserted/excluded) и возвращает обновляемые колонки
+    """
+    if not rows:
+        return
+    if engine.dialect.name == 'mysql':
+        statement = mysql.insert(table)
+        statement = statement.on_duplicate_key_update(update(statement.inserted))
+    elif engine.dialect.name == 'sqlite':
+        statement = sqlite.insert(table)
+        statement = statement.on_conflict_do_update(index_elements=conflict_columns, set_=update(statement.excluded))
+    else:
+        raise ValueError(f"Пакетная запись не поддерживается для базы данных {engine.dialect.name}")
+    session.execute(statement, rows)
+
+def add_store_statistics(rows: List[Dict[str, Any]], session: Optional[Session] = None):
+    """
+    Накопительное обновление статистики магазинов пакетом. Строки: store_id,
+    total_reviews и answered_reviews (прирост за период), last_check_time
+    """
+    table = StoreStatistics.__table__
+    now = datetime.utcnow()
+    with _use_session(session) as session:
+        _bulk_upsert(
+            session,
+            table,
+            [{**row, 'created_at': now, 'updated_at': now} for row in rows],
+            ['store_id'],
+            lambda new: {
+                'total_reviews': func.coalesce(table.c.total_reviews, 0) + new.total_reviews,
+                'answered_reviews': func.coalesce(table.c.answered_reviews, 0) + new.answered_reviews,
+                'last_check_time': new.last_check_time,
+                'updated_at': new.updated_at
+            }
+        )
 
 def get_store_statistics(store_id: int) -> StoreStatistics:
     """Получение статистики магазина"""
     with session_scope() as session:
-        return session.query(StoreStatistics).filter_by(store_id=store_id).first() 
+        return session.query(StoreStatistics).filter_by(store_id=store_id).first()
+
+def get_review_cursor(store_id: int) -> Optional[Tuple[datetime, List[str]]]:
+    """Получение курсора (дата, id отзывов с этой датой) самого нового обработанного отзыва магазина"""
+    with session_scope() as session:
+        cursor = session.query(StoreReviewCursor).filter_by(store_id=store_id).first()
+        if not cursor or not cursor.last_created_date:
+            return None
+        return cursor.last_created_date, json.loads(cursor.last_feedback_ids or "[]")
+
+def update_review_cursor(store_id: int, last_created_date: datetime, last_feedback_ids: List[str]):
+    """Сохранение курсора инкрементальной загрузки отзывов"""
+    with session_scope() as session:
+        cursor = session.query(StoreReviewCursor).filter_by(store_id=store_id).first()
+        if not cursor:
+            cursor = StoreReviewCursor(store_id=store_id)
+            session.add(cursor)
+        cursor.last_created_date = last_created_date
+        cursor.last_feedback_ids = json.dumps(sorted(last_feedback_ids))
+
+def get_processed_review_ids(store_id: int, feedback_ids: Optional[List[str]] = None) -> Set[str]:
+    """
+    Получение id отзывов магазина, обработка которых завершена: всех или только
+    из feedback_ids (частями, чтобы не упираться в размер IN)
+    """
+    with session_scope() as session:
+        query = session.query(ProcessedReview.feedback_id).filter(
+            ProcessedReview.store_id == store_id,
+            ProcessedReview.status.in_(FINAL_REVIEW_STATUSES)
+        )
+        if feedback_ids is None:
+            return {row.feedback_id for row in query}
+        processed = set()
+        for start in range(0, len(feedback_ids), 500):
+            processed.update(row.feedback_id for row in query.filter(
+                ProcessedReview.feedback_id.in_(feedback_ids[start:start + 500])
+            ))
+        return processed
+
+def get_failed_review_ids(store_id: int, limit: int) -> List[str]:
+    """id отзывов магазина с ошибкой обработки, начиная с самой давней попытки"""
+    with session_scope() as session:
+        rows = session.query(ProcessedReview.feedback_id).filter(
+            ProcessedReview.store_id == store_id,
+            ProcessedReview.status == REVIEW_STATUS_FAILED
+        ).order_by(ProcessedReview.updated_at, ProcessedReview.id).limit(limit).all()
+        return [row.feedback_id for row in rows]
+
+def claim_review(store_id: int, feedback_id: str, stale_after: timedelta) -> bool:
+    """
+    Захват отзыва на обработку. Уникальный индекс гарантирует, что отзыв
+    обрабатывает только один воркер. Повторно захватываются отзывы с ошибкой
+    и зависшие в обработке дольше stale_after.
+    """
+    try:
+        with session_scope() as session:
+            session.add(ProcessedReview(
+                store_id=store_id,
+                feedback_id=feedback_id,
+                status=REVIEW_STATUS_PROCESSING
+            ))
+        return True
+    except IntegrityError:
+        pass
+    
+    with session_scope() as session:
+        claimed = session.query(ProcessedReview).filter(
+            ProcessedReview.store_id == store_id,
+            ProcessedReview.feedback_id == feedback_id,
+            or_(
+                ProcessedReview.status == REVIEW_STATUS_FAILED,
+                (ProcessedReview.status == REVIEW_STATUS_PROCESSING)
+                & (ProcessedReview.updated_at < datetime.utcnow() - stale_after)
+            )
+        ).update(
+            {ProcessedReview.status: REVIEW_STATUS_PROCESSING, ProcessedReview.updated_at: datetime.utcnow()},
+            synchronize_session=False
+        )
+        return claimed == 1
+
+def finish_review(store_id: int, feedback_id: str, status: str, answer_text: Optional[str] = None):
+    """Сохранение результата обработки отзыва в журнале"""
+    with session_scope() as session:
+        record = session.query(ProcessedReview).filter_by(store_id=store_id, feedback_id=feedback_id).first()
+        if not record:
+            record = ProcessedReview(store_id=store_id, feedback_id=feedback_id)
+            session.add(record)
+        record.status = status
+        if answer_text is not None:
+            record.answer_hash = _answer_hash(answer_text)
+
+def _answer_hash(answer_text: Optional[str]) -> Optional[str]:
+    return hashlib.sha256(answer_text.encode('utf-8')).hexdigest() if answer_text is not None else None
+
+def finish_reviews(rows: List[Dict[str, Any]], session: Optional[Session] = None):
+    """
+    Сохранение результатов обработки отзывов в журнале пакетом. Строки: store_id,
+    feedback_id, status и answer_text (None, если ответа нет)
+    """
+    table = ProcessedReview.__table__
+    now = datetime.utcnow()
+    with _use_session(session) as session:
+        _bulk_upsert(
+            session,
+            table,
+            [{
+                'store_id': row['store_id'],
+                'feedback_id': row['feedback_id'],
+                'status': row['status'],
+                'answer_hash': _answer_hash(row.get('answer_text')),
+                'created_at': now,
+                'updated_at': now
+            } for row in rows],
+            ['store_id', 'feedback_id'],
+            lambda new: {
+                'status': new.status,
+                'answer_hash': func.coalesce(new.answer_hash, table.c.answer_hash),
+                'updated_at': new.updated_at
+            }
+        )
+
+def rollup_bucket_start(moment: datetime, period: str) -> datetime:
+    """Начало часа или дня, к которому относится момент"""
+    moment = moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0) if period == ROLLUP_DAY else moment
+
+def save_cycle_metrics(rows: List[Dict[str, Any]], session: Optional[Session] = None):
+    """
+    Запись метрик циклов и прибавление их к часовым и дневным агрегатам.
+    Строки: store_id, started_at, finished_at и поля CYCLE_METRIC_FIELDS
+    """
+    if not rows:
+        return
+    buckets: Dict[Tuple[int, str, datetime], Dict[str, Any]] = {}
+    for row in rows:
+        for period in (ROLLUP_HOUR, ROLLUP_DAY):
+            bucket_start = rollup_bucket_start(row['started_at'], period)
+            bucket = buckets.setdefault((row['store_id'], period, bucket_start), {
+                'store_id': row['store_id'], 'period': period, 'bucket_start': bucket_start, 'cycles': 0,
+                **{field: 0 for field in CYCLE_METRIC_FIELDS}
+            })
+            bucket['cycles'] += 1
+            for field in CYCLE_METRIC_FIELDS:
+                bucket[field] += row.get(field, 0)
+    
+    table = CycleMetricRollup.__table__
+    with _use_session(session) as session:
+        session.execute(CycleMetric.__table__.insert(), rows)
+        _bulk_upsert(
+            session,
+            table,
+            list(buckets.values()),
+            ['store_id', 'period', 'bucket_start'],
+            lambda new: {
+                field: func.coalesce(table.c[field], 0) + new[field]
+                for field in ('cycles',) + CYCLE_METRIC_FIELDS
+            }
+        )
+
+def get_store_tokens_since(store_id: int, since: datetime) -> int:
+    """Токены LLM магазина (prompt + completion) по дневным агрегатам начиная с since"""
+    with session_scope() as session:
+        total = session.query(
+            func.sum(func.coalesce(CycleMetricRollup.prompt_tokens, 0) + func.coalesce(CycleMetricRollup.completion_tokens, 0))
+        ).filter(
+            CycleMetricRollup.store_id == store_id,
+            CycleMetricRollup.period == ROLLUP_DAY,
+            CycleMetricRollup.bucket_start >= since
+        ).scalar()
+        return int(total or 0)
+
+def prune_cycle_metrics(before: datetime) -> int:
+    """Удаление метрик циклов и часовых агрегатов старше before (дневные агрегаты хранятся)"""
+    with session_scope() as session:
+        removed = session.query(CycleMetric).filter(
+            CycleMetric.started_at < before
+        ).delete(synchronize_session=False)
+        removed += session.query(CycleMetricRollup).filter(
+            CycleMetricRollup.period == ROLLUP_HOUR,
+            CycleMetricRollup.bucket_start < before
+        ).delete(synchronize_session=False)
+        return removed
+
+def prune_processed_reviews(before: datetime) -> int:
+    """
+    Удаление завершенных записей журнала (answered, skipped), не менявшихся с before.
+    Записи с ошибкой, в обработке и в пакетах Batch API сохраняются
+    """
+    with session_scope() as session:
+        return session.query(ProcessedReview).filter(
+            ProcessedReview.status.in_(FINAL_REVIEW_STATUSES),
+            ProcessedReview.updated_at < before
+        ).delete(synchronize_session=False)
+
+def _set_review_status(session: Session, store_id: int, feedback_ids: List[str], status: str,
+                       only_status: Optional[str] = None):
+    """Смена статуса отзывов в журнале (частями, чтобы не упираться в размер IN)"""
+    for start in range(0, len(feedback_ids), 500):
+        query = session.query(ProcessedReview).filter(
+            ProcessedReview.store_id == store_id,
+            ProcessedReview.feedback_id.in_(feedback_ids[start:start + 500])
+        )
+        if only_status is not None:
+            query = query.filter(ProcessedReview.status == only_status)
+        query.update(
+            {ProcessedReview.status: status, ProcessedReview.updated_at: datetime.utcnow()},
+            synchronize_session=False
+        )
+
+def save_llm_batch(store_id: int, batch_id: str, status: str, reviews: List[Dict[str, Any]]):
+    """
+    Сохранение отправленного пакета Batch API с его отзывами (feedback_id, review_text,
+    valuation, created_date) и перевод отзывов в журнале в статус batched одной транзакцией
+    """
+    with session_scope() as session:
+        batch = LLMBatch(store_id=store_id, batch_id=batch_id, status=status, request_count=len(reviews))
+        session.add(batch)
+        session.flush()
+        session.execute(LLMBatchReview.__table__.insert(), [{**review, 'llm_batch_id': batch.id} for review in reviews])
+        _set_review_status(session, store_id, [review['feedback_id'] for review in reviews], REVIEW_STATUS_BATCHED)
+
+def get_pending_llm_batches(store_id: int) -> List[Tuple[int, str, str]]:
+    """Ожидающие результата пакеты Batch API магазина: (id записи, id пакета у провайдера, статус)"""
+    with session_scope() as session:
+        rows = session.query(LLMBatch.id, LLMBatch.batch_id, LLMBatch.status).filter(
+            LLMBatch.store_id == store_id,
+            LLMBatch.finished_at.is_(None)
+        ).order_by(LLMBatch.id).all()
+        return [(row.id, row.batch_id, row.status) for row in rows]
+
+def update_llm_batch_status(llm_batch_id: int, status: str):
+    """Сохранение статуса пакета Batch API"""
+    with session_scope() as session:
+        session.query(LLMBatch).filter_by(id=llm_batch_id).update(
+            {LLMBatch.status: status, LLMBatch.updated_at: datetime.utcnow()}, synchronize_session=False
+        )
+
+def finish_llm_batch(llm_batch_id: int, status: str) -> List[Dict[str, Any]]:
+    """
+    Завершение пакета Batch API: возвращает его отзывы и удаляет их из пакета.
+    Отзывы в журнале возвращаются в статус processing, поэтому при сбое до отправки
+    ответов их снова захватят после REVIEW_CLAIM_TIMEOUT_MINUTES
+    """
+    with session_scope() as session:
+        batch = session.query(LLMBatch).filter_by(id=llm_batch_id).first()
+        if not batch or batch.finished_at is not None:
+            return []
+        reviews = [{
+            'feedback_id': review.feedback_id,
+            'review_text': review.review_text,
+            'valuation': review.valuation,
+            'created_date': review.created_date
+        } for review in batch.reviews]
+        _set_review_status(
+            session, batch.store_id, [review['feedback_id'] for review in reviews],
+            REVIEW_STATUS_PROCESSING, only_status=REVIEW_STATUS_BATCHED
+        )
+        batch.reviews.clear()
+        batch.status = status
+        batch.finished_at = datetime.utcnow()
+        return reviews
+
+def get_cached_answers(cache_key: str, ttl: timedelta) -> List[str]:
+    """Получение вариантов ответа из кэша (пустой список, если записи нет или она устарела)"""
+    with session_scope() as session:
+        entry = session.query(CachedAnswer).filter(
+            CachedAnswer.cache_key == cache_key,
+            CachedAnswer.created_at > datetime.utcnow() - ttl
+        ).first()
+        return json.loads(entry.answers) if entry else []
+
+def save_cached_answers(store_id: int, cache_key: str, answers: List[str]):
+    """Сохранение вариантов ответа в кэш"""
+    with session_scope() as session:
+        entry = session.query(CachedAnswer).filter_by(cache_key=cache_key).first()
+        if not entry:
+            entry = CachedAnswer(store_id=store_id, cache_key=cache_key)
+            session.add(entry)
+        elif len(answers) == 1:
+            # Первый вариант вместо устаревшей записи: срок жизни отсчитывается заново
+            entry.created_at = datetime.utcnow()
+        entry.answers = json.dumps(answers, ensure_ascii=False)
+        entry.last_used_at = datetime.utcnow()
+
+def touch_cached_answer(cache_key: str):
+    """Учет попадания в кэш для вытеснения давно не используемых записей"""
+    with session_scope() as session:
+        session.query(CachedAnswer).filter_by(cache_key=cache_key).update(
+            {CachedAnswer.hits: CachedAnswer.hits + 1, CachedAnswer.last_used_at: datetime.utcnow()},
+            synchronize_session=False
+        )
+
+def touch_cached_answers(hits: Dict[str, int], session: Optional[Session] = None):
+    """Учет накопленных попаданий в кэш пакетом: {ключ кэша: число попаданий}"""
+    if not hits:
+        return
+    table = CachedAnswer.__table__
+    now = datetime.utcnow()
+    with _use_session(session) as session:
+        session.connection().execute(
+            table.update().where(table.c.cache_key == bindparam('key'))
+            .values(hits=table.c.hits + bindparam('count'), last_used_at=now),
+            [{'key': cache_key, 'count': count} for cache_key, count in hits.items()]
+        )
+
+def evict_cached_answers(ttl: timedelta, max_entries: int) -> int:
+    """Удаление устаревших записей кэша и давно не используемых сверх max_entries"""
+    with session_scope() as session:
+        removed = session.query(CachedAnswer).filter(
+            CachedAnswer.created_at <= datetime.utcnow() - ttl
+        ).delete(synchronize_session=False)
+        
+        overflow = session.query(CachedAnswer).count() - max_entries
+        if overflow > 0:
+            stale_ids = [row.id for row in session.query(CachedAnswer.id)
+                         .order_by(CachedAnswer.last_used_at).limit(overflow)]
+            removed += session.query(CachedAnswer).filter(
+                CachedAnswer.id.in_(stale_ids)
+            ).delete(synchronize_session=False)
+        return removed
+
+def heartbeat_worker(worker_id: str):
+    """Продление регистрации воркера"""
+    with session_scope() as session:
+        updated = session.query(WorkerHeartbeat).filter_by(worker_id=worker_id).update(
+            {WorkerHeartbeat.heartbeat_at: datetime.utcnow()}, synchronize_session=False
+        )
+        if not updated:
+            session.add(WorkerHeartbeat(worker_id=worker_id))
+
+def get_live_workers(lease: timedelta) -> List[str]:
+    """Воркеры, обновлявшие регистрацию не раньше lease назад"""
+    with session_scope() as session:
+        rows = session.query(WorkerHeartbeat.worker_id).filter(
+            WorkerHeartbeat.heartbeat_at > datetime.utcnow() - lease
+        ).all()
+        return sorted(row.worker_id for row in rows)
+
+def remove_worker(worker_id: str):
+    """Снятие регистрации воркера при штатной остановке"""
+    with session_scope() as session:
+        session.query(WorkerHeartbeat).filter_by(worker_id=worker_id).delete(synchronize_session=False)
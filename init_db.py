@@ -1,6 +1,6 @@
 from database import init_db
 
 if __name__ == "__main__":
-    print("Создание таблиц в базе данных...")
+    print("Создание таблиц и применение миграций базы данных...")
     init_db()
-    print("Таблицы успешно созданы!") 
\ No newline at end of file
+    print("База данных в актуальном состоянии!")
@@ -0,0 +1,260 @@
+"""
+Бэкенды LLM и маршрутизация запросов между ними.
+
+Бэкенд - OpenAI-совместимый API chat.completions: OpenAI, DeepSeek или
+локальный сервер (llama.cpp, vLLM) по адресу LOCAL_LLM_BASE_URL. Включенные
+бэкенды перечисляются в LLM_BACKENDS, магазин может ограничить их и выбрать
+модели в LLM_STORE_BACKENDS: {"id магазина": "local:qwen2.5-7b-instruct"} или
+список таких значений; модель без указания берется из настроек бэкенда.
+
+Запрос уходит на исправный бэкенд магазина с наименьшей скользящей средней
+задержки. После LLM_BACKEND_FAILURES ошибок подряд бэкенд исключается на
+LLM_BACKEND_COOLDOWN_SECONDS, затем получает запросы снова, но следующая ошибка
+сразу исключает его повторно. Если ответ не пришел за p95 задержки бэкенда,
+тот же запрос дублируется на следующий бэкенд (hedged request) и берется
+первый ответ; при ошибке запрос повторяется на следующем бэкенде.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+import httpx
+import openai
+
+from metrics import LLM_BACKEND_SECONDS, LLM_HEDGED_TOTAL
+
+OPENAI = 'openai'
+DEEPSEEK = 'deepseek'
+LOCAL = 'local'
+
+# Число последних задержек бэкенда для расчета p95
+LATENCY_WINDOW = 200
+# Вес нового замера в скользящей средней задержки
+LATENCY_EWMA_ALPHA = 0.2
+
+
+class LLMBackend:
+    """OpenAI-совместимый бэкенд: клиент, модель по умолчанию, задержки и исправность"""
+    def __init__(self, name: str, client: openai.AsyncOpenAI, model: str,
+                 failure_threshold: int, cooldown_seconds: float):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown_seconds = cooldown_seconds
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        # Скользящая средняя задержки; None - замеров еще нет
+        self.ewma: Optional[float] = None
+        self.failures = 0
+        self.unhealthy_until = 0.0
+        self.errors = 0
+
+    def healthy(self, now: Optional[float] = None) -> bool:
+        return (time.monotonic() if now is None else now) >= self.unhealthy_until
+
+    def record_latency(self, seconds: float) -> None:
+        self.latencies.append(seconds)
+        self.ewma = seconds if self.ewma is None else self.ewma + LATENCY_EWMA_ALPHA * (seconds - self.ewma)
+
+    def record_success(self, seconds: float) -> None:
+        self.record_latency(seconds)
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.errors += 1
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.unhealthy_until = time.monotonic() + self.cooldown_seconds
+            logging.warning(
+                f"Бэкенд LLM {self.name} исключен на {self.cooldown_seconds:g} с "
+                f"после {self.failures} ошибок подряд"
+            )
+
+    def p95(self) -> Optional[float]:
+        """95-й перцентиль последних задержек в секундах или None без замеров"""
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+class Route(NamedTuple):
+    """Бэкенд и модель для запроса магазина"""
+    backend: LLMBackend
+    model: str
+
+
+def _backend_settings(name: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    """Ключ, адрес и модель бэкенда из конфигурации"""
+    if name == OPENAI:
+        # Адрес по умолчанию клиент берет из OPENAI_BASE_URL
+        settings = {'api_key': config["OPENAI_API_KEY"], 'base_url': None, 'model': config["OPENAI_MODEL"]}
+    elif name == DEEPSEEK:
+        settings = {'api_key': config["DEEPSEEK_API_KEY"], 'base_url': config["DEEPSEEK_BASE_URL"],
+                    'model': config["DEEPSEEK_MODEL"]}
+    elif name == LOCAL:
+        if not config["LOCAL_LLM_BASE_URL"]:
+            raise ValueError("Для бэкенда local не задан LOCAL_LLM_BASE_URL")
+        # Локальные серверы обычно не проверяют ключ, но клиент OpenAI требует непустой
+        settings = {'api_key': config["LOCAL_LLM_API_KEY"] or 'local', 'base_url': config["LOCAL_LLM_BASE_URL"],
+                    'model': config["LOCAL_LLM_MODEL"]}
+    else:
+        raise ValueError(f"Неизвестный бэкенд LLM: {name}")
+    if not settings['api_key']:
+        raise ValueError(f"Для бэкенда {name} не задан API ключ")
+    return settings
+
+
+class LLMRouter:
+    """Бэкенды LLM воркера с выбором по задержке, исключением неисправных и дублированием медленных запросов"""
+    def __init__(self, config: Dict[str, Any], http_limits: Optional[httpx.Limits] = None):
+        self.config = config
+        if not config["LLM_BACKENDS"]:
+            raise ValueError("Не задан ни один бэкенд LLM (LLM_BACKENDS)")
+        self.backends: Dict[str, LLMBackend] = {}
+        for name in config["LLM_BACKENDS"]:
+            settings = _backend_settings(name, config)
+            client = openai.AsyncOpenAI(
+                api_key=settings['api_key'],
+                base_url=settings['base_url'],
+                timeout=config["OPENAI_TIMEOUT_SECONDS"],
+                http_client=openai.DefaultAsyncHttpxClient(limits=http_limits) if http_limits else None
+            )
+            self.backends[name] = LLMBackend(
+                name, client, settings['model'],
+                config["LLM_BACKEND_FAILURES"], config["LLM_BACKEND_COOLDOWN_SECONDS"]
+            )
+        self.store_routes = {
+            store_id: self._parse_routes(spec) for store_id, spec in config["LLM_STORE_BACKENDS"].items()
+        }
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+
+    def _parse_routes(self, spec: Any) -> List[Route]:
+        """Маршруты магазина из "бэкенд" / "бэкенд:модель" или списка таких строк"""
+        routes = []
+        for item in [spec] if isinstance(spec, str) else spec:
+            name, _, model = item.partition(':')
+            backend = self.backends.get(name)
+            if backend is None:
+                raise ValueError(f"В LLM_STORE_BACKENDS указан невключенный бэкенд LLM: {name}")
+            routes.append(Route(backend, model or backend.model))
+        return routes
+
+    def routes(self, store_id: int) -> List[Route]:
+        """Бэкенды магазина: исправные по возрастанию задержки, затем исключенные"""
+        routes = self.store_routes.get(str(store_id)) or [
+            Route(backend, backend.model) for backend in self.backends.values()
+        ]
+        now = time.monotonic()
+        # Бэкенды без замеров идут первыми, чтобы получить оценку задержки
+        healthy = sorted((route for route in routes if route.backend.healthy(now)),
+                         key=lambda route: route.backend.ewma or 0.0)
+        unhealthy = sorted((route for route in routes if not route.backend.healthy(now)),
+                           key=lambda route: route.backend.unhealthy_until)
+        return healthy + unhealthy
+
+    def hedge_delay(self, backend: LLMBackend) -> Optional[float]:
+        """Через сколько секунд продублировать запрос к бэкенду; None - не дублировать"""
+        if not self.config["LLM_HEDGE_ENABLED"] or len(backend.latencies) < self.config["LLM_HEDGE_MIN_SAMPLES"]:
+            return None
+        return backend.p95()
+
+    async def create(self, store_id: int, request: Dict[str, Any], timeout: float) -> Any:
+        """
+        Запрос chat.completions магазина (параметры без модели). Возвращает первый
+        успешный ответ; если не ответил ни один бэкенд, пробрасывает последнюю ошибку
+        """
+        routes = self.routes(store_id)
+        pending: Dict[asyncio.Future, Tuple[Route, float]] = {}
+        attempts = 0
+        hedge: Optional[asyncio.Future] = None
+        last_error: Optional[BaseException] = None
+
+        def launch() -> asyncio.Future:
+            nonlocal attempts
+            route = routes[attempts]
+            attempts += 1
+            task = asyncio.ensure_future(route.backend.client.chat.completions.create(
+                **request, model=route.model, timeout=timeout
+            ))
+            pending[task] = (route, time.monotonic())
+            return task
+
+        launch()
+        try:
+            while pending:
+                delay = None
+                if hedge is None and len(pending) == 1 and attempts < len(routes):
+                    (route, _), = pending.values()
+                    delay = self.hedge_delay(route.backend)
+                done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self.hedged += 1
+                    LLM_HEDGED_TOTAL.inc(backend=routes[attempts].backend.name)
+                    hedge = launch()
+                    continue
+
+                for task in done:
+                    route, started = pending.pop(task)
+                    elapsed = time.monotonic() - started
+                    try:
+                        response = task.result()
+                    except openai.BadRequestError:
+                        # Ошибка в самом запросе повторится на любом бэкенде
+                        LLM_BACKEND_SECONDS.observe(elapsed, backend=route.backend.name, outcome='error')
+                        raise
+                    except Exception as e:
+                        LLM_BACKEND_SECONDS.observe(elapsed, backend=route.backend.name, outcome='error')
+                        route.backend.record_failure()
+                        logging.warning(f"Ошибка бэкенда LLM {route.backend.name}: {type(e).__name__}: {str(e)}")
+                        last_error = e
+                        continue
+                    LLM_BACKEND_SECONDS.observe(elapsed, backend=route.backend.name, outcome='ok')
+                    route.backend.record_success(elapsed)
+                    if task is hedge:
+                        self.hedge_wins += 1
+                    return response
+
+                if not pending and attempts < len(routes):
+                    self.failovers += 1
+                    launch()
+        finally:
+            for task, (route, started) in pending.items():
+                task.cancel()
+                # Отмененный запрос шел дольше победившего: время ожидания - нижняя оценка задержки
+                route.backend.record_latency(time.monotonic() - started)
+        raise last_error
+
+    def batch_route(self, store_id: int) -> Optional[Route]:
+        """Маршрут OpenAI для Batch API, если он доступен магазину; у других провайдеров Batch API нет"""
+        routes = self.store_routes.get(str(store_id))
+        if routes is None:
+            backend = self.backends.get(OPENAI)
+            return Route(backend, backend.model) if backend else None
+        return next((route for route in routes if route.backend.name == OPENAI), None)
+
+    @property
+    def batch_client(self) -> Optional[openai.AsyncOpenAI]:
+        """Клиент OpenAI для проверки отправленных пакетов Batch API"""
+        backend = self.backends.get(OPENAI)
+        return backend.client if backend else None
+
+    async def close(self) -> None:
+        for backend in self.backends.values():
+            await backend.client.close()
+
+    def metrics(self) -> Dict[str, float]:
+        """Задержки и исправность бэкендов, число дублированных и повторных запросов"""
+        metrics = {'hedged': self.hedged, 'hedge_wins': self.hedge_wins, 'failovers': self.failovers}
+        now = time.monotonic()
+        for name, backend in self.backends.items():
+            metrics[f'backend_{name}_healthy'] = int(backend.healthy(now))
+            metrics[f'backend_{name}_errors'] = backend.errors
+            if backend.ewma is not None:
+                metrics[f'backend_{name}_latency_ms'] = round(backend.ewma * 1000)
+                metrics[f'backend_{name}_p95_ms'] = round(backend.p95() * 1000)
+        return metrics
@@ -0,0 +1,100 @@
+"""
+Пакетная генерация ответов: несколько отзывов магазина в одном запросе к LLM.
+
+Отзывы упаковываются в пакеты не больше LLM_BATCH_SIZE штук и LLM_BATCH_MAX_TOKENS
+оценочных токенов (текст отзыва плюс запас на ответ) и отправляются одним
+запросом с промптом магазина (его собирает RequestBuilder из llm_requests).
+Модель возвращает JSON-массив ответов с id отзыва; ответы проверяются,
+а отзывы без корректного ответа генерируются по одному.
+"""
+import json
+import logging
+from typing import Any, Callable, Dict, Iterable, List, Optional, TypeVar
+
+T = TypeVar('T')
+
+# Запас токенов на ответ одного отзыва в бюджете пакета
+ANSWER_TOKENS = 200
+
+BATCH_INSTRUCTION = (
+    "Ответь на каждый отзыв из JSON-массива ниже. "
+    "У отзыва есть id, текст review и оценка valuation (null - не указана). "
+    "Верни только JSON-объект вида {\"answers\": [{\"id\": \"<id отзыва>\", \"answer\": \"<ответ>\"}]} "
+    "с одним ответом на каждый отзыв, без пояснений и разметки."
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов: около трех символов кириллицы на токен"""
+    return len(text) // 3 + 1
+
+
+def pack_batches(items: Iterable[T], max_items: int, max_tokens: int,
+                 text: Callable[[T], str]) -> List[List[T]]:
+    """
+    Разбиение по порядку на пакеты не больше max_items элементов и max_tokens
+    оценочных токенов. Элемент больше бюджета попадает в пакет один
+    """
+    batches: List[List[T]] = []
+    current: List[T] = []
+    current_tokens = 0
+    for item in items:
+        tokens = estimate_tokens(text(item)) + ANSWER_TOKENS
+        if current and (len(current) >= max_items or current_tokens + tokens > max_tokens):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(item)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def batch_payload(reviews: List[Dict[str, Any]]) -> str:
+    """JSON-массив пакета подготовленных отзывов (id, text, valuation) для сообщения пользователя"""
+    return json.dumps([
+        {'id': review['id'], 'review': review['text'], 'valuation': review['valuation']}
+        for review in reviews
+    ], ensure_ascii=False)
+
+
+def _strip_code_fence(content: str) -> str:
+    content = content.strip()
+    if content.startswith("```"):
+        content = content.split('\n', 1)[1] if '\n' in content else ''
+        if content.rstrip().endswith("```"):
+            content = content.rstrip()[:-3]
+    return content.strip()
+
+
+def parse_batch_answers(content: Optional[str], ids: Iterable[str]) -> Dict[str, str]:
+    """
+    Ответы из ответа модели: {id отзыва: текст}. Берутся только непустые строки
+    для отзывов пакета; повторные ответы на один отзыв и лишние id отбрасываются
+    """
+    expected = set(ids)
+    if not content:
+        return {}
+    try:
+        data = json.loads(_strip_code_fence(content))
+    except ValueError as e:
+        logging.warning(f"Ответ на пакет отзывов не является JSON: {str(e)}")
+        return {}
+    if isinstance(data, dict):
+        data = data.get('answers')
+    if not isinstance(data, list):
+        logging.warning("В ответе на пакет отзывов нет массива answers")
+        return {}
+
+    answers: Dict[str, str] = {}
+    for item in data:
+        if not isinstance(item, dict) or item.get('id') is None:
+            continue
+        feedback_id = str(item['id'])
+        answer = item.get('answer')
+        if feedback_id not in expected or feedback_id in answers:
+            continue
+        if not isinstance(answer, str) or not answer.strip():
+            continue
+        answers[feedback_id] = answer.strip()
+    return answers
@@ -0,0 +1,77 @@
+"""
+Запросы к LLM с постоянным префиксом для кэширования промпта у провайдера.
+
+OpenAI и совместимые провайдеры кэшируют совпадающее начало запроса: повторный
+префикс дешевле и обрабатывается быстрее. Поэтому каждый запрос магазина
+начинается с одних и тех же сообщений - промпта магазина и общих примеров
+LLM_FEW_SHOT_EXAMPLES, - а меняющиеся данные (отзыв или пакет отзывов) идут
+последним сообщением. Префикс строится один раз на версию промпта (хэш текста)
+и хранится в LRU, общем для всех магазинов воркера. Модель в запрос добавляет
+маршрутизатор бэкендов (llm_backends).
+"""
+import hashlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from llm_batching import BATCH_INSTRUCTION, batch_payload
+
+# Число версий промпта, префиксы которых хранятся в памяти
+PREFIX_CACHE_SIZE = 1024
+
+Message = Dict[str, str]
+
+
+def prompt_version(prompt: str) -> str:
+    """Версия промпта магазина: хэш текста, меняется при любом изменении промпта"""
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+
+def review_message(review_text: str, product_valuation: Optional[int]) -> str:
+    """Текст сообщения пользователя с одним отзывом"""
+    return f"Отзыв: {review_text}\nОценка: {product_valuation if product_valuation else 'не указана'}"
+
+
+class RequestBuilder:
+    """Сборка запросов chat.completions: общий префикс магазина и данные отзыва в конце"""
+    def __init__(self, config: Dict[str, Any]):
+        # Примеры {"review", "valuation", "answer"} - пары сообщений после промпта
+        self.examples = config["LLM_FEW_SHOT_EXAMPLES"]
+        self._prefixes: 'OrderedDict[str, Tuple[Message, ...]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def prefix(self, prompt: str) -> Tuple[Message, ...]:
+        """Неизменный префикс запросов для версии промпта"""
+        version = prompt_version(prompt)
+        prefix = self._prefixes.get(version)
+        if prefix is not None:
+            self._prefixes.move_to_end(version)
+            self.hits += 1
+            return prefix
+
+        self.misses += 1
+        messages: List[Message] = [{"role": "system", "content": prompt}]
+        for example in self.examples:
+            messages.append({"role": "user", "content": review_message(example['review'], example.get('valuation'))})
+            messages.append({"role": "assistant", "content": example['answer']})
+        prefix = tuple(messages)
+        self._prefixes[version] = prefix
+        if len(self._prefixes) > PREFIX_CACHE_SIZE:
+            self._prefixes.popitem(last=False)
+        return prefix
+
+    def review_request(self, prompt: str, review_text: str, product_valuation: Optional[int]) -> Dict[str, Any]:
+        """Параметры запроса ответа на один отзыв (без модели)"""
+        return {
+            "messages": [*self.prefix(prompt), {"role": "user", "content": review_message(review_text, product_valuation)}]
+        }
+
+    def batch_request(self, prompt: str, reviews: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Параметры запроса ответов на пакет подготовленных отзывов (id, text, valuation), без модели"""
+        return {
+            "messages": [*self.prefix(prompt), {"role": "user", "content": f"{BATCH_INSTRUCTION}\n\n{batch_payload(reviews)}"}],
+            "response_format": {"type": "json_object"}
+        }
+
+    def metrics(self) -> Dict[str, int]:
+        return {'prefix_hits': self.hits, 'prefix_misses': self.misses, 'prefixes': len(self._prefixes)}
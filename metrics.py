@@ -0,0 +1,290 @@
+"""
+Метрики воркера в формате Prometheus (text exposition 0.0.4): счетчики,
+гистограммы и gauge с метками, отдаются локальным HTTP-эндпоинтом /metrics.
+
+Число значений метки store ограничено METRICS_MAX_STORE_LABELS: магазины сверх
+лимита попадают в общее значение "other", чтобы тысячи магазинов не раздували
+число временных рядов.
+"""
+import logging
+import math
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+from aiohttp import web
+
+# Границы гистограмм длительности (секунды): от быстрых запросов к WB до долгих циклов
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+OTHER_STORES = 'other'
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    type_name = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Метрика {self.name} ожидает метки {self.labelnames}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterator[Tuple[str, Sequence[str], LabelValues, float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for name, labelnames, values, value in self.samples():
+            lines.append(f"{name}{_format_labels(labelnames, values)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик"""
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        if amount < 0:
+            raise ValueError("Счетчик не может уменьшаться")
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        for values, value in self._values.items():
+            yield self.name, self.labelnames, values, value
+
+
+class Gauge(_Metric):
+    """Текущее значение (глубина очереди, число запросов в работе)"""
+    type_name = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        for values, value in self._values.items():
+            yield self.name, self.labelnames, values, value
+
+
+class Histogram(_Metric):
+    """Распределение длительностей по накопительным корзинам (le)"""
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # метки -> (число наблюдений по корзинам, сумма)
+        self._values: Dict[LabelValues, Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Замер длительности блока (в том числе с await внутри)"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def count(self, **labels: str) -> int:
+        entry = self._values.get(self._key(labels))
+        return sum(entry[0]) if entry else 0
+
+    def samples(self):
+        bucket_labels = self.labelnames + ('le',)
+        for values, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f"{self.name}_bucket", bucket_labels, values + (_format_value(bound),), cumulative
+            yield f"{self.name}_sum", self.labelnames, values, total
+            yield f"{self.name}_count", self.labelnames, values, cumulative
+
+
+class MetricsRegistry:
+    """Метрики процесса и функции, добавляющие значения в момент опроса"""
+    def __init__(self, max_store_labels: int = 100):
+        self.metrics: Dict[str, _Metric] = {}
+        # Функции, возвращающие {имя: значение} для gauge, собираемых при опросе
+        self.collectors: List[Tuple[str, str, Callable[[], Dict[str, float]]]] = []
+        self.max_store_labels = max_store_labels
+        self._store_labels: Set[str] = set()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, prefix: str, documentation: str, collect: Callable[[], Dict[str, float]]) -> None:
+        """Значения collect() отдаются как gauge {prefix}_{имя} при каждом опросе"""
+        self.collectors.append((prefix, documentation, collect))
+
+    def remove_collector(self, prefix: str) -> None:
+        self.collectors = [collector for collector in self.collectors if collector[0] != prefix]
+
+    def store_label(self, store_id) -> str:
+        """Значение метки store с ограничением числа разных магазинов"""
+        label = str(store_id)
+        if label in self._store_labels:
+            return label
+        if len(self._store_labels) < self.max_store_labels:
+            self._store_labels.add(label)
+            return label
+        return OTHER_STORES
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        for prefix, documentation, collect in self.collectors:
+            try:
+                values = collect()
+            except Exception as e:
+                logging.error(f"Ошибка при сборе метрик {prefix}: {str(e)}")
+                continue
+            for name, value in values.items():
+                if value is None:
+                    continue
+                metric_name = f"{prefix}_{name}"
+                lines.append(f"# HELP {metric_name} {documentation}")
+                lines.append(f"# TYPE {metric_name} gauge")
+                lines.append(f"{metric_name} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+WB_PAGE_SECONDS = REGISTRY.histogram(
+    'wb_bot_fetch_page_seconds', 'Время получения страницы отзывов WB с повторными попытками',
+    ['store', 'outcome']
+)
+WB_SEND_SECONDS = REGISTRY.histogram(
+    'wb_bot_send_response_seconds', 'Время отправки ответа на отзыв в WB с повторными попытками',
+    ['store', 'outcome']
+)
+LLM_SECONDS = REGISTRY.histogram(
+    'wb_bot_generate_seconds', 'Время генерации ответа LLM (без ожидания общего лимита)',
+    ['store', 'outcome']
+)
+RATE_LIMIT_WAIT_SECONDS = REGISTRY.histogram(
+    'wb_bot_rate_limit_wait_seconds', 'Ожидание лимита запросов к WB перед запросом',
+    ['store'], buckets=(0, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+STORE_CYCLE_SECONDS = REGISTRY.histogram(
+    'wb_bot_store_cycle_seconds', 'Длительность цикла обработки отзывов магазина', ['store']
+)
+ALL_STORES_SECONDS = REGISTRY.histogram(
+    'wb_bot_process_all_stores_seconds', 'Длительность обработки всех магазинов (process_all_stores)'
+)
+REVIEWS_TOTAL = REGISTRY.counter(
+    'wb_bot_reviews_total', 'Обработанные отзывы по результату', ['store', 'result']
+)
+HTTP_RESPONSES_TOTAL = REGISTRY.counter(
+    'wb_bot_http_responses_total', 'Ответы WB API по методу и статусу', ['method', 'status']
+)
+QUEUE_DEPTH = REGISTRY.gauge(
+    'wb_bot_pipeline_queue_depth', 'Глубина очередей конвейера магазина', ['store', 'queue']
+)
+LLM_TOKENS_TOTAL = REGISTRY.counter(
+    'wb_bot_llm_tokens_total', 'Токены LLM по магазину: prompt, completion и cached (часть prompt из кэша провайдера)',
+    ['store', 'kind']
+)
+LLM_BACKEND_SECONDS = REGISTRY.histogram(
+    'wb_bot_llm_backend_seconds', 'Время одного запроса к бэкенду LLM', ['backend', 'outcome']
+)
+LLM_HEDGED_TOTAL = REGISTRY.counter(
+    'wb_bot_llm_hedged_total', 'Запросы к LLM, продублированные на другой бэкенд после p95 задержки', ['backend']
+)
+LLM_IN_FLIGHT = REGISTRY.gauge(
+    'wb_bot_llm_in_flight', 'Запросы к LLM в работе'
+)
+
+
+class MetricsServer:
+    """Локальный HTTP-эндпоинт /metrics для Prometheus"""
+    def __init__(self, registry: MetricsRegistry, host: str, port: int):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.registry.render(), content_type='text/plain', charset='utf-8')
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        # При порте 0 система выбирает свободный порт
+        self.port = self._runner.addresses[0][1]
+        logging.info(f"Метрики доступны на http://{self.host}:{self.port}/metrics")
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
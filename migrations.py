@@ -0,0 +1,159 @@
+"""
+Версионные миграции схемы базы данных.
+
+Каждая миграция применяется один раз и записывается в таблицу schema_migrations.
+Миграции только добавляют колонки, индексы и ограничения и проверяют текущее
+состояние схемы перед изменением, поэтому их можно применять к работающей базе
+до перезапуска ботов: старый код новых колонок не использует. В MySQL индексы
+создаются online (ALGORITHM=INPLACE, LOCK=NONE) без блокировки записи.
+
+Новая база создается сразу в актуальной схеме, и все миграции отмечаются примененными.
+"""
+import logging
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from sqlalchemy import Column, DateTime, Integer, String, MetaData, Table, func, inspect, select, text
+from sqlalchemy.engine import Connection, Engine
+
+from database import Base, CycleMetric, CycleMetricRollup, ProcessedReview, Store, StoreStatistics, backfill_store_key_info
+
+_migrations_metadata = MetaData()
+
+schema_migrations = Table(
+    'schema_migrations', _migrations_metadata,
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('name', String(255), nullable=False),
+    Column('applied_at', DateTime, nullable=False)
+)
+
+
+def _add_column(connection: Connection, table: Table, column_name: str) -> None:
+    """Добавление nullable-колонки модели, если ее еще нет"""
+    existing = {column['name'] for column in inspect(connection).get_columns(table.name)}
+    if column_name in existing:
+        return
+    column = table.columns[column_name]
+    column_type = column.type.compile(dialect=connection.dialect)
+    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+    logging.info(f"Добавлена колонка {table.name}.{column.name}")
+
+
+def _create_index(connection: Connection, table: Table, index_name: str) -> None:
+    """
+    Создание индекса модели, если его еще нет. Если уникальный индекс невозможен
+    из-за дубликатов в существующих данных, создается обычный индекс
+    """
+    if index_name in {index['name'] for index in inspect(connection).get_indexes(table.name)}:
+        return
+    index = next(index for index in table.indexes if index.name == index_name)
+    columns = [column.name for column in index.columns]
+    unique = index.unique
+    if unique:
+        duplicates = connection.execute(
+            select(*index.columns).where(*(c.isnot(None) for c in index.columns))
+            .group_by(*index.columns).having(func.count() > 1).limit(5)
+        ).fetchall()
+        if duplicates:
+            logging.error(
+                f"Индекс {index_name} создан неуникальным: в {table.name} есть повторяющиеся "
+                f"значения {', '.join(columns)}, например {[tuple(row) for row in duplicates]}"
+            )
+            unique = False
+
+    statement = f"CREATE {'UNIQUE ' if unique else ''}INDEX {index_name} ON {table.name} ({', '.join(columns)})"
+    if connection.dialect.name == 'mysql':
+        statement += " ALGORITHM=INPLACE LOCK=NONE"
+    connection.execute(text(statement))
+    logging.info(f"Создан индекс {index_name}")
+
+
+def _store_key_metadata(connection: Connection) -> None:
+    """Данные JWT ключа API в таблице магазинов"""
+    stores = Store.__table__
+    for column_name in ('key_expires_at', 'seller_id', 'key_scopes', 'key_expiry_warned_at'):
+        _add_column(connection, stores, column_name)
+    _create_index(connection, stores, 'ix_stores_key_expires_at')
+
+
+def _lookup_indexes(connection: Connection) -> None:
+    """Индексы для поиска магазина по названию, владельцу и ключу API и статистики по магазину"""
+    stores = Store.__table__
+    _add_column(connection, stores, 'wb_api_key_hash')
+    _create_index(connection, stores, 'ix_stores_name')
+    _create_index(connection, stores, 'ix_stores_telegram_user_id')
+
+
+def _backfill_key_hashes(connection: Connection) -> None:
+    """Заполнение хэшей ключей API и данных ключа у существующих магазинов"""
+    # Выполняется отдельной сессией ORM после коммита предыдущих миграций
+    connection.commit()
+    backfill_store_key_info()
+    _create_index(connection, Store.__table__, 'uq_stores_wb_api_key_hash')
+    _create_index(connection, StoreStatistics.__table__, 'uq_store_statistics_store_id')
+
+
+def _store_statistics_cascade(connection: Connection) -> None:
+    """Каскадное удаление статистики вместе с магазином (без него delete_store падает в InnoDB)"""
+    if connection.dialect.name != 'mysql':
+        # SQLite не меняет внешние ключи через ALTER TABLE; каскад выполняет ORM (Store.statistics)
+        return
+    for foreign_key in inspect(connection).get_foreign_keys('store_statistics'):
+        if foreign_key['referred_table'] != 'stores':
+            continue
+        if (foreign_key.get('options') or {}).get('ondelete', '').upper() == 'CASCADE':
+            return
+        connection.execute(text(f"ALTER TABLE store_statistics DROP FOREIGN KEY {foreign_key['name']}"))
+    connection.execute(text(
+        "ALTER TABLE store_statistics ADD CONSTRAINT fk_store_statistics_store_id "
+        "FOREIGN KEY (store_id) REFERENCES stores (id) ON DELETE CASCADE"
+    ))
+    logging.info("Внешний ключ store_statistics.store_id пересоздан с ON DELETE CASCADE")
+
+
+def _cycle_metrics_cached_tokens(connection: Connection) -> None:
+    """Токены из кэша префиксов провайдера в метриках циклов и агрегатах"""
+    _add_column(connection, CycleMetric.__table__, 'cached_tokens')
+    _add_column(connection, CycleMetricRollup.__table__, 'cached_tokens')
+
+
+def _processed_reviews_retention_index(connection: Connection) -> None:
+    """Индекс для очистки журнала отзывов по сроку хранения"""
+    _create_index(connection, ProcessedReview.__table__, 'ix_processed_reviews_status_updated')
+
+
+# (версия, название, функция миграции); новые миграции добавляются в конец
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, 'store_key_metadata', _store_key_metadata),
+    (2, 'lookup_indexes', _lookup_indexes),
+    (3, 'backfill_key_hashes', _backfill_key_hashes),
+    (4, 'store_statistics_cascade', _store_statistics_cascade),
+    (5, 'cycle_metrics_cached_tokens', _cycle_metrics_cached_tokens),
+    (6, 'processed_reviews_retention_index', _processed_reviews_retention_index),
+]
+
+
+def migrate(engine: Engine) -> List[int]:
+    """Создание недостающих таблиц и применение новых миграций. Возвращает примененные версии"""
+    fresh = not inspect(engine).has_table(Store.__tablename__)
+    _migrations_metadata.create_all(bind=engine)
+    # Новые таблицы создаются сразу в актуальной схеме; у существующих create_all ничего не меняет
+    Base.metadata.create_all(bind=engine)
+
+    with engine.connect() as connection:
+        applied = set(connection.execute(select(schema_migrations.c.version)).scalars())
+
+    done = []
+    for version, name, migration in MIGRATIONS:
+        if version in applied:
+            continue
+        with engine.connect() as connection:
+            if not fresh:
+                logging.info(f"Применение миграции {version}: {name}")
+                migration(connection)
+            connection.execute(schema_migrations.insert().values(
+                version=version, name=name, applied_at=datetime.utcnow()
+            ))
+            connection.commit()
+        done.append(version)
+    return done
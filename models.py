@@ -0,0 +1,58 @@
+import json
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+# orjson разбирает ответы API в несколько раз быстрее стандартного json, но не обязателен
+try:
+    import orjson
+
+    def loads(data: bytes) -> Any:
+        """Разбор JSON из байтов ответа"""
+        return orjson.loads(data)
+except ImportError:
+    def loads(data: bytes) -> Any:
+        """Разбор JSON из байтов ответа"""
+        return json.loads(data)
+
+
+def parse_wb_date(value: Optional[str]) -> Optional[datetime]:
+    """Преобразование даты из API Wildberries (ISO 8601) в naive UTC datetime"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        logging.warning(f"Некорректный формат даты отзыва: {value}")
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+@dataclass
+class Review:
+    """
+    Отзыв Wildberries с полями, нужными для ответа. Строится из JSON страницы
+    /feedbacks сразу при разборе, остальные поля (фото, карточка товара и т.д.)
+    в памяти не держатся.
+    """
+    __slots__ = ('id', 'text', 'product_valuation', 'created', 'answered')
+
+    id: str
+    # Первое непустое поле из text, pros, cons, comment
+    text: str
+    product_valuation: Optional[int]
+    created: Optional[datetime]
+    answered: bool
+
+    @classmethod
+    def from_feedback(cls, feedback: Dict[str, Any]) -> 'Review':
+        return cls(
+            id=feedback.get('id') or '',
+            text=feedback.get('text') or feedback.get('pros') or feedback.get('cons') or feedback.get('comment') or '',
+            product_valuation=feedback.get('productValuation'),
+            created=parse_wb_date(feedback.get('createdDate')),
+            answered=bool(feedback.get('answer'))
+        )
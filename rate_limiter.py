@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Any, Mapping, Optional
+
+from api_keys import api_key_hash, introspect_api_key
+
+
+def _header_float(headers: Mapping[str, str], name: str) -> Optional[float]:
+    """Числовое значение заголовка ответа или None"""
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def rate_limit_key(api_key: str) -> str:
+    """
+    Ключ лимита запросов: лимиты WB считаются на продавца, поэтому
+    ключи одного продавца (claim sid) делят общий бакет. Ключ разбирается
+    через кэш introspect_api_key
+    """
+    info = introspect_api_key(api_key)
+    if info is not None and info.seller_id:
+        return f"sid:{info.seller_id}"
+    return "key:" + api_key_hash(api_key)
+
+
+class TokenBucket:
+    """
+    Token bucket для запросов к API Wildberries одного продавца.
+    Скорость адаптируется по принципу AIMD: падает вдвое на 429 и плавно
+    растет обратно до настроенного потолка; заголовки X-Ratelimit-* уточняют
+    остаток и время ожидания.
+    """
+    def __init__(self, rate: float, burst: int, min_rate: float, default_retry_seconds: float):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.default_retry_seconds = default_retry_seconds
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+        # Статистика для подбора лимитов
+        self.throttled = 0
+        self.wait_seconds = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> float:
+        """Ожидание токена на один запрос. Возвращает время ожидания в секундах"""
+        started = time.monotonic()
+        # Ожидающие обслуживаются по очереди, поэтому лимит не превышается пачкой
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if self.blocked_until > now:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    break
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+        waited = time.monotonic() - started
+        self.wait_seconds += waited
+        return waited
+
+    def on_response(self, status: int, headers: Mapping[str, str]) -> None:
+        """Подстройка лимита по ответу API"""
+        now = time.monotonic()
+        self._refill(now)
+
+        limit = _header_float(headers, "X-Ratelimit-Limit")
+        if limit and limit >= 1:
+            self.capacity = limit
+
+        if status == 429:
+            self.throttled += 1
+            retry = _header_float(headers, "X-Ratelimit-Retry")
+            if retry is None:
+                retry = _header_float(headers, "Retry-After")
+            if retry is None:
+                retry = self.default_retry_seconds
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0.0
+            self.blocked_until = max(self.blocked_until, now + retry)
+            logging.warning(f"Превышен лимит запросов WB. Пауза {retry} с, скорость снижена до {self.rate:.2f} запр/с")
+            return
+
+        remaining = _header_float(headers, "X-Ratelimit-Remaining")
+        if remaining is not None:
+            self.tokens = min(self.tokens, remaining)
+        # Аддитивный рост скорости обратно к потолку
+        self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            'rate': self.rate,
+            'tokens': self.tokens,
+            'throttled': self.throttled,
+            'wait_seconds': self.wait_seconds
+        }
+
+
+class RateLimiterRegistry:
+    """Бакеты лимитов запросов к WB, по одному на продавца"""
+    def __init__(self, config: Dict[str, Any]):
+        self.config = config
+        self.buckets: Dict[str, TokenBucket] = {}
+
+    def get(self, api_key: str) -> TokenBucket:
+        key = rate_limit_key(api_key)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(
+                rate=self.config["WB_RATE_LIMIT_PER_SECOND"],
+                burst=self.config["WB_RATE_LIMIT_BURST"],
+                min_rate=self.config["WB_RATE_LIMIT_MIN_PER_SECOND"],
+                default_retry_seconds=self.config["RATE_LIMIT_DELAY_SECONDS"]
+            )
+            self.buckets[key] = bucket
+        return bucket
+
+    def metrics(self) -> Dict[str, float]:
+        """Сводная статистика по всем бакетам"""
+        return {
+            'buckets': len(self.buckets),
+            'throttled': sum(bucket.throttled for bucket in self.buckets.values()),
+            'wait_seconds': sum(bucket.wait_seconds for bucket in self.buckets.values())
+        }
@@ -1,52 +1,232 @@
-import subprocess
-import sys
-import os
-from threading import Thread
+import asyncio
+import json
 import logging
+import os
+import signal
+import socket
+import sys
 import time
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+
+from dotenv import load_dotenv
+
+BASE_DIR = Path(__file__).resolve().parent
+
+
+def load_supervisor_config() -> Dict[str, Any]:
+    """Загрузка настроек супервизора"""
+    load_dotenv()
+    return {
+        "REVIEW_WORKERS": int(os.getenv("REVIEW_WORKERS", "1")),
+        "SUPERVISOR_RESTART_BASE_SECONDS": float(os.getenv("SUPERVISOR_RESTART_BASE_SECONDS", "1")),
+        "SUPERVISOR_RESTART_MAX_SECONDS": float(os.getenv("SUPERVISOR_RESTART_MAX_SECONDS", "60")),
+        "SUPERVISOR_STABLE_SECONDS": float(os.getenv("SUPERVISOR_STABLE_SECONDS", "60")),
+        "SUPERVISOR_DRAIN_SECONDS": float(os.getenv("SUPERVISOR_DRAIN_SECONDS", "60")),
+        "SUPERVISOR_STATUS_SECONDS": float(os.getenv("SUPERVISOR_STATUS_SECONDS", "60")),
+        "SUPERVISOR_STATUS_DIR": os.getenv("SUPERVISOR_STATUS_DIR", "logs"),
+        "METRICS_PORT": int(os.getenv("METRICS_PORT", "0")),
+    }
+
+
+class ChildProcess:
+    """
+    Дочерний процесс под наблюдением супервизора: перезапускается после падения
+    с экспоненциальной задержкой, которая сбрасывается, если процесс проработал
+    дольше SUPERVISOR_STABLE_SECONDS
+    """
+    def __init__(self, name: str, args: List[str], config: Dict[str, Any],
+                 env: Optional[Dict[str, str]] = None, status_file: Optional[str] = None):
+        self.name = name
+        self.args = args
+        self.config = config
+        self.env = env or {}
+        self.status_file = status_file
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.started_at: Optional[float] = None
+        self.restarts = 0
+        self.last_exit_code: Optional[int] = None
+        self.stopping = False
+
+    async def supervise(self) -> None:
+        failures = 0
+        while not self.stopping:
+            logging.info(f"Запуск {self.name}: {' '.join(self.args)}")
+            self.process = await asyncio.create_subprocess_exec(
+                *self.args, cwd=str(BASE_DIR), env={**os.environ, **self.env}
+            )
+            self.started_at = time.monotonic()
+            if self.stopping:
+                # Остановка началась, пока процесс запускался
+                self.send_signal(signal.SIGTERM)
+            self.last_exit_code = await self.process.wait()
+            uptime = time.monotonic() - self.started_at
+            if self.stopping:
+                logging.info(f"{self.name} остановлен (код {self.last_exit_code})")
+                return
+
+            failures = 1 if uptime >= self.config["SUPERVISOR_STABLE_SECONDS"] else failures + 1
+            delay = min(
+                self.config["SUPERVISOR_RESTART_MAX_SECONDS"],
+                self.config["SUPERVISOR_RESTART_BASE_SECONDS"] * 2 ** (failures - 1)
+            )
+            logging.error(
+                f"{self.name} завершился с кодом {self.last_exit_code} через {uptime:.0f} с, "
+                f"перезапуск через {delay:.1f} с"
+            )
+            self.restarts += 1
+            await asyncio.sleep(delay)
+
+    def send_signal(self, sig: int) -> None:
+        if self.process and self.process.returncode is None:
+            self.process.send_signal(sig)
+
+    async def stop(self, timeout: float) -> None:
+        """Плавная остановка: SIGTERM и ожидание, затем SIGKILL"""
+        self.stopping = True
+        if not self.process or self.process.returncode is not None:
+            return
+        self.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"{self.name} не остановился за {timeout:.0f} с, принудительное завершение")
+            self.process.kill()
+            await self.process.wait()
+
+    def status(self) -> Dict[str, Any]:
+        alive = self.process is not None and self.process.returncode is None
+        status = {
+            'name': self.name,
+            'pid': self.process.pid if self.process else None,
+            'alive': alive,
+            'uptime_seconds': round(time.monotonic() - self.started_at) if alive and self.started_at else 0,
+            'restarts': self.restarts,
+            'last_exit_code': self.last_exit_code
+        }
+        if self.status_file:
+            try:
+                with open(self.status_file, encoding='utf-8') as f:
+                    status['worker'] = json.load(f)
+            except (OSError, ValueError):
+                status['worker'] = None
+        return status
+
+
+class Supervisor:
+    """
+    Запуск Telegram бота и REVIEW_WORKERS воркеров обработки отзывов.
+    При нескольких воркерах магазины делятся между ними (SHARDING_ENABLED).
+    SIGTERM/SIGINT пересылаются процессам для плавной остановки; состояние
+    процессов и суммарная пропускная способность периодически пишутся в лог
+    и в SUPERVISOR_STATUS_DIR/supervisor_status.json.
+    """
+    def __init__(self, config: Dict[str, Any], children: Optional[List[ChildProcess]] = None):
+        self.config = config
+        self.status_dir = Path(config["SUPERVISOR_STATUS_DIR"])
+        self.children = children if children is not None else self._default_children()
+        self.stop_event = asyncio.Event()
+        self._last_answered: Optional[int] = None
+        self._last_report: Optional[float] = None
+
+    def _default_children(self) -> List[ChildProcess]:
+        self.status_dir.mkdir(parents=True, exist_ok=True)
+        children = [ChildProcess("telegram_bot", [sys.executable, "telegram_bot.py"], self.config)]
+        workers = self.config["REVIEW_WORKERS"]
+        host = socket.gethostname()
+        for index in range(workers):
+            status_file = str(self.status_dir / f"worker_{index}.json")
+            env = {
+                "WORKER_ID": f"{host}:worker-{index}",
+                "WORKER_STATUS_FILE": status_file,
+                "SHARDING_ENABLED": "true" if workers > 1 else os.getenv("SHARDING_ENABLED", "false")
+            }
+            if self.config["METRICS_PORT"]:
+                # Свой порт /metrics у каждого воркера: METRICS_PORT, METRICS_PORT+1, ...
+                env["METRICS_PORT"] = str(self.config["METRICS_PORT"] + index)
+            children.append(ChildProcess(f"review_worker_{index}", [sys.executable, "wb_bot.py"],
+                                         self.config, env, status_file))
+        return children
+
+    def aggregate_status(self) -> Dict[str, Any]:
+        """Сводное состояние процессов и пропускная способность воркеров"""
+        children = [child.status() for child in self.children]
+        workers = [child['worker'] for child in children if child.get('worker')]
+        totals: Dict[str, int] = {}
+        for worker in workers:
+            for name, value in worker.get('totals', {}).items():
+                totals[name] = totals.get(name, 0) + value
+
+        now = time.monotonic()
+        answered = totals.get('answered', 0)
+        per_minute = None
+        if self._last_answered is not None and now > self._last_report:
+            # Счетчики перезапущенного воркера начинаются с нуля
+            per_minute = max(0, answered - self._last_answered) * 60 / (now - self._last_report)
+        self._last_answered, self._last_report = answered, now
+
+        return {
+            'updated_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'healthy': all(child['alive'] for child in children),
+            'children': children,
+            'totals': totals,
+            'answered_per_minute': round(per_minute, 2) if per_minute is not None else None
+        }
+
+    def report(self) -> None:
+        status = self.aggregate_status()
+        alive = sum(child['alive'] for child in status['children'])
+        logging.info(
+            f"Процессов работает: {alive}/{len(status['children'])}, "
+            f"перезапусков: {sum(child['restarts'] for child in status['children'])}, "
+            f"отзывов: {status['totals'].get('reviews', 0)}, ответов: {status['totals'].get('answered', 0)}, "
+            f"ответов в минуту: {status['answered_per_minute']}"
+        )
+        try:
+            self.status_dir.mkdir(parents=True, exist_ok=True)
+            with open(self.status_dir / "supervisor_status.json", 'w', encoding='utf-8') as f:
+                json.dump(status, f, ensure_ascii=False, indent=2)
+        except OSError as e:
+            logging.error(f"Ошибка при записи состояния супервизора: {str(e)}")
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.stop_event.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        tasks = [asyncio.create_task(child.supervise()) for child in self.children]
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    await asyncio.wait_for(self.stop_event.wait(), timeout=self.config["SUPERVISOR_STATUS_SECONDS"])
+                except asyncio.TimeoutError:
+                    self.report()
+        finally:
+            logging.info("Остановка процессов...")
+            await asyncio.gather(*(child.stop(self.config["SUPERVISOR_DRAIN_SECONDS"]) for child in self.children))
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.report()
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('run_bots.log'),
-        logging.StreamHandler()
-    ]
-)
-
-def run_telegram_bot():
-    try:
-        logging.info("Запуск Telegram бота...")
-        subprocess.run([sys.executable, "tg_bot.py"], check=True)
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Ошибка при запуске Telegram бота: {e}")
-    except Exception as e:
-        logging.error(f"Неожиданная ошибка при запуске Telegram бота: {e}")
-
-def run_wb_bot():
-    try:
-        logging.info("Запуск WB бота...")
-        subprocess.run([sys.executable, "wb_bot.py"], check=True)
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Ошибка при запуске WB бота: {e}")
-    except Exception as e:
-        logging.error(f"Неожиданная ошибка при запуске WB бота: {e}")
 
 if __name__ == "__main__":
-    logging.info("Начало запуска ботов")
-    
-    # Создаем потоки для каждого бота
-    tg_thread = Thread(target=run_telegram_bot)
-    wb_thread = Thread(target=run_wb_bot)
+    # Настройка логирования
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler('run_bots.log'),
+            logging.StreamHandler()
+        ]
+    )
     
-    # Запускаем ботов
-    tg_thread.start()
-    time.sleep(2)  # Даем время первому боту запуститься
-    wb_thread.start()
-    
-    # Ждем завершения обоих ботов
-    tg_thread.join()
-    wb_thread.join()
-    
-    logging.info("Боты завершили работу") 
\ No newline at end of file
+    logging.info("Начало запуска ботов")
+    try:
+        asyncio.run(Supervisor(load_supervisor_config()).run())
+    except KeyboardInterrupt:
+        pass
+    logging.info("Боты завершили работу")
@@ -0,0 +1,164 @@
+import asyncio
+import heapq
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Dict, Any, List, Optional, Set, Tuple
+
+
+class StoreSchedule:
+    """Расписание одного магазина"""
+    __slots__ = ('store', 'interval', 'next_run', 'due', 'task', 'skipped')
+
+    def __init__(self, store: Dict[str, Any], interval: float, next_run: float):
+        self.store = store
+        # Текущий период опроса магазина в секундах
+        self.interval = interval
+        # Плановое время запуска без джиттера: от него отсчитываются следующие запуски
+        self.next_run = next_run
+        # Фактическое время запуска с джиттером
+        self.due = next_run
+        self.task: Optional[asyncio.Task] = None
+        self.skipped = 0
+
+
+class StoreScheduler:
+    """
+    Планировщик опроса магазинов. Каждый магазин запускается по своему расписанию
+    из очереди с приоритетом по времени запуска:
+    - первые запуски равномерно распределены по CHECK_INTERVAL_MINUTES, а каждый
+      запуск смещается на случайную долю SCHEDULER_JITTER периода, поэтому магазины
+      не обращаются к WB и OpenAI одновременно;
+    - период отсчитывается от планового времени, а не от окончания обработки,
+      поэтому длительность обработки не накапливается;
+    - магазин, предыдущая обработка которого еще идет, пропускает запуск;
+    - период растет для магазинов без новых отзывов и сокращается для магазинов,
+      где за запуск приходит SCHEDULER_BUSY_REVIEWS и больше отзывов.
+    """
+    def __init__(self, config: Dict[str, Any],
+                 load_stores: Callable[[], List[Dict[str, Any]]],
+                 run_store: Callable[[Dict[str, Any]], Awaitable[Optional[Dict[str, int]]]],
+                 clock: Callable[[], float] = time.monotonic):
+        self.config = config
+        self.load_stores = load_stores
+        self.run_store = run_store
+        self.clock = clock
+        self.base_interval = config["CHECK_INTERVAL_MINUTES"] * 60
+        self.min_interval = config["SCHEDULER_MIN_INTERVAL_MINUTES"] * 60
+        self.max_interval = config["SCHEDULER_MAX_INTERVAL_MINUTES"] * 60
+        self.schedules: Dict[int, StoreSchedule] = {}
+        self._queue: List[Tuple[float, int]] = []
+        # Все начатые обработки, в том числе магазинов, удаленных из расписания
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _push(self, schedule: StoreSchedule, next_run: float) -> None:
+        now = self.clock()
+        # После долгого простоя не наверстываем пропущенные запуски
+        if next_run < now - schedule.interval:
+            next_run = now
+        schedule.next_run = next_run
+        jitter = self.config["SCHEDULER_JITTER"] * schedule.interval
+        schedule.due = max(now, next_run + random.uniform(-jitter, jitter))
+        heapq.heappush(self._queue, (schedule.due, schedule.store['id']))
+
+    def refresh(self) -> None:
+        """Синхронизация расписания со списком магазинов в базе данных"""
+        stores = {store['id']: store for store in self.load_stores()}
+        now = self.clock()
+        for store_id, store in stores.items():
+            schedule = self.schedules.get(store_id)
+            if schedule:
+                schedule.store = store
+                continue
+            # Новый магазин: первый запуск в случайный момент периода
+            schedule = StoreSchedule(store, self.base_interval, now + random.uniform(0, self.base_interval))
+            self.schedules[store_id] = schedule
+            heapq.heappush(self._queue, (schedule.due, store_id))
+        for store_id in set(self.schedules) - set(stores):
+            logging.info(f"Магазин {self.schedules[store_id].store['name']} удален из расписания")
+            del self.schedules[store_id]
+
+    def adapt_interval(self, schedule: StoreSchedule, stats: Optional[Dict[str, int]]) -> None:
+        """Подстройка периода опроса под поток новых отзывов магазина"""
+        if stats is None:
+            return
+        new_reviews = stats['processed'] - stats['skipped']
+        if new_reviews == 0:
+            schedule.interval = min(self.max_interval, schedule.interval * 1.5)
+        elif new_reviews >= self.config["SCHEDULER_BUSY_REVIEWS"]:
+            schedule.interval = max(self.min_interval, schedule.interval / 2)
+
+    async def _run(self, schedule: StoreSchedule, started_at: float) -> None:
+        interval = schedule.interval
+        try:
+            stats = await self.run_store(schedule.store)
+        except Exception as e:
+            logging.error(f"Ошибка при обработке магазина {schedule.store['name']}: {str(e)}", exc_info=True)
+            stats = None
+        self.adapt_interval(schedule, stats)
+        if schedule.interval != interval and self.schedules.get(schedule.store['id']) is schedule:
+            logging.info(
+                f"Период опроса магазина {schedule.store['name']}: {schedule.interval / 60:.1f} мин"
+            )
+            self._push(schedule, started_at + schedule.interval)
+
+    def start_due(self) -> List[asyncio.Task]:
+        """Запуск магазинов, время которых наступило"""
+        now = self.clock()
+        started = []
+        while self._queue and self._queue[0][0] <= now:
+            due, store_id = heapq.heappop(self._queue)
+            schedule = self.schedules.get(store_id)
+            # Устаревшая запись очереди: магазин удален или перепланирован
+            if schedule is None or schedule.due != due:
+                continue
+            if schedule.task and not schedule.task.done():
+                schedule.skipped += 1
+                logging.warning(
+                    f"Пропуск запуска магазина {schedule.store['name']}: предыдущая обработка еще идет"
+                )
+            else:
+                schedule.task = asyncio.create_task(self._run(schedule, schedule.next_run))
+                self._tasks.add(schedule.task)
+                schedule.task.add_done_callback(self._tasks.discard)
+                started.append(schedule.task)
+            self._push(schedule, schedule.next_run + schedule.interval)
+        return started
+
+    def seconds_until_due(self) -> float:
+        if not self._queue:
+            return self.base_interval
+        return max(0.0, self._queue[0][0] - self.clock())
+
+    async def run(self, stop: Optional[asyncio.Event] = None) -> None:
+        """Основной цикл планировщика до установки события stop"""
+        stop = stop or asyncio.Event()
+        refresh_interval = self.config["SCHEDULER_REFRESH_MINUTES"] * 60
+        next_refresh = self.clock()
+        try:
+            while not stop.is_set():
+                if self.clock() >= next_refresh:
+                    try:
+                        self.refresh()
+                    except Exception as e:
+                        logging.error(f"Ошибка при обновлении списка магазинов: {str(e)}", exc_info=True)
+                    next_refresh = self.clock() + refresh_interval
+                self.start_due()
+                timeout = min(self.seconds_until_due(), max(0.0, next_refresh - self.clock()))
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            # Дожидаемся начатых обработок, чтобы не оставить отзывы захваченными
+            running = [task for task in self._tasks if not task.done()]
+            if running:
+                logging.info(f"Ожидание завершения обработки {len(running)} магазинов")
+                try:
+                    await asyncio.gather(*running, return_exceptions=True)
+                except asyncio.CancelledError:
+                    # Принудительная остановка: отменяем все обработки и ждем их завершения
+                    for task in running:
+                        task.cancel()
+                    await asyncio.gather(*running, return_exceptions=True)
+                    raise
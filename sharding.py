@@ -0,0 +1,80 @@
+import asyncio
+import hashlib
+import logging
+import os
+import socket
+from datetime import timedelta
+from typing import Dict, Any, List, Optional
+
+from database import heartbeat_worker, get_live_workers, remove_worker
+
+
+def default_worker_id() -> str:
+    """Идентификатор воркера по умолчанию: хост и pid процесса"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def shard_owner(store_id: int, workers: List[str]) -> Optional[str]:
+    """
+    Воркер, отвечающий за магазин (rendezvous hashing): при появлении или
+    отключении воркера переезжают только магазины этого воркера
+    """
+    if not workers:
+        return None
+    return max(workers, key=lambda worker: hashlib.sha256(f"{worker}:{store_id}".encode('utf-8')).digest())
+
+
+class ShardMembership:
+    """
+    Участие воркера в распределении магазинов. Воркер регистрируется в таблице
+    worker_heartbeats и обновляет запись каждые WORKER_HEARTBEAT_SECONDS; воркеры
+    без обновления дольше WORKER_LEASE_SECONDS считаются отключенными, и их магазины
+    при следующем обновлении списка достаются оставшимся.
+    Пересечение при переезде магазина безопасно: отзывы захватываются через журнал
+    processed_reviews.
+    """
+    def __init__(self, config: Dict[str, Any], worker_id: Optional[str] = None):
+        self.config = config
+        self.enabled = config["SHARDING_ENABLED"]
+        self.worker_id = worker_id or config["WORKER_ID"] or default_worker_id()
+        self.lease = timedelta(seconds=config["WORKER_LEASE_SECONDS"])
+        self.workers: List[str] = [self.worker_id]
+
+    def heartbeat(self) -> None:
+        if self.enabled:
+            heartbeat_worker(self.worker_id)
+
+    def filter_stores(self, stores: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Магазины, которые обрабатывает этот воркер"""
+        if not self.enabled:
+            return stores
+        workers = get_live_workers(self.lease)
+        # Собственная регистрация могла не успеть обновиться: воркер всегда считает себя живым
+        if self.worker_id not in workers:
+            workers = sorted(workers + [self.worker_id])
+        if workers != self.workers:
+            logging.info(f"Состав воркеров изменился: {', '.join(workers)}")
+            self.workers = workers
+        owned = [store for store in stores if shard_owner(store['id'], workers) == self.worker_id]
+        logging.info(f"Воркер {self.worker_id}: {len(owned)} из {len(stores)} магазинов")
+        return owned
+
+    async def run_heartbeat(self, stop: asyncio.Event) -> None:
+        """Обновление регистрации до установки события stop"""
+        if not self.enabled:
+            return
+        try:
+            while not stop.is_set():
+                try:
+                    self.heartbeat()
+                except Exception as e:
+                    logging.error(f"Ошибка при обновлении регистрации воркера: {str(e)}", exc_info=True)
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=self.config["WORKER_HEARTBEAT_SECONDS"])
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            try:
+                remove_worker(self.worker_id)
+            except Exception as e:
+                logging.error(f"Ошибка при снятии регистрации воркера: {str(e)}", exc_info=True)
@@ -1,29 +1,32 @@
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 import asyncio
-from database import (
+from datetime import datetime, timedelta
+from async_database import (
     add_store, 
     get_store, 
     get_user_stores, 
-    delete_store, 
+    get_user_stores_with_statistics, 
+    get_user_store, 
+    delete_user_store, 
     get_store_by_api_key, 
-    Session, 
-    Store,
-    get_store_statistics,
-    update_store_statistics
+    update_store_prompt, 
+    get_stores_with_expiring_keys, 
+    get_stores_throughput, 
+    mark_key_expiry_warned
 )
 from wb_bot import WBFeedbackBot, check_api_key_expiration
 import os
 from dotenv import load_dotenv
-from sqlalchemy.orm import Session
-from database import Store
-from database import session_scope
 
 # Загрузка конфигурации
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
+# За сколько дней предупреждать владельца об истечении API ключа и как часто проверять ключи
+KEY_EXPIRY_WARNING_DAYS = int(os.getenv("KEY_EXPIRY_WARNING_DAYS", "7"))
+KEY_EXPIRY_CHECK_MINUTES = int(os.getenv("KEY_EXPIRY_CHECK_MINUTES", "60"))
 
 # Состояния для FSM
 class States:
@@ -82,7 +85,7 @@ async def handle_store_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     store_name = update.message.text
     
     # Проверяем, не существует ли уже магазин с таким названием
-    existing_store = get_store(store_name)
+    existing_store = await get_store(store_name)
     if existing_store:
         await update.message.reply_text(
             "❌ Магазин с таким названием уже существует. Пожалуйста, выберите другое название:\n"
@@ -111,7 +114,7 @@ async def handle_wb_api_key(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Проверяем, существует ли магазин с таким API-ключом
-    existing_store = get_store_by_api_key(wb_api_key)
+    existing_store = await get_store_by_api_key(wb_api_key)
     if existing_store:
         await update.message.reply_text(
             "❌ Магазин с таким API-ключом уже существует. Пожалуйста, введите другой ключ:\n"
@@ -136,7 +139,7 @@ async def handle_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     prompt = update.message.text
     
     # Сохраняем магазин в базу данных
-    success = add_store(
+    success = await add_store(
         name=user_data[user_id]['store_name'],
         wb_api_key=user_data[user_id]['wb_api_key'],
         prompt=prompt,
@@ -163,20 +166,19 @@ async def list_stores(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     try:
-        with session_scope() as session:
-            stores = session.query(Store).filter_by(telegram_user_id=user_id).all()
-            
-            if not stores:
-                await update.message.reply_text(
-                    "У вас пока нет добавленных магазинов. Используйте /add_store для добавления."
-                )
-                return
-            
-            message = "📋 Ваши магазины:\n\n"
-            for store in stores:
-                message += f"🏪 {store.name}\n"
-            
-            await update.message.reply_text(message)
+        stores = await get_user_stores(user_id)
+        
+        if not stores:
+            await update.message.reply_text(
+                "У вас пока нет добавленных магазинов. Используйте /add_store для добавления."
+            )
+            return
+        
+        message = "📋 Ваши магазины:\n\n"
+        for store in stores:
+            message += f"🏪 {store.name}\n"
+        
+        await update.message.reply_text(message)
     except Exception as e:
         logging.error(f"Ошибка при получении списка магазинов: {e}")
         await update.message.reply_text(
@@ -187,24 +189,23 @@ async def delete_store_command(update: Update, context: ContextTypes.DEFAULT_TYP
     """Обработчик команды удаления магазина"""
     user_id = update.effective_user.id
     
-    with session_scope() as session:
-        # Получаем список магазинов пользователя
-        stores = session.query(Store).filter(Store.telegram_user_id == user_id).all()
+    # Получаем список магазинов пользователя
+    stores = await get_user_stores(user_id)
+    
+    if not stores:
+        await update.message.reply_text("У вас нет добавленных магазинов.")
+        return
         
-        if not stores:
-            await update.message.reply_text("У вас нет добавленных магазинов.")
-            return
-            
-        # Создаем клавиатуру с кнопками для каждого магазина
-        keyboard = []
-        for store in stores:
-            keyboard.append([InlineKeyboardButton(store.name, callback_data=f"delete_{store.id}")])
-            
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(
-            "Выберите магазин для удаления:",
-            reply_markup=reply_markup
-        )
+    # Создаем клавиатуру с кнопками для каждого магазина
+    keyboard = []
+    for store in stores:
+        keyboard.append([InlineKeyboardButton(store.name, callback_data=f"delete_{store.id}")])
+        
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await update.message.reply_text(
+        "Выберите магазин для удаления:",
+        reply_markup=reply_markup
+    )
 
 async def delete_store_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик нажатия на кнопку удаления магазина"""
@@ -217,48 +218,37 @@ async def delete_store_callback(update: Update, context: ContextTypes.DEFAULT_TY
     store_id = int(query.data.split("_")[1])
     user_id = update.effective_user.id
     
-    with session_scope() as session:
-        # Проверяем существование магазина и права доступа
-        store = session.query(Store).filter(
-            Store.id == store_id,
-            Store.telegram_user_id == user_id
-        ).first()
-        
-        if not store:
-            await query.edit_message_text("Магазин не найден или у вас нет прав для его удаления.")
-            return
-            
-        store_name = store.name
-        session.delete(store)
-        session.commit()
+    # Удаляем магазин с проверкой прав доступа
+    store_name = await delete_user_store(store_id, user_id)
+    
+    if not store_name:
+        await query.edit_message_text("Магазин не найден или у вас нет прав для его удаления.")
+        return
         
-        await query.edit_message_text(f"Магазин '{store_name}' успешно удален.")
+    await query.edit_message_text(f"Магазин '{store_name}' успешно удален.")
 
 async def edit_prompt_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Начало процесса редактирования промпта"""
     user_id = update.effective_user.id
     
     try:
-        with session_scope() as session:
-            stores = session.query(Store).filter_by(telegram_user_id=user_id).all()
-            
-            if not stores:
-                await update.message.reply_text(
-                    "У вас нет магазинов для редактирования."
-                )
-                return
-            
-            keyboard = []
-            for store in stores:
-                # Получаем имя магазина до закрытия сессии
-                store_name = store.name
-                keyboard.append([InlineKeyboardButton(store_name, callback_data=f"edit_{store_name}")])
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
+        stores = await get_user_stores(user_id)
+        
+        if not stores:
             await update.message.reply_text(
-                "Выберите магазин для редактирования промпта:",
-                reply_markup=reply_markup
+                "У вас нет магазинов для редактирования."
             )
+            return
+        
+        keyboard = []
+        for store in stores:
+            keyboard.append([InlineKeyboardButton(store.name, callback_data=f"edit_{store.name}")])
+        
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await update.message.reply_text(
+            "Выберите магазин для редактирования промпта:",
+            reply_markup=reply_markup
+        )
     except Exception as e:
         logging.error(f"Ошибка при получении списка магазинов: {e}")
         await update.message.reply_text(
@@ -274,29 +264,25 @@ async def handle_edit_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     user_id = update.effective_user.id
     
     try:
-        with session_scope() as session:
-            # Получаем магазин
-            store = session.query(Store).filter_by(name=store_name, telegram_user_id=user_id).first()
-            
-            if not store:
-                await query.edit_message_text(
-                    "❌ Магазин не найден или у вас нет прав на его редактирование."
-                )
-                return
-            
-            # Сохраняем имя магазина для последующего редактирования
-            if user_id not in user_data:
-                user_data[user_id] = {}
-            user_data[user_id]['store_name'] = store_name
-            context.user_data['state'] = States.WAITING_FOR_EDIT_PROMPT
-            
-            # Получаем текущий промпт
-            current_prompt = store.prompt
-            
+        # Получаем магазин
+        store = await get_user_store(store_name, user_id)
+        
+        if not store:
             await query.edit_message_text(
-                f"Текущий промпт для магазина {store_name}:\n\n{current_prompt}\n\n"
-                "Введите новый промпт:"
+                "❌ Магазин не найден или у вас нет прав на его редактирование."
             )
+            return
+        
+        # Сохраняем имя магазина для последующего редактирования
+        if user_id not in user_data:
+            user_data[user_id] = {}
+        user_data[user_id]['store_name'] = store_name
+        context.user_data['state'] = States.WAITING_FOR_EDIT_PROMPT
+        
+        await query.edit_message_text(
+            f"Текущий промпт для магазина {store_name}:\n\n{store.prompt}\n\n"
+            "Введите новый промпт:"
+        )
     except Exception as e:
         logging.error(f"Ошибка при получении информации о магазине: {e}")
         await query.edit_message_text(
@@ -319,31 +305,19 @@ async def handle_edit_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE)
     store_name = user_data[user_id]['store_name']
     
     try:
-        with session_scope() as session:
-            # Получаем магазин
-            store = session.query(Store).filter_by(name=store_name, telegram_user_id=user_id).first()
-            
-            if not store:
-                await update.message.reply_text(
-                    "❌ Магазин не найден или у вас нет прав на его редактирование."
-                )
-                del user_data[user_id]
-                context.user_data['state'] = None
-                return
-            
-            # Обновляем промпт
-            store.prompt = new_prompt
-            session.commit()
-            
-            # Проверяем, что изменения сохранились
-            session.refresh(store)
-            if store.prompt != new_prompt:
-                raise Exception("Не удалось сохранить изменения в базу данных")
-            
+        # Обновляем промпт
+        if not await update_store_prompt(store_name, user_id, new_prompt):
             await update.message.reply_text(
-                f"✅ Промпт для магазина {store_name} успешно обновлен!\n\n"
-                f"Новый промпт:\n{new_prompt}"
+                "❌ Магазин не найден или у вас нет прав на его редактирование."
             )
+            del user_data[user_id]
+            context.user_data['state'] = None
+            return
+        
+        await update.message.reply_text(
+            f"✅ Промпт для магазина {store_name} успешно обновлен!\n\n"
+            f"Новый промпт:\n{new_prompt}"
+        )
     except Exception as e:
         logging.error(f"Ошибка при обновлении промпта: {e}")
         await update.message.reply_text(
@@ -353,36 +327,55 @@ async def handle_edit_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE)
     del user_data[user_id]
     context.user_data['state'] = None
 
+def format_throughput(period: dict) -> str:
+    """Строка с суммами метрик циклов за период для /stats"""
+    text = f"отзывов {period['fetched']}, отвечено {period['answered']}, ошибок {period['errors']}"
+    if period['llm_calls']:
+        text += f", ответ ИИ в среднем за {period['llm_latency_ms'] / period['llm_calls'] / 1000:.1f} с"
+    tokens = period['prompt_tokens'] + period['completion_tokens']
+    if tokens:
+        text += f", токенов ИИ {tokens}"
+        if period['cached_tokens']:
+            text += f" (из кэша {period['cached_tokens']})"
+    return text
+
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать статистику по магазинам"""
     user_id = update.effective_user.id
     
     try:
-        with session_scope() as session:
-            stores = session.query(Store).filter_by(telegram_user_id=user_id).all()
-            
-            if not stores:
-                await update.message.reply_text(
-                    "У вас пока нет добавленных магазинов."
-                )
-                return
-            
-            message = "📊 Статистика по магазинам:\n\n"
-            
-            for store in stores:
-                stats = get_store_statistics(store.id)
-                api_key_valid = check_api_key_expiration(store.wb_api_key)
-                
-                message += f"🏪 {store.name}\n"
-                if stats:
-                    message += f"Всего отзывов: {stats.total_reviews}\n"
-                    message += f"Отвечено: {stats.answered_reviews}\n"
-                    message += f"Последняя проверка: {stats.last_check_time.strftime('%Y-%m-%d %H:%M:%S')}\n"
-                else:
-                    message += "Статистика пока недоступна\n"
-                message += f"API ключ: {'✅ Действителен' if api_key_valid else '❌ Недействителен'}\n\n"
+        # Магазины и их статистика загружаются одним запросом
+        stores = await get_user_stores_with_statistics(user_id)
+        
+        if not stores:
+            await update.message.reply_text(
+                "У вас пока нет добавленных магазинов."
+            )
+            return
+        
+        # Динамика за 24 часа и 7 дней из готовых агрегатов, без чтения сырых метрик циклов
+        throughput = await get_stores_throughput([store.id for store in stores])
+        
+        message = "📊 Статистика по магазинам:\n\n"
+        
+        for store in stores:
+            stats = store.statistics
+            api_key_valid = is_key_valid(store)
             
-            await update.message.reply_text(message)
+            message += f"🏪 {store.name}\n"
+            if stats:
+                message += f"Всего отзывов: {stats.total_reviews}\n"
+                message += f"Отвечено: {stats.answered_reviews}\n"
+                message += f"Последняя проверка: {stats.last_check_time.strftime('%Y-%m-%d %H:%M:%S')}\n"
+                for window, title in (('24h', 'За 24 часа'), ('7d', 'За 7 дней')):
+                    period = throughput.get(store.id, {}).get(window)
+                    if period:
+                        message += f"{title}: {format_throughput(period)}\n"
+            else:
+                message += "Статистика пока недоступна\n"
+            message += f"API ключ: {'✅ Действителен' if api_key_valid else '❌ Недействителен'}\n\n"
+        
+        await update.message.reply_text(message)
     except Exception as e:
         logging.error(f"Ошибка при получении статистики: {e}")
         await update.message.reply_text(
@@ -394,29 +387,64 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     try:
-        with session_scope() as session:
-            stores = session.query(Store).filter_by(telegram_user_id=user_id).all()
-            
-            if not stores:
-                await update.message.reply_text(
-                    "У вас пока нет добавленных магазинов."
-                )
-                return
-            
-            message = "🔍 Статус бота и API ключей:\n\n"
-            
-            for store in stores:
-                api_key_valid = check_api_key_expiration(store.wb_api_key)
-                message += f"🏪 {store.name}\n"
-                message += f"API ключ: {'✅ Действителен' if api_key_valid else '❌ Недействителен'}\n\n"
-            
-            await update.message.reply_text(message)
+        stores = await get_user_stores(user_id)
+        
+        if not stores:
+            await update.message.reply_text(
+                "У вас пока нет добавленных магазинов."
+            )
+            return
+        
+        message = "🔍 Статус бота и API ключей:\n\n"
+        
+        for store in stores:
+            message += f"🏪 {store.name}\n"
+            if is_key_valid(store):
+                message += f"API ключ: ✅ Действителен до {store.key_expires_at.strftime('%Y-%m-%d')}\n\n"
+            else:
+                message += "API ключ: ❌ Недействителен\n\n"
+        
+        await update.message.reply_text(message)
     except Exception as e:
         logging.error(f"Ошибка при проверке статуса: {e}")
         await update.message.reply_text(
             "❌ Произошла ошибка при проверке статуса. Пожалуйста, попробуйте позже."
         )
 
+def is_key_valid(store) -> bool:
+    """Проверка ключа API по сохраненному сроку действия, без разбора JWT"""
+    return store.key_expires_at is not None and store.key_expires_at > datetime.utcnow()
+
+async def notify_expiring_keys(bot) -> int:
+    """Предупреждение владельцев об истекающих и истекших API ключах. Возвращает число отправленных"""
+    now = datetime.utcnow()
+    sent = 0
+    for store in await get_stores_with_expiring_keys(now + timedelta(days=KEY_EXPIRY_WARNING_DAYS)):
+        expires = store.key_expires_at.strftime('%Y-%m-%d %H:%M')
+        if store.key_expires_at <= now:
+            text = (f"❌ API ключ магазина {store.name} истек {expires} (UTC). "
+                    "Ответы на отзывы не отправляются, пока магазин не будет добавлен с новым ключом.")
+        else:
+            text = (f"⚠️ API ключ магазина {store.name} истекает {expires} (UTC). "
+                    "Выпустите новый ключ в личном кабинете Wildberries.")
+        try:
+            await bot.send_message(chat_id=int(store.telegram_user_id), text=text)
+        except (TelegramError, ValueError) as e:
+            logging.error(f"Не удалось отправить предупреждение об истечении ключа магазина {store.name}: {e}")
+            continue
+        await mark_key_expiry_warned(store.id)
+        sent += 1
+    return sent
+
+async def key_expiry_notifier(application: Application) -> None:
+    """Периодическая проверка сроков действия API ключей"""
+    while True:
+        try:
+            await notify_expiring_keys(application.bot)
+        except Exception as e:
+            logging.error(f"Ошибка при проверке сроков действия API ключей: {e}")
+        await asyncio.sleep(KEY_EXPIRY_CHECK_MINUTES * 60)
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик всех текстовых сообщений"""
     if 'state' not in context.user_data:
@@ -495,8 +523,15 @@ def main():
     # Установка меню команд
     async def post_init(application: Application) -> None:
         await application.bot.set_my_commands(commands)
+        application.bot_data['key_expiry_task'] = asyncio.create_task(key_expiry_notifier(application))
+    
+    async def post_shutdown(application: Application) -> None:
+        task = application.bot_data.get('key_expiry_task')
+        if task:
+            task.cancel()
     
     application.post_init = post_init
+    application.post_shutdown = post_shutdown
     
     # Запуск бота
     application.run_polling()
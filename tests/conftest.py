@@ -0,0 +1,109 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# database.py создает движок при импорте, поэтому БД для тестов задается до импорта модулей бота
+_db_dir = tempfile.mkdtemp(prefix="wb_bot_tests_")
+os.environ["DATABASE_URL"] = f"sqlite:///{Path(_db_dir) / 'test.db'}"
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pytest
+
+import database
+
+
+@pytest.fixture(autouse=True)
+def clean_db():
+    """Чистая схема базы данных для каждого теста"""
+    database.Base.metadata.drop_all(bind=database.engine)
+    database.init_db()
+    yield
+
+
+@pytest.fixture
+def config():
+    return {
+        "OPENAI_API_KEY": "sk-test",
+        "OPENAI_MODEL": "gpt-3.5-turbo",
+        "DEEPSEEK_API_KEY": "",
+        "DEEPSEEK_BASE_URL": "https://api.deepseek.com",
+        "DEEPSEEK_MODEL": "deepseek-chat",
+        "LOCAL_LLM_BASE_URL": "",
+        "LOCAL_LLM_API_KEY": "",
+        "LOCAL_LLM_MODEL": "local",
+        "LLM_BACKENDS": ["openai"],
+        "LLM_STORE_BACKENDS": {},
+        "LLM_BACKEND_FAILURES": 3,
+        "LLM_BACKEND_COOLDOWN_SECONDS": 30,
+        "LLM_HEDGE_ENABLED": True,
+        "LLM_HEDGE_MIN_SAMPLES": 20,
+        "WB_API_URL": "http://wb.test/api/v1",
+        "REVIEWS_PER_PAGE": 2,
+        "CHECK_INTERVAL_MINUTES": 5,
+        "MAX_RETRIES": 2,
+        "RETRY_DELAY_SECONDS": 0,
+        "MAX_CONCURRENT_REQUESTS": 2,
+        "BATCH_SIZE": 5,
+        "OPENAI_TIMEOUT_SECONDS": 5,
+        "WB_TIMEOUT_SECONDS": 5,
+        "RATE_LIMIT_DELAY_SECONDS": 0,
+        "INCREMENTAL_FETCH": True,
+        "CURSOR_RETRY_HOURS": 24,
+        "FAILED_RETRY_LIMIT": 20,
+        "REVIEW_CLAIM_TIMEOUT_MINUTES": 30,
+        "LLM_MAX_CONCURRENCY": 10,
+        "LLM_STORE_CONCURRENCY": 3,
+        "LLM_STORE_CONCURRENCY_OVERRIDES": {},
+        "HTTP_POOL_LIMIT": 10,
+        "HTTP_POOL_LIMIT_PER_HOST": 5,
+        "HTTP_DNS_CACHE_SECONDS": 10,
+        "HTTP_KEEPALIVE_SECONDS": 10,
+        "WB_RATE_LIMIT_PER_SECOND": 1000,
+        "WB_RATE_LIMIT_BURST": 1000,
+        "WB_RATE_LIMIT_MIN_PER_SECOND": 1,
+        "RETRY_MAX_DELAY_SECONDS": 0,
+        "PREFETCH_PAGES": 2,
+        "ANSWER_CACHE_ENABLED": True,
+        "ANSWER_CACHE_TTL_HOURS": 24,
+        "ANSWER_CACHE_MAX_ENTRIES": 100,
+        "ANSWER_CACHE_MEMORY_ENTRIES": 10,
+        "ANSWER_CACHE_VARIANTS": 2,
+        "ANSWER_CACHE_MAX_TEXT_LENGTH": 100,
+        "SCHEDULER_MIN_INTERVAL_MINUTES": 1,
+        "SCHEDULER_MAX_INTERVAL_MINUTES": 30,
+        "SCHEDULER_JITTER": 0.1,
+        "SCHEDULER_BUSY_REVIEWS": 20,
+        "SCHEDULER_REFRESH_MINUTES": 1,
+        "SHARDING_ENABLED": True,
+        "WORKER_ID": "",
+        "WORKER_HEARTBEAT_SECONDS": 15,
+        "WORKER_LEASE_SECONDS": 60,
+        "WORKER_STATUS_FILE": "",
+        "WRITE_BUFFER_FLUSH_SECONDS": 5,
+        "WRITE_BUFFER_MAX_PENDING": 100,
+        "CYCLE_METRICS_RETENTION_DAYS": 30,
+        "PROCESSED_REVIEWS_RETENTION_DAYS": 90,
+        "METRICS_HOST": "127.0.0.1",
+        "METRICS_PORT": 0,
+        "METRICS_MAX_STORE_LABELS": 100,
+        "LLM_FEW_SHOT_EXAMPLES": [],
+        "LLM_STORE_DAILY_TOKENS": 0,
+        "LLM_STORE_DAILY_TOKENS_OVERRIDES": {},
+        "LLM_BATCH_SIZE": 1,
+        "LLM_BATCH_MAX_TOKENS": 4000,
+        "LLM_BACKLOG_ENABLED": False,
+        "LLM_BACKLOG_MIN_AGE_HOURS": 24,
+        "LLM_BACKLOG_MAX_REQUESTS": 100,
+        "LLM_BACKLOG_CHUNK_SIZE": 100,
+    }
+
+
+@pytest.fixture
+def store():
+    """Магазин в базе данных в виде словаря, как его передает process_all_stores"""
+    database.add_store("shop", "key", "Ты помощник", "42")
+    with database.session_scope() as session:
+        row = session.query(database.Store).filter_by(name="shop").first()
+        return {"id": row.id, "name": row.name, "wb_api_key": row.wb_api_key, "prompt": row.prompt}
@@ -0,0 +1,3 @@
+async def fake_generate(review_text, product_valuation):
+    """Заглушка генерации ответа без обращения к LLM"""
+    return "Спасибо!"
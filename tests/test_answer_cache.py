@@ -0,0 +1,79 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import database
+from answer_cache import AnswerCache, normalize_review_text
+from models import Review
+from wb_bot import WBFeedbackBot
+
+
+class CountingLLM:
+    def __init__(self):
+        self.calls = 0
+
+    async def generate(self, review_text, product_valuation):
+        self.calls += 1
+        return f"Спасибо за отзыв! #{self.calls}"
+
+
+def run_reviews(config, store, reviews):
+    bot = WBFeedbackBot(config, store)
+    llm = CountingLLM()
+    bot.generate_ai_response = llm.generate
+    sent = {}
+
+    async def send_response(feedback_id, text):
+        sent[feedback_id] = text
+        return True
+    bot.send_response = send_response
+
+    stats = {'total': len(reviews), 'processed': 0, 'success': 0, 'errors': 0, 'skipped': 0}
+    asyncio.run(bot.run_pipeline(reviews, stats, []))
+    return bot, llm, sent
+
+
+def test_normalization_ignores_case_punctuation_and_yo():
+    assert normalize_review_text("  Всё ОТЛИЧНО!!! 👍 ") == normalize_review_text("все отлично")
+
+
+def test_rating_only_reviews_are_answered_from_cache(config, store):
+    config["LLM_STORE_CONCURRENCY"] = 1
+    reviews = [Review(f"fb{i}", "", 5, None, False) for i in range(20)]
+    bot, llm, sent = run_reviews(config, store, reviews)
+
+    assert len(sent) == 20
+    assert llm.calls == config["ANSWER_CACHE_VARIANTS"]
+    assert set(sent.values()) == {"Спасибо за отзыв! #1", "Спасибо за отзыв! #2"}
+    assert bot.answer_cache.metrics()["hit_rate"] > 0.5
+
+
+def test_cache_is_persistent_and_keyed_by_rating_and_prompt(config, store):
+    config["ANSWER_CACHE_VARIANTS"] = 1
+    run_reviews(config, store, [Review("fb1", "Всё отлично!", 5, None, False)])
+
+    # Новый процесс: кэш в памяти пуст, ответ берется из базы данных
+    _, llm, _ = run_reviews(config, store, [Review("fb2", "все отлично", 5, None, False)])
+    assert llm.calls == 0
+    _, llm, _ = run_reviews(config, store, [Review("fb3", "все отлично", 4, None, False)])
+    assert llm.calls == 1
+
+    cache = AnswerCache(config)
+    assert asyncio.run(cache.get(cache.key(store["prompt"], "все отлично", 5)))
+    assert asyncio.run(cache.get(cache.key("Другой промпт", "все отлично", 5))) is None
+    assert cache.key(store["prompt"], "длинный отзыв " * 20, 5) is None
+
+
+def test_eviction_by_ttl_and_size(config, store):
+    config["ANSWER_CACHE_MAX_ENTRIES"] = 2
+    cache = AnswerCache(config)
+    for i in range(4):
+        database.save_cached_answers(store["id"], f"key{i}", ["Спасибо!"])
+    with database.session_scope() as session:
+        session.query(database.CachedAnswer).filter_by(cache_key="key0").update(
+            {database.CachedAnswer.created_at: datetime.utcnow() - timedelta(days=2)})
+        session.query(database.CachedAnswer).filter_by(cache_key="key1").update(
+            {database.CachedAnswer.last_used_at: datetime.utcnow() - timedelta(hours=1)})
+    cache.evict()
+    with database.session_scope() as session:
+        keys = {row.cache_key for row in session.query(database.CachedAnswer.cache_key)}
+    assert keys == {"key2", "key3"}
@@ -0,0 +1,97 @@
+import asyncio
+
+from aiohttp import web
+
+from models import Review
+from tests.helpers import fake_generate
+from wb_bot import WBFeedbackBot
+
+
+async def serve_answers(config, answer_handler, answered_ids):
+    """Локальный стенд методов ответа и проверки отзыва"""
+    async def feedback(request):
+        return web.json_response({"data": {"id": request.query["id"],
+                                           "answer": {"text": "ok"} if request.query["id"] in answered_ids else None}})
+
+    app = web.Application()
+    app.router.add_post("/api/v1/feedbacks/answer", answer_handler)
+    app.router.add_get("/api/v1/feedback", feedback)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    config["WB_API_URL"] = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/api/v1"
+    return runner
+
+
+def send_once(config, store, answer_handler, answered_ids):
+    async def scenario():
+        runner = await serve_answers(config, answer_handler, answered_ids)
+        bot = WBFeedbackBot(config, store)
+        try:
+            await bot.init_session()
+            return await bot.send_response("fb1", "Спасибо!")
+        finally:
+            await bot.close_session()
+            await runner.cleanup()
+
+    return asyncio.run(scenario())
+
+
+def test_timeout_is_not_reposted_when_answer_landed(config, store):
+    config["WB_TIMEOUT_SECONDS"] = 0.2
+    posts = []
+    answered_ids = set()
+
+    async def answer(request):
+        posts.append(await request.json())
+        answered_ids.add("fb1")
+        await asyncio.sleep(0.5)
+        return web.Response(status=204)
+
+    assert send_once(config, store, answer, answered_ids)
+    assert len(posts) == 1
+
+
+def test_server_error_is_retried_when_answer_missing(config, store):
+    posts = []
+
+    async def answer(request):
+        posts.append(await request.json())
+        return web.Response(status=502 if len(posts) == 1 else 204)
+
+    assert send_once(config, store, answer, set())
+    assert len(posts) == 2
+
+
+def test_client_error_is_not_retried(config, store):
+    posts = []
+
+    async def answer(request):
+        posts.append(await request.json())
+        return web.Response(status=400)
+
+    assert not send_once(config, store, answer, set())
+    assert len(posts) == 1
+
+
+def test_answers_are_posted_concurrently_up_to_batch_size(config, store):
+    config["BATCH_SIZE"] = 4
+    config["LLM_STORE_CONCURRENCY"] = 8
+    bot = WBFeedbackBot(config, store)
+    bot.generate_ai_response = fake_generate
+    in_flight = {"now": 0, "peak": 0}
+
+    async def send_response(feedback_id, text):
+        in_flight["now"] += 1
+        in_flight["peak"] = max(in_flight["peak"], in_flight["now"])
+        await asyncio.sleep(0.01)
+        in_flight["now"] -= 1
+        return True
+    bot.send_response = send_response
+
+    reviews = [Review(f"fb{i}", "Отлично", None, None, False) for i in range(20)]
+    stats = {'total': 20, 'processed': 0, 'success': 0, 'errors': 0, 'skipped': 0}
+    asyncio.run(bot.run_pipeline(reviews, stats, []))
+    assert in_flight["peak"] == 4
+    assert stats["success"] == 20
@@ -0,0 +1,67 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import jwt
+
+import api_keys
+import async_database
+import database
+import telegram_bot
+from api_keys import introspect_api_key
+from wb_bot import load_active_stores
+
+
+def make_key(days, **claims):
+    return jwt.encode({"exp": int(time.time() + days * 86400), **claims}, "secret")
+
+
+def test_key_is_decoded_once(monkeypatch):
+    decoded = []
+    original = jwt.decode
+
+    def counting_decode(*args, **kwargs):
+        decoded.append(args[0])
+        return original(*args, **kwargs)
+    monkeypatch.setattr(api_keys.jwt, "decode", counting_decode)
+
+    key = make_key(30, sid="seller-1", s=1024)
+    info = introspect_api_key(key)
+    assert introspect_api_key(key) is info
+    assert len(decoded) == 1
+    assert info.seller_id == "seller-1" and info.scopes == 1024 and info.is_valid()
+    assert introspect_api_key("not-a-jwt") is None
+
+
+def test_active_stores_are_selected_by_stored_expiry():
+    database.add_store("valid", make_key(30), "Промпт", "42")
+    database.add_store("expired", make_key(-1), "Промпт", "42")
+    database.add_store("broken", "not-a-jwt", "Промпт", "42")
+    # Магазин, добавленный до появления колонок с данными ключа
+    with database.session_scope() as session:
+        session.add(database.Store(name="legacy", wb_api_key=make_key(30, n=2), prompt="Промпт", telegram_user_id="42"))
+
+    assert sorted(store["name"] for store in load_active_stores()) == ["legacy", "valid"]
+
+
+def test_owner_is_warned_once_before_expiry():
+    database.add_store("soon", make_key(2), "Промпт", "42")
+    database.add_store("later", make_key(60), "Промпт", "42")
+
+    class FakeBot:
+        def __init__(self):
+            self.messages = []
+
+        async def send_message(self, chat_id, text):
+            self.messages.append((chat_id, text))
+
+    bot = FakeBot()
+
+    async def scenario():
+        try:
+            return await telegram_bot.notify_expiring_keys(bot), await telegram_bot.notify_expiring_keys(bot)
+        finally:
+            await async_database.async_engine.dispose()
+
+    assert asyncio.run(scenario()) == (1, 0)
+    assert bot.messages[0][0] == 42 and "soon" in bot.messages[0][1]
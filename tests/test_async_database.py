@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+import async_database as adb
+from async_database import async_database_url
+
+
+def run(coro):
+    async def scenario():
+        try:
+            return await coro
+        finally:
+            # Соединения aiosqlite привязаны к event loop теста
+            await adb.async_engine.dispose()
+    return asyncio.run(scenario())
+
+
+def test_async_driver_is_derived_from_sync_url():
+    assert async_database_url("mysql+pymysql://user:pw@localhost/db") == "mysql+aiomysql://user:pw@localhost/db"
+    assert async_database_url("sqlite:///stores.db") == "sqlite+aiosqlite:///stores.db"
+    with pytest.raises(ValueError):
+        async_database_url("oracle://host/db")
+
+
+def test_store_helpers_round_trip():
+    async def scenario():
+        assert await adb.add_store("shop", "key", "Промпт", 42)
+        assert (await adb.get_store("shop")).prompt == "Промпт"
+        assert (await adb.get_store_by_api_key("key")).name == "shop"
+        assert [s.name for s in await adb.get_user_stores(42)] == ["shop"]
+        assert await adb.get_user_stores(7) == []
+
+        assert await adb.update_store_prompt("shop", 42, "Новый промпт")
+        assert not await adb.update_store_prompt("shop", 7, "Чужой промпт")
+        store = await adb.get_user_store("shop", 42)
+        assert store.prompt == "Новый промпт"
+
+        assert await adb.delete_user_store(store.id, 7) is None
+        assert await adb.delete_user_store(store.id, 42) == "shop"
+        assert await adb.get_store("shop") is None
+
+    run(scenario())
+
+
+def test_statistics_are_loaded_with_stores_in_one_query():
+    from datetime import datetime
+
+    from sqlalchemy import event
+
+    import database
+
+    for i in range(40):
+        database.add_store(f"shop{i}", f"key{i}", "Промпт", "42")
+    with database.session_scope() as session:
+        for store in session.query(database.Store).filter(database.Store.id % 2 == 0):
+            session.add(database.StoreStatistics(store_id=store.id, total_reviews=10, answered_reviews=9,
+                                                 last_check_time=datetime(2025, 1, 1)))
+
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    async def scenario():
+        event.listen(adb.async_engine.sync_engine, "before_cursor_execute", count)
+        try:
+            return await adb.get_user_stores_with_statistics(42)
+        finally:
+            event.remove(adb.async_engine.sync_engine, "before_cursor_execute", count)
+
+    stores = run(scenario())
+    assert len(statements) == 1
+    assert len(stores) == 40
+    assert sum(store.statistics is not None for store in stores) == 20
+    assert all(store.statistics.answered_reviews == 9 for store in stores if store.statistics)
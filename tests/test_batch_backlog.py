@@ -0,0 +1,140 @@
+import asyncio
+import json
+
+from aiohttp import web
+
+import database
+import wb_bot
+from batch_backlog import build_batch_file, parse_batch_output
+from benchmark import FakeServices
+from wb_bot import WBFeedbackBot
+
+
+def review_statuses(store_id):
+    with database.session_scope() as session:
+        return {row.feedback_id: row.status for row in
+                session.query(database.ProcessedReview).filter_by(store_id=store_id)}
+
+
+def run_cycles(monkeypatch, config, store, services, cycles):
+    """Циклы обработки магазина против локальной заглушки WB и OpenAI (Batch API)"""
+    async def scenario():
+        runner = web.AppRunner(services.app())
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        url = f"http://127.0.0.1:{runner.addresses[0][1]}"
+        monkeypatch.setenv("OPENAI_BASE_URL", f"{url}/v1")
+        config["WB_API_URL"] = f"{url}/api/v1"
+        results = []
+        try:
+            for _ in range(cycles):
+                results.append(await WBFeedbackBot(config, store).process_reviews())
+        finally:
+            await runner.cleanup()
+        return results
+
+    return asyncio.run(scenario())
+
+
+def backlog_config(config):
+    config["LLM_BACKLOG_ENABLED"] = True
+    config["REVIEWS_PER_PAGE"] = 10
+    config["ANSWER_CACHE_ENABLED"] = False
+    return config
+
+
+def test_batch_file_and_output_round_trip():
+    data = build_batch_file([("fb1", {"model": "m", "messages": []})])
+    line = json.loads(data.decode("utf-8"))
+    assert line == {"custom_id": "fb1", "method": "POST", "url": "/v1/chat/completions",
+                    "body": {"model": "m", "messages": []}}
+
+    output = "\n".join([
+        json.dumps({"custom_id": "fb1", "response": {"status_code": 200, "body": {
+            "choices": [{"message": {"content": " Спасибо! "}}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 3}}}}),
+        json.dumps({"custom_id": "fb2", "response": {"status_code": 500, "body": {}}}),
+        json.dumps({"custom_id": "fb3", "response": None, "error": {"message": "expired"}}),
+        json.dumps({"custom_id": "fb4", "response": {"status_code": 200, "body": {
+            "choices": [{"message": {"content": ""}}]}}}),
+        "не json",
+    ])
+    results = parse_batch_output(output)
+    assert results.answers == {"fb1": "Спасибо!"}
+    assert (results.prompt_tokens, results.completion_tokens) == (10, 3)
+
+
+def test_old_reviews_go_through_batch_api_and_are_posted_next_cycle(monkeypatch, config, store):
+    services = FakeServices(reviews_per_store=4)
+    first, second = run_cycles(monkeypatch, backlog_config(config), store, services, cycles=2)
+
+    assert first["batched"] == 4 and first["success"] == 0
+    assert services.calls["llm"] == 0 and services.calls["llm_batches"] == 1
+    assert second["success"] == 4
+    assert services.calls["wb_answer"] == 4
+    assert set(review_statuses(store["id"]).values()) == {database.REVIEW_STATUS_ANSWERED}
+    with database.session_scope() as session:
+        batch = session.query(database.LLMBatch).one()
+        assert batch.status == "completed" and batch.finished_at is not None
+        assert session.query(database.LLMBatchReview).count() == 0
+        metrics = session.query(database.CycleMetric).order_by(database.CycleMetric.id).all()
+        assert metrics[-1].completion_tokens == 4 * 15
+
+
+def test_batched_reviews_are_not_claimed_again(monkeypatch, config, store):
+    services = FakeServices(reviews_per_store=3)
+    config = backlog_config(config)
+    config["INCREMENTAL_FETCH"] = False
+
+    async def pending(request):
+        # Пакет еще выполняется: повторно полученные отзывы не генерируются заново
+        return web.json_response(services.batches[request.match_info["batch_id"]])
+    services.get_batch = pending
+    run_cycles(monkeypatch, config, store, services, cycles=2)
+    assert services.calls["llm"] == 0 and services.calls["llm_batches"] == 1
+    assert set(review_statuses(store["id"]).values()) == {database.REVIEW_STATUS_BATCHED}
+
+
+def test_failed_batch_items_are_generated_individually(monkeypatch, config, store):
+    services = FakeServices(reviews_per_store=3)
+    services.batch_error_ids = {"fb0-1"}
+    _, second = run_cycles(monkeypatch, backlog_config(config), store, services, cycles=2)
+
+    assert second["success"] == 3
+    assert services.calls["llm"] == 1
+    assert set(review_statuses(store["id"]).values()) == {database.REVIEW_STATUS_ANSWERED}
+
+
+def test_reviews_are_answered_interactively_when_submission_fails(monkeypatch, config, store):
+    async def broken(*args, **kwargs):
+        raise RuntimeError("Batch API недоступен")
+    monkeypatch.setattr(wb_bot, "submit_batch", broken)
+    services = FakeServices(reviews_per_store=3)
+    (stats,) = run_cycles(monkeypatch, backlog_config(config), store, services, cycles=1)
+
+    assert stats["success"] == 3 and "batched" not in stats
+    assert services.calls["llm"] == 3
+
+
+def test_fresh_reviews_stay_interactive(monkeypatch, config, store):
+    config = backlog_config(config)
+    config["LLM_BACKLOG_MIN_AGE_HOURS"] = 24 * 365 * 100
+    services = FakeServices(reviews_per_store=3)
+    (stats,) = run_cycles(monkeypatch, config, store, services, cycles=1)
+
+    assert stats["success"] == 3
+    assert services.calls["llm_batches"] == 0
+
+
+def test_backlog_is_submitted_in_chunks_while_streaming(monkeypatch, config, store):
+    config = backlog_config(config)
+    config["LLM_BACKLOG_CHUNK_SIZE"] = 2
+    services = FakeServices(reviews_per_store=5)
+    (stats,) = run_cycles(monkeypatch, config, store, services, cycles=1)
+
+    assert stats["batched"] == 5
+    assert services.calls["llm_batches"] == 3
+    with database.session_scope() as session:
+        sizes = sorted(session.query(database.LLMBatchReview).filter_by(llm_batch_id=batch.id).count()
+                       for batch in session.query(database.LLMBatch))
+    assert sizes == [1, 2, 2]
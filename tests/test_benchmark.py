@@ -0,0 +1,40 @@
+import asyncio
+
+from aiohttp import web
+
+from benchmark import FakeServices, percentile, run_scenario
+
+
+def test_percentile_uses_nearest_rank():
+    values = [float(v) for v in range(1, 101)]
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([3.0], 99) == 3
+
+
+def test_scenario_answers_every_review_against_fake_services(monkeypatch):
+    services = FakeServices(reviews_per_store=3, rate_limit_ratio=0.2)
+
+    async def scenario():
+        runner = web.AppRunner(services.app())
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        url = f"http://127.0.0.1:{runner.addresses[0][1]}"
+        monkeypatch.setenv("WB_API_URL", f"{url}/api/v1")
+        monkeypatch.setenv("OPENAI_BASE_URL", f"{url}/v1")
+        monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+        monkeypatch.setenv("REVIEWS_PER_PAGE", "2")
+        monkeypatch.setenv("RETRY_DELAY_SECONDS", "0")
+        monkeypatch.setenv("MAX_RETRIES", "10")
+        monkeypatch.setenv("ANSWER_CACHE_ENABLED", "false")
+        try:
+            return await run_scenario(2, 3, url)
+        finally:
+            await runner.cleanup()
+
+    result = asyncio.run(scenario())
+    assert result["answered"] == 6
+    assert result["http_calls"]["llm"] == 6
+    assert result["stages"]["send_response"]["count"] == 6
+    assert result["stages"]["store_cycle"]["count"] == 2
+    assert result["reviews_per_second"] > 0
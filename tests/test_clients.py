@@ -0,0 +1,56 @@
+import asyncio
+
+from aiohttp import web
+
+from clients import ClientRegistry
+from wb_bot import WBFeedbackBot
+
+
+def test_bots_share_registry_clients_and_do_not_close_them(config, store):
+    async def scenario():
+        clients = ClientRegistry(config)
+        await clients.start()
+        try:
+            first = WBFeedbackBot(config, store, clients)
+            second = WBFeedbackBot(config, store, clients)
+            assert first.session is second.session is clients.http
+            assert first.llm is second.llm is clients.llm
+
+            await first.close_session()
+            assert not clients.http.closed
+        finally:
+            await clients.close()
+        assert clients.http is None and clients.llm is None
+
+    asyncio.run(scenario())
+
+
+def test_pool_metrics_count_reused_connections(config):
+    async def scenario():
+        async def ping(request):
+            return web.json_response({})
+
+        app = web.Application()
+        app.router.add_get("/ping", ping)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        clients = ClientRegistry(config)
+        await clients.start()
+        try:
+            for _ in range(3):
+                async with clients.http.get(f"http://127.0.0.1:{port}/ping") as response:
+                    await response.read()
+            return clients.metrics()
+        finally:
+            await clients.close()
+            await runner.cleanup()
+
+    metrics = asyncio.run(scenario())
+    assert metrics["http_requests"] == 3
+    assert metrics["connections_created"] == 1
+    assert metrics["connections_reused"] == 2
+    assert metrics["pool_idle"] == 1
@@ -0,0 +1,94 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import async_database as adb
+import database
+from database import ROLLUP_DAY, ROLLUP_HOUR, prune_cycle_metrics, save_cycle_metrics
+from models import Review
+from tests.helpers import fake_generate
+from wb_bot import WBFeedbackBot
+
+
+def cycle(store_id, started_at, **metrics):
+    return {'store_id': store_id, 'started_at': started_at, 'finished_at': started_at + timedelta(seconds=5),
+            'fetched': 0, 'answered': 0, 'skipped': 0, 'errors': 0, 'llm_calls': 0, 'llm_latency_ms': 0,
+            'prompt_tokens': 0, 'completion_tokens': 0, **metrics}
+
+
+def rollups(store_id):
+    with database.session_scope() as session:
+        rows = session.query(database.CycleMetricRollup).filter_by(store_id=store_id)
+        return {(row.period, row.bucket_start): (row.cycles, row.fetched, row.llm_latency_ms) for row in rows}
+
+
+def test_rollups_are_maintained_incrementally(store):
+    now = datetime(2025, 3, 10, 14, 30)
+    save_cycle_metrics([
+        cycle(store["id"], now, fetched=3, llm_calls=3, llm_latency_ms=900),
+        cycle(store["id"], now + timedelta(minutes=10), fetched=2, llm_calls=1, llm_latency_ms=100),
+    ])
+    save_cycle_metrics([cycle(store["id"], now + timedelta(hours=1), fetched=1)])
+
+    assert rollups(store["id"]) == {
+        (ROLLUP_HOUR, datetime(2025, 3, 10, 14)): (2, 5, 1000),
+        (ROLLUP_HOUR, datetime(2025, 3, 10, 15)): (1, 1, 0),
+        (ROLLUP_DAY, datetime(2025, 3, 10)): (3, 6, 1000),
+    }
+    with database.session_scope() as session:
+        assert session.query(database.CycleMetric).count() == 3
+
+
+def test_throughput_windows_use_hourly_and_daily_buckets(store):
+    now = datetime(2025, 3, 10, 14, 30)
+    save_cycle_metrics([
+        cycle(store["id"], now, fetched=4, answered=3, llm_calls=2, llm_latency_ms=3000),
+        # Вне 24 часов, но в пределах 7 дней
+        cycle(store["id"], now - timedelta(hours=30), fetched=10, answered=10),
+        # Старше 7 дней
+        cycle(store["id"], now - timedelta(days=8), fetched=100),
+    ])
+
+    async def scenario():
+        try:
+            return await adb.get_stores_throughput([store["id"]], now=now)
+        finally:
+            await adb.async_engine.dispose()
+    throughput = asyncio.run(scenario())[store["id"]]
+
+    assert (throughput['24h']['fetched'], throughput['24h']['answered'], throughput['24h']['cycles']) == (4, 3, 1)
+    assert throughput['24h']['llm_latency_ms'] == 3000
+    assert (throughput['7d']['fetched'], throughput['7d']['cycles']) == (14, 2)
+
+
+def test_prune_keeps_daily_rollups(store):
+    now = datetime.utcnow()
+    save_cycle_metrics([cycle(store["id"], now - timedelta(days=40), fetched=1), cycle(store["id"], now, fetched=1)])
+    assert prune_cycle_metrics(now - timedelta(days=30)) == 2
+
+    with database.session_scope() as session:
+        assert session.query(database.CycleMetric).count() == 1
+    periods = [period for period, _ in rollups(store["id"])]
+    assert periods.count(ROLLUP_DAY) == 2 and periods.count(ROLLUP_HOUR) == 1
+
+
+def test_process_reviews_records_cycle_metrics(config, store):
+    bot = WBFeedbackBot(config, store)
+    bot.generate_ai_response = fake_generate
+
+    async def iter_reviews():
+        for i in range(3):
+            yield Review(id=f"fb{i}", text=f"Отзыв {i}", product_valuation=5, created=None, answered=i == 2)
+
+    async def send_response(feedback_id, text):
+        return True
+
+    bot.iter_reviews = iter_reviews
+    bot.send_response = send_response
+    bot.fetch_complete = True
+    asyncio.run(bot.process_reviews())
+
+    with database.session_scope() as session:
+        metric = session.query(database.CycleMetric).one()
+        assert (metric.fetched, metric.answered, metric.skipped, metric.errors, metric.llm_calls) == (3, 2, 1, 0, 2)
+        assert metric.finished_at >= metric.started_at
+    assert sum(cycles for cycles, _, _ in rollups(store["id"]).values()) == 2
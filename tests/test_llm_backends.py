@@ -0,0 +1,130 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+from llm_backends import LLMRouter
+from wb_bot import WBFeedbackBot
+
+
+class FakeCompletions:
+    """Заглушка chat.completions: задержка ответа и ошибки по порядку вызовов"""
+    def __init__(self, name, delay=0.0, errors=()):
+        self.name = name
+        self.delay = delay
+        self.errors = list(errors)
+        self.models = []
+        self.cancelled = 0
+
+    async def create(self, model, timeout, **request):
+        self.models.append(model)
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.errors:
+            raise self.errors.pop(0)
+        return SimpleNamespace(backend=self.name, model=model)
+
+
+def connection_error():
+    return openai.APIConnectionError(request=httpx.Request("POST", "http://llm.test/v1/chat/completions"))
+
+
+def make_router(config, **delays):
+    config["LLM_BACKENDS"] = ["openai", "deepseek", "local"]
+    config["DEEPSEEK_API_KEY"] = "sk-deepseek"
+    config["LOCAL_LLM_BASE_URL"] = "http://127.0.0.1:8080/v1"
+    router = LLMRouter(config)
+    fakes = {}
+    for name, backend in router.backends.items():
+        fakes[name] = FakeCompletions(name, delays.get(name, 0.0))
+        backend.client = SimpleNamespace(chat=SimpleNamespace(completions=fakes[name]))
+    return router, fakes
+
+
+def create(router, store_id=1):
+    return asyncio.run(router.create(store_id, {"messages": []}, timeout=5))
+
+
+def test_fastest_healthy_backend_is_preferred(config):
+    router, _ = make_router(config)
+    router.backends["openai"].record_success(0.8)
+    router.backends["deepseek"].record_success(0.2)
+    # Бэкенд без замеров пробуется первым
+    assert [route.backend.name for route in router.routes(1)] == ["local", "deepseek", "openai"]
+
+    router.backends["local"].record_success(0.5)
+    for _ in range(config["LLM_BACKEND_FAILURES"]):
+        router.backends["deepseek"].record_failure()
+    assert [route.backend.name for route in router.routes(1)] == ["local", "openai", "deepseek"]
+
+
+def test_failed_request_moves_to_next_backend(config):
+    router, fakes = make_router(config)
+    for name in ("deepseek", "local"):
+        router.backends[name].record_success(1.0)
+    fakes["openai"].errors = [connection_error()]
+
+    response = create(router)
+    assert response.backend in ("deepseek", "local")
+    assert router.backends["openai"].failures == 1 and router.failovers == 1
+
+
+def test_bad_request_is_not_retried_elsewhere(config):
+    router, fakes = make_router(config)
+    request = httpx.Request("POST", "http://llm.test/v1/chat/completions")
+    fakes["openai"].errors = [openai.BadRequestError("too long", response=httpx.Response(400, request=request), body=None)]
+    router.backends["deepseek"].record_success(1.0)
+    router.backends["local"].record_success(1.0)
+
+    with pytest.raises(openai.BadRequestError):
+        create(router)
+    assert router.backends["openai"].failures == 0
+    assert fakes["deepseek"].models == [] and fakes["local"].models == []
+
+
+def test_slow_request_is_hedged_after_p95(config):
+    router, fakes = make_router(config, openai=2.0)
+    for _ in range(config["LLM_HEDGE_MIN_SAMPLES"]):
+        router.backends["openai"].record_success(0.05)
+    router.backends["deepseek"].record_success(0.1)
+    router.backends["local"].record_success(0.2)
+
+    started = time.monotonic()
+    response = create(router)
+    assert response.backend == "deepseek"
+    assert time.monotonic() - started < 1
+    assert (router.hedged, router.hedge_wins) == (1, 1)
+    assert fakes["openai"].cancelled == 1
+    # Отмененный запрос повышает оценку задержки медленного бэкенда
+    assert router.backends["openai"].latencies[-1] >= 0.05
+
+
+def test_store_backends_and_models(config, store):
+    config["LLM_STORE_BACKENDS"] = {str(store["id"]): "local:qwen2.5-7b-instruct"}
+    config["LLM_BACKLOG_ENABLED"] = True
+    router, fakes = make_router(config)
+
+    assert create(router, store["id"]).model == "qwen2.5-7b-instruct"
+    assert create(router, store["id"] + 1).model in ("gpt-3.5-turbo", "deepseek-chat", "local")
+    assert fakes["local"].models[0] == "qwen2.5-7b-instruct"
+    # У локального сервера нет Batch API: старые отзывы магазина отвечаются сразу
+    assert router.batch_route(store["id"]) is None
+    bot = WBFeedbackBot(config, store)
+    bot.llm = router
+    assert bot.backlog_cutoff() is None
+
+
+def test_backend_configuration_errors(config):
+    config["LLM_BACKENDS"] = ["deepseek"]
+    with pytest.raises(ValueError):
+        LLMRouter(config)
+    config["LLM_BACKENDS"] = ["openai"]
+    config["LLM_STORE_BACKENDS"] = {"1": "local"}
+    with pytest.raises(ValueError):
+        LLMRouter(config)
@@ -0,0 +1,129 @@
+import asyncio
+import json
+
+from aiohttp import web
+
+from benchmark import FakeServices, run_scenario
+from llm_batching import ANSWER_TOKENS, pack_batches, parse_batch_answers
+from llm_requests import RequestBuilder
+from models import Review
+from wb_bot import WBFeedbackBot
+
+
+class BatchLLM:
+    """Заглушка LLM: пакетный запрос отвечает на все отзывы, кроме skip_ids"""
+    def __init__(self, skip_ids=()):
+        self.skip_ids = set(skip_ids)
+        self.batches = []
+        self.single_calls = []
+
+    async def generate_batch_response(self, prepared_reviews):
+        self.batches.append([prepared['id'] for prepared in prepared_reviews])
+        return {prepared['id']: f"Пакет: {prepared['text']}"
+                for prepared in prepared_reviews if prepared['id'] not in self.skip_ids}
+
+    async def generate(self, review_text, product_valuation):
+        self.single_calls.append(review_text)
+        return f"Один: {review_text}"
+
+
+def run_reviews(config, store, reviews, llm):
+    bot = WBFeedbackBot(config, store)
+    bot.generate_batch_response = llm.generate_batch_response
+    bot.generate_ai_response = llm.generate
+    sent = {}
+
+    async def send_response(feedback_id, text):
+        sent[feedback_id] = text
+        return True
+    bot.send_response = send_response
+
+    stats = {'total': len(reviews), 'processed': 0, 'success': 0, 'errors': 0, 'skipped': 0}
+    asyncio.run(bot.run_pipeline([Review.from_feedback(r) for r in reviews], stats, []))
+    return bot, stats, sent
+
+
+def test_batches_respect_size_and_token_budget():
+    items = ["а" * 30] * 7
+    assert [len(batch) for batch in pack_batches(items, 3, 10_000, text=str)] == [3, 3, 1]
+
+    budget = 2 * (ANSWER_TOKENS + 11)
+    assert [len(batch) for batch in pack_batches(items, 10, budget, text=str)] == [2, 2, 2, 1]
+    # Отзыв больше бюджета отправляется отдельно, а не теряется
+    assert pack_batches(["а" * 10_000, "б"], 10, budget, text=str) == [["а" * 10_000], ["б"]]
+
+
+def test_batch_request_carries_ids_and_store_prompt(config):
+    messages = RequestBuilder(config).batch_request("Ты помощник", [
+        {'id': 'fb1', 'text': 'Отлично', 'valuation': 5},
+        {'id': 'fb2', 'text': 'Плохо', 'valuation': None},
+    ])["messages"]
+    assert messages[0] == {"role": "system", "content": "Ты помощник"}
+    assert json.loads(messages[-1]["content"].rsplit("\n\n", 1)[-1]) == [
+        {'id': 'fb1', 'review': 'Отлично', 'valuation': 5},
+        {'id': 'fb2', 'review': 'Плохо', 'valuation': None},
+    ]
+
+
+def test_parsing_keeps_only_valid_answers_for_batch_ids():
+    content = "```json\n" + json.dumps({"answers": [
+        {"id": "fb1", "answer": " Спасибо! "},
+        {"id": "fb1", "answer": "Повтор"},
+        {"id": "fb2", "answer": ""},
+        {"id": "fb3", "answer": 42},
+        {"id": "чужой", "answer": "Лишний"},
+        "не объект",
+    ]}, ensure_ascii=False) + "\n```"
+    assert parse_batch_answers(content, ["fb1", "fb2", "fb3"]) == {"fb1": "Спасибо!"}
+    assert parse_batch_answers('[{"id": "fb2", "answer": "Да"}]', ["fb2"]) == {"fb2": "Да"}
+    assert parse_batch_answers("Извините, не могу", ["fb1"]) == {}
+    assert parse_batch_answers('{"result": []}', ["fb1"]) == {}
+    assert parse_batch_answers(None, ["fb1"]) == {}
+
+
+def test_pipeline_answers_in_batches_and_falls_back_per_review(config, store):
+    config["LLM_BATCH_SIZE"] = 5
+    reviews = [{"id": f"fb{i}", "text": f"Отзыв {i}"} for i in range(12)]
+    llm = BatchLLM(skip_ids={"fb3"})
+    bot, stats, sent = run_reviews(config, store, reviews, llm)
+
+    assert stats["success"] == 12 and stats["errors"] == 0
+    assert sorted(len(batch) for batch in llm.batches) == [2, 5, 5]
+    assert llm.single_calls == ["Отзыв 3"]
+    assert sent["fb3"] == "Один: Отзыв 3"
+    assert sent["fb0"] == "Пакет: Отзыв 0"
+    assert bot.llm_usage["llm_calls"] == 4
+
+
+def test_batch_size_one_keeps_per_review_requests(config, store):
+    reviews = [{"id": f"fb{i}", "text": f"Отзыв {i}"} for i in range(4)]
+    llm = BatchLLM()
+    _, stats, _ = run_reviews(config, store, reviews, llm)
+    assert stats["success"] == 4
+    assert llm.batches == []
+    assert len(llm.single_calls) == 4
+
+
+def test_batched_scenario_against_fake_services(monkeypatch):
+    services = FakeServices(reviews_per_store=6)
+
+    async def scenario():
+        runner = web.AppRunner(services.app())
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        url = f"http://127.0.0.1:{runner.addresses[0][1]}"
+        monkeypatch.setenv("WB_API_URL", f"{url}/api/v1")
+        monkeypatch.setenv("OPENAI_BASE_URL", f"{url}/v1")
+        monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+        monkeypatch.setenv("REVIEWS_PER_PAGE", "10")
+        monkeypatch.setenv("ANSWER_CACHE_ENABLED", "false")
+        monkeypatch.setenv("LLM_STORE_CONCURRENCY", "1")
+        monkeypatch.setenv("LLM_BATCH_SIZE", "10")
+        try:
+            return await run_scenario(1, 6, url)
+        finally:
+            await runner.cleanup()
+
+    result = asyncio.run(scenario())
+    assert result["answered"] == 6
+    assert result["http_calls"]["llm"] < 6
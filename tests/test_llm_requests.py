@@ -0,0 +1,99 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+from database import get_review_cursor, save_cycle_metrics
+from models import Review
+from llm_requests import RequestBuilder
+from metrics import LLM_TOKENS_TOTAL
+from wb_bot import WBFeedbackBot
+
+
+def test_prefix_is_memoized_per_prompt_version(config):
+    builder = RequestBuilder(config)
+    first = builder.review_request("Ты помощник", "Отлично", 5)["messages"]
+    second = builder.review_request("Ты помощник", "Плохо", None)["messages"]
+
+    assert first[:-1] == second[:-1] == [{"role": "system", "content": "Ты помощник"}]
+    assert second[-1] == {"role": "user", "content": "Отзыв: Плохо\nОценка: не указана"}
+    assert builder.metrics() == {"prefix_hits": 1, "prefix_misses": 1, "prefixes": 1}
+
+    # Измененный промпт - новая версия префикса
+    builder.review_request("Ты вежливый помощник", "Отлично", 5)
+    assert builder.metrics()["prefix_misses"] == 2
+
+
+def test_few_shot_examples_follow_store_prompt(config):
+    config["LLM_FEW_SHOT_EXAMPLES"] = [{"review": "Пришло быстро", "valuation": 5, "answer": "Спасибо за отзыв!"}]
+    messages = RequestBuilder(config).batch_request("Ты помощник", [
+        {"id": "fb1", "text": "Хорошо", "valuation": 4},
+    ])["messages"]
+
+    assert [m["role"] for m in messages] == ["system", "user", "assistant", "user"]
+    assert messages[1]["content"] == "Отзыв: Пришло быстро\nОценка: 5"
+    assert messages[2]["content"] == "Спасибо за отзыв!"
+
+
+def test_usage_with_cached_tokens_is_counted(config, store):
+    bot = WBFeedbackBot(config, store)
+    before = LLM_TOKENS_TOTAL.value(store=bot.store_label, kind="cached")
+    bot.count_llm_tokens(SimpleNamespace(usage=SimpleNamespace(
+        prompt_tokens=120, completion_tokens=30, prompt_tokens_details=SimpleNamespace(cached_tokens=64)
+    )))
+
+    assert (bot.llm_usage["prompt_tokens"], bot.llm_usage["completion_tokens"], bot.llm_usage["cached_tokens"]) == (120, 30, 64)
+    assert LLM_TOKENS_TOTAL.value(store=bot.store_label, kind="cached") - before == 64
+
+
+def test_store_over_daily_budget_skips_cycle(config, store):
+    now = datetime.utcnow()
+    save_cycle_metrics([{
+        'store_id': store["id"], 'started_at': now, 'finished_at': now, 'fetched': 1, 'answered': 1,
+        'skipped': 0, 'errors': 0, 'llm_calls': 1, 'llm_latency_ms': 100,
+        'prompt_tokens': 400, 'completion_tokens': 200, 'cached_tokens': 0,
+    }])
+    config["LLM_STORE_DAILY_TOKENS"] = 500
+
+    async def iter_reviews():
+        raise AssertionError("отзывы не должны загружаться")
+        yield
+
+    bot = WBFeedbackBot(config, store)
+    bot.iter_reviews = iter_reviews
+    stats = asyncio.run(bot.process_reviews())
+    assert stats["total"] == 0
+
+    # Индивидуальный бюджет магазина важнее общего
+    config["LLM_STORE_DAILY_TOKENS_OVERRIDES"] = {str(store["id"]): 1000}
+    bot = WBFeedbackBot(config, store)
+    bot.load_tokens_today()
+    assert bot.tokens_today == 600 and not bot.budget_exhausted()
+
+
+def test_budget_exhausted_mid_cycle_keeps_cursor(config, store):
+    config["LLM_STORE_DAILY_TOKENS"] = 500
+    config["LLM_STORE_CONCURRENCY"] = 1
+    bot = WBFeedbackBot(config, store)
+
+    async def iter_reviews():
+        # Отзывы старше окна CURSOR_RETRY_HOURS: курсор их не удерживает
+        for i in range(3):
+            yield Review(id=f"fb{i}", text=f"Отзыв {i}", product_valuation=5,
+                         created=datetime(2020, 1, 1, 10, i), answered=False)
+        bot.fetch_complete = True
+
+    async def generate_ai_response(review_text, product_valuation):
+        bot.add_llm_tokens(400, 200, 0)
+        return "Спасибо!"
+
+    async def send_response(feedback_id, text):
+        return True
+
+    bot.iter_reviews = iter_reviews
+    bot.generate_ai_response = generate_ai_response
+    bot.send_response = send_response
+    stats = asyncio.run(bot.process_reviews())
+
+    assert (stats["success"], stats["errors"], bot.budget_deferred) == (1, 2, 2)
+    # Курсор не прошел отложенные отзывы: в следующие сутки они загрузятся снова
+    assert get_review_cursor(store["id"]) is None
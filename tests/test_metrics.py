@@ -0,0 +1,76 @@
+import asyncio
+
+import aiohttp
+
+from metrics import OTHER_STORES, REVIEWS_TOTAL, LLM_SECONDS, MetricsRegistry, MetricsServer
+from models import Review
+from tests.helpers import fake_generate
+from wb_bot import WBFeedbackBot
+
+
+def test_exposition_format():
+    registry = MetricsRegistry()
+    requests = registry.counter('requests_total', 'Запросы', ['status'])
+    latency = registry.histogram('latency_seconds', 'Задержка', ['store'], buckets=(0.1, 1))
+    requests.inc(status='200')
+    requests.inc(2, status='200')
+    latency.observe(0.05, store='a"b')
+    latency.observe(0.5, store='a"b')
+    registry.add_collector('pool', 'Пул', lambda: {'in_use': 3})
+
+    text = registry.render()
+    assert '# TYPE requests_total counter' in text
+    assert 'requests_total{status="200"} 3' in text
+    assert 'latency_seconds_bucket{store="a\\"b",le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{store="a\\"b",le="1"} 2' in text
+    assert 'latency_seconds_bucket{store="a\\"b",le="+Inf"} 2' in text
+    assert 'latency_seconds_count{store="a\\"b"} 2' in text
+    assert 'latency_seconds_sum{store="a\\"b"} 0.55' in text
+    assert 'pool_in_use 3' in text
+
+
+def test_store_labels_are_capped():
+    registry = MetricsRegistry(max_store_labels=2)
+    assert [registry.store_label(i) for i in (1, 2, 3, 1)] == ["1", "2", OTHER_STORES, "1"]
+
+
+def test_metrics_endpoint_serves_registry():
+    registry = MetricsRegistry()
+    registry.counter('up_total', 'Проверка').inc()
+
+    async def scenario():
+        server = MetricsServer(registry, "127.0.0.1", 0)
+        await server.start()
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"http://127.0.0.1:{server.port}/metrics") as response:
+                    return response.status, await response.text()
+        finally:
+            await server.stop()
+
+    status, text = asyncio.run(scenario())
+    assert status == 200
+    assert 'up_total 1' in text
+
+
+def test_pipeline_is_instrumented(config, store):
+    bot = WBFeedbackBot(config, store)
+    bot.generate_ai_response = fake_generate
+
+    async def send_response(feedback_id, text):
+        return True
+    bot.send_response = send_response
+
+    label = bot.store_label
+    answered = REVIEWS_TOTAL.value(store=label, result='answered')
+    skipped = REVIEWS_TOTAL.value(store=label, result='skipped')
+    generated = LLM_SECONDS.count(store=label, outcome='ok')
+
+    reviews = [Review(id="fb1", text="Хорошо", product_valuation=5, created=None, answered=False),
+               Review(id="fb2", text="Отлично", product_valuation=5, created=None, answered=True)]
+    stats = {'total': 0, 'processed': 0, 'success': 0, 'errors': 0, 'skipped': 0}
+    asyncio.run(bot.run_pipeline(reviews, stats, []))
+
+    assert REVIEWS_TOTAL.value(store=label, result='answered') == answered + 1
+    assert REVIEWS_TOTAL.value(store=label, result='skipped') == skipped + 1
+    assert LLM_SECONDS.count(store=label, outcome='ok') == generated + 1
@@ -0,0 +1,45 @@
+import sqlite3
+
+from sqlalchemy import create_engine, inspect
+
+import database
+from migrations import MIGRATIONS, migrate
+
+
+def test_fresh_database_is_stamped_at_head():
+    # conftest уже создал схему через init_db
+    assert migrate(database.engine) == []
+    with database.engine.connect() as connection:
+        versions = [row[0] for row in connection.exec_driver_sql("SELECT version FROM schema_migrations")]
+    assert versions == [version for version, _, _ in MIGRATIONS]
+
+
+def test_legacy_database_is_upgraded_in_place(tmp_path, monkeypatch):
+    path = tmp_path / "legacy.db"
+    connection = sqlite3.connect(path)
+    connection.executescript("""
+        CREATE TABLE stores (id INTEGER PRIMARY KEY, name VARCHAR(255) NOT NULL, wb_api_key VARCHAR(255) NOT NULL,
+                             prompt TEXT NOT NULL, telegram_user_id VARCHAR(255), created_at DATETIME, updated_at DATETIME);
+        CREATE TABLE store_statistics (id INTEGER PRIMARY KEY, store_id INTEGER NOT NULL REFERENCES stores(id),
+                                       total_reviews INTEGER, answered_reviews INTEGER, last_check_time DATETIME,
+                                       created_at DATETIME, updated_at DATETIME);
+        INSERT INTO stores (name, wb_api_key, prompt, telegram_user_id) VALUES ('old', 'legacy-key', 'p', '42');
+        INSERT INTO store_statistics (store_id, total_reviews) VALUES (1, 5);
+    """)
+    connection.commit()
+    connection.close()
+
+    engine = create_engine(f"sqlite:///{path}")
+    # Заполнение хэшей и удаление идут через сессии ORM
+    monkeypatch.setitem(database.SessionLocal.kw, "bind", engine)
+
+    assert migrate(engine) == [1, 2, 3, 4, 5, 6]
+    assert migrate(engine) == []
+
+    indexes = {index["name"] for index in inspect(engine).get_indexes("stores")}
+    assert {"ix_stores_name", "ix_stores_telegram_user_id", "uq_stores_wb_api_key_hash"} <= indexes
+    assert database.get_store_by_api_key("legacy-key") is not None
+    # Статистика удаляется вместе с магазином
+    assert database.delete_store("old", "42")
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("SELECT COUNT(*) FROM store_statistics").scalar() == 0
@@ -0,0 +1,12 @@
+from datetime import datetime
+
+from models import Review, loads
+
+
+def test_review_keeps_only_answer_fields():
+    feedback = loads(b'{"id": "fb1", "text": "", "pros": "\xd0\x9e\xd0\xba", "productValuation": 5,'
+                     b' "createdDate": "2025-01-01T10:00:00.5Z", "answer": null,'
+                     b' "photoLinks": [{"fullSize": "x"}], "productDetails": {"nmId": 1}}')
+    review = Review.from_feedback(feedback)
+    assert review == Review("fb1", "Ок", 5, datetime(2025, 1, 1, 10, 0, 0, 500000), False)
+    assert not hasattr(review, "__dict__")
@@ -0,0 +1,79 @@
+import asyncio
+
+from aiohttp import web
+
+from benchmark import FakeServices
+from wb_bot import WBFeedbackBot
+
+
+def test_streams_and_pages_are_fetched_concurrently(config, store):
+    config["PREFETCH_PAGES"] = 2
+    config["MAX_CONCURRENT_REQUESTS"] = 5
+    calls = []
+    state = {"active": 0, "peak": 0}
+    # 7 неотвеченных отзывов по 2 на странице: 3 полные страницы и короткая
+    unanswered = [{"id": f"u{i}", "text": "ok"} for i in range(7)]
+    answered = [{"id": "a0", "text": "ok", "answer": {"text": "Спасибо"}}]
+
+    async def feedbacks(request):
+        state["active"] += 1
+        state["peak"] = max(state["peak"], state["active"])
+        await asyncio.sleep(0.05)
+        state["active"] -= 1
+        skip, take = int(request.query["skip"]), int(request.query["take"])
+        is_answered = request.query["isAnswered"] == "true"
+        calls.append((is_answered, skip))
+        items = answered if is_answered else unanswered
+        return web.json_response({"data": {"feedbacks": items[skip:skip + take]}})
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get("/api/v1/feedbacks", feedbacks)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        config["WB_API_URL"] = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/api/v1"
+        bot = WBFeedbackBot(config, store)
+        try:
+            reviews = await bot.get_reviews()
+            # Даем отмененным опережающим запросам завершиться на стороне сервера
+            await asyncio.sleep(0.1)
+        finally:
+            await bot.close_session()
+            await runner.cleanup()
+        return reviews, bot.fetch_complete
+
+    reviews, complete = asyncio.run(scenario())
+    assert complete
+    assert sorted(r.id for r in reviews) == sorted([r["id"] for r in unanswered] + ["a0"])
+    # Обе выборки и опережающие страницы идут параллельно
+    assert state["peak"] >= 3
+    # Страница 0 одна, затем окно из 3 страниц; после короткой страницы (skip=6) новых запросов нет
+    unanswered_skips = sorted(skip for is_answered, skip in calls if not is_answered)
+    assert unanswered_skips[:4] == [0, 2, 4, 6]
+    assert max(unanswered_skips) <= 6 + 2 * config["PREFETCH_PAGES"]
+
+
+def test_answers_do_not_shift_unanswered_pages_past_unseen_reviews(monkeypatch, config, store):
+    # Фейковый WB убирает отзыв из списка неотвеченных сразу после ответа
+    services = FakeServices(reviews_per_store=60)
+    config["REVIEWS_PER_PAGE"] = 5
+    config["ANSWER_CACHE_ENABLED"] = False
+
+    async def scenario():
+        runner = web.AppRunner(services.app())
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        url = f"http://127.0.0.1:{runner.addresses[0][1]}"
+        monkeypatch.setenv("OPENAI_BASE_URL", f"{url}/v1")
+        config["WB_API_URL"] = f"{url}/api/v1"
+        try:
+            return await WBFeedbackBot(config, store).process_reviews()
+        finally:
+            await runner.cleanup()
+
+    stats = asyncio.run(scenario())
+    assert stats["success"] == 60 and stats["errors"] == 0
+    assert services.calls["wb_answer"] == 60
+    assert all(review["answer"] for reviews in services.stores.values() for review in reviews)
@@ -0,0 +1,64 @@
+import asyncio
+
+from models import Review
+from wb_bot import WBFeedbackBot
+
+
+class GenerationProbe:
+    """Заглушка LLM, запоминающая максимальное число одновременных генераций"""
+    def __init__(self):
+        self.active = 0
+        self.peak = 0
+
+    async def generate(self, review_text, product_valuation):
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        await asyncio.sleep(0.01)
+        self.active -= 1
+        return f"Ответ: {review_text}"
+
+
+def run_pipeline(config, store, reviews, fail_ids=()):
+    bot = WBFeedbackBot(config, store)
+    probe = GenerationProbe()
+    bot.generate_ai_response = probe.generate
+    sent = []
+
+    async def send_response(feedback_id, text):
+        sent.append(feedback_id)
+        return feedback_id not in fail_ids
+    bot.send_response = send_response
+
+    stats = {'total': len(reviews), 'processed': 0, 'success': 0, 'errors': 0, 'skipped': 0}
+    failed = []
+    asyncio.run(bot.run_pipeline([Review.from_feedback(r) for r in reviews], stats, failed))
+    return probe, stats, failed, sent
+
+
+def test_generation_runs_concurrently_up_to_store_limit(config, store):
+    reviews = [{"id": f"fb{i}", "text": f"Отзыв {i}"} for i in range(12)]
+    probe, stats, failed, sent = run_pipeline(config, store, reviews)
+    assert probe.peak == config["LLM_STORE_CONCURRENCY"]
+    assert stats["success"] == 12 and stats["processed"] == 12
+    assert sorted(sent) == sorted(r["id"] for r in reviews)
+
+
+def test_global_limit_caps_store_concurrency(config, store):
+    config["LLM_MAX_CONCURRENCY"] = 2
+    config["LLM_STORE_CONCURRENCY_OVERRIDES"] = {str(store["id"]): 8}
+    reviews = [{"id": f"fb{i}", "text": f"Отзыв {i}"} for i in range(12)]
+    probe, stats, _, _ = run_pipeline(config, store, reviews)
+    assert probe.peak == 2
+    assert stats["success"] == 12
+
+
+def test_failures_and_skips_are_counted(config, store):
+    reviews = [
+        {"id": "ok", "text": "Отлично"},
+        {"id": "fail", "text": "Плохо"},
+        {"id": "answered", "text": "Норм", "answer": {"text": "Спасибо"}},
+        {"text": "без id"},
+    ]
+    _, stats, failed, _ = run_pipeline(config, store, reviews, fail_ids={"fail"})
+    assert stats == {'total': 4, 'processed': 4, 'success': 1, 'errors': 2, 'skipped': 1}
+    assert {r.id for r in failed} == {"fail", ""}
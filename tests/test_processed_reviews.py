@@ -0,0 +1,100 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import database
+from database import (
+    REVIEW_STATUS_ANSWERED,
+    REVIEW_STATUS_FAILED,
+    REVIEW_STATUS_SKIPPED,
+    claim_review,
+    finish_review,
+    get_processed_review_ids,
+)
+from models import Review
+from tests.helpers import fake_generate
+from wb_bot import WBFeedbackBot, prune_review_ledger
+
+
+def make_bot(config, store, sent):
+    bot = WBFeedbackBot(config, store)
+    bot.generate_ai_response = fake_generate
+
+    async def send_response(feedback_id, text):
+        sent.append(feedback_id)
+        return True
+    bot.send_response = send_response
+    return bot
+
+
+def test_claim_is_exclusive_until_failure(store):
+    timeout = timedelta(minutes=30)
+    assert claim_review(store["id"], "fb1", timeout)
+    assert not claim_review(store["id"], "fb1", timeout)
+
+    finish_review(store["id"], "fb1", REVIEW_STATUS_FAILED)
+    assert claim_review(store["id"], "fb1", timeout)
+
+    finish_review(store["id"], "fb1", REVIEW_STATUS_ANSWERED, "Спасибо!")
+    assert not claim_review(store["id"], "fb1", timeout)
+    assert get_processed_review_ids(store["id"]) == {"fb1"}
+
+
+def test_stale_claim_can_be_taken_over(store):
+    assert claim_review(store["id"], "fb1", timedelta(minutes=30))
+    assert claim_review(store["id"], "fb1", timedelta(seconds=-1))
+
+
+def test_answered_and_known_reviews_are_not_regenerated(config, store):
+    sent = []
+    bot = make_bot(config, store, sent)
+
+    async def scenario():
+        answered = await bot.process_review(Review.from_feedback({"id": "old", "text": "Отлично", "answer": {"text": "Спасибо"}}))
+        first = await bot.process_review(Review.from_feedback({"id": "fb1", "text": "Отлично", "answer": None}))
+        second = await bot.process_review(Review.from_feedback({"id": "fb1", "text": "Отлично", "answer": None}))
+        return answered, first, second
+
+    answered, first, second = asyncio.run(scenario())
+    assert answered["skipped"] and second["skipped"]
+    assert first["response"] == "Спасибо!"
+    assert sent == ["fb1"]
+
+
+def test_ledger_survives_restart(config, store):
+    sent = []
+    asyncio.run(make_bot(config, store, sent).process_review(Review.from_feedback({"id": "fb1", "text": "Отлично"})))
+
+    # Новый процесс: повторный ответ не отправляется благодаря журналу
+    result = asyncio.run(make_bot(config, store, sent).process_review(Review.from_feedback({"id": "fb1", "text": "Отлично"})))
+    assert result["skipped"]
+    assert sent == ["fb1"]
+
+
+def test_known_reviews_are_looked_up_per_page(config, store):
+    finish_review(store["id"], "fb1", REVIEW_STATUS_SKIPPED)
+    finish_review(store["id"], "fb2", REVIEW_STATUS_FAILED)
+    bot = WBFeedbackBot(config, store)
+    page = [Review.from_feedback({"id": f"fb{i}", "text": "Отлично"}) for i in range(1, 4)]
+    asyncio.run(bot.load_processed_ids(page))
+    assert bot.processed_ids == {"fb1"}
+    assert get_processed_review_ids(store["id"], ["fb1", "fb2", "fb9"]) == {"fb1"}
+
+
+def test_old_final_records_are_pruned(config, store):
+    for feedback_id, status in (("old", REVIEW_STATUS_ANSWERED), ("failed", REVIEW_STATUS_FAILED),
+                                ("new", REVIEW_STATUS_SKIPPED)):
+        finish_review(store["id"], feedback_id, status)
+    with database.session_scope() as session:
+        session.query(database.ProcessedReview).filter(database.ProcessedReview.feedback_id != "new").update(
+            {database.ProcessedReview.updated_at: datetime.utcnow() - timedelta(days=100)})
+
+    prune_review_ledger(config)
+    with database.session_scope() as session:
+        assert {row.feedback_id for row in session.query(database.ProcessedReview)} == {"failed", "new"}
+
+
+def test_ledger_is_deleted_with_store_by_database(store):
+    finish_review(store["id"], "fb1", REVIEW_STATUS_ANSWERED, "Спасибо!")
+    assert database.delete_store("shop", "42")
+    with database.session_scope() as session:
+        assert session.query(database.ProcessedReview).count() == 0
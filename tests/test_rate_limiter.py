@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+import jwt
+from aiohttp import web
+
+from wb_bot import WBFeedbackBot
+from rate_limiter import RateLimiterRegistry, TokenBucket, rate_limit_key
+
+
+def test_bucket_paces_requests_after_burst():
+    async def scenario():
+        bucket = TokenBucket(rate=50, burst=2, min_rate=1, default_retry_seconds=1)
+        started = time.monotonic()
+        for _ in range(7):
+            await bucket.acquire()
+        return time.monotonic() - started
+
+    # 2 запроса из burst, еще 5 со скоростью 50 запр/с
+    assert asyncio.run(scenario()) >= 0.09
+
+
+def test_429_halves_rate_and_blocks_until_retry():
+    async def scenario():
+        bucket = TokenBucket(rate=10, burst=5, min_rate=1, default_retry_seconds=1)
+        bucket.on_response(429, {"X-Ratelimit-Retry": "0.1"})
+        assert bucket.rate == 5 and bucket.throttled == 1
+        return await bucket.acquire()
+
+    assert asyncio.run(scenario()) >= 0.1
+
+
+def test_headers_adjust_capacity_and_tokens_and_rate_recovers():
+    bucket = TokenBucket(rate=10, burst=5, min_rate=1, default_retry_seconds=1)
+    bucket.rate = 2
+    bucket.on_response(200, {"X-Ratelimit-Limit": "3", "X-Ratelimit-Remaining": "0"})
+    assert bucket.capacity == 3
+    assert bucket.tokens == 0
+    assert bucket.rate > 2
+
+
+def test_rate_never_drops_below_minimum():
+    bucket = TokenBucket(rate=1, burst=1, min_rate=0.5, default_retry_seconds=0)
+    for _ in range(5):
+        bucket.on_response(429, {})
+    assert bucket.rate == 0.5
+
+
+def test_keys_of_same_seller_share_bucket(config):
+    exp = int(time.time()) + 3600
+    first = jwt.encode({"sid": "seller-1", "n": 1, "exp": exp}, "secret")
+    second = jwt.encode({"sid": "seller-1", "n": 2, "exp": exp}, "secret")
+    other = jwt.encode({"sid": "seller-2", "exp": exp}, "secret")
+    registry = RateLimiterRegistry(config)
+    assert registry.get(first) is registry.get(second)
+    assert registry.get(first) is not registry.get(other)
+    assert rate_limit_key("not-a-jwt").startswith("key:")
+
+
+def test_fetch_and_answer_retry_after_429(config, store):
+    calls = {"get": 0, "post": 0}
+
+    async def feedbacks(request):
+        calls["get"] += 1
+        if calls["get"] == 1:
+            return web.Response(status=429, headers={"X-Ratelimit-Retry": "0"})
+        return web.json_response({"data": {"feedbacks": [{"id": "fb1", "text": "Хорошо"}]}})
+
+    async def answer(request):
+        calls["post"] += 1
+        if calls["post"] == 1:
+            return web.Response(status=429, headers={"X-Ratelimit-Retry": "0"})
+        return web.Response(status=204)
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get("/api/v1/feedbacks", feedbacks)
+        app.router.add_post("/api/v1/feedbacks/answer", answer)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        config["WB_API_URL"] = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/api/v1"
+        bot = WBFeedbackBot(config, store)
+        try:
+            await bot.init_session()
+            reviews, complete = await bot._fetch_reviews(0, 2, is_answered=False)
+            sent = await bot.send_response("fb1", "Спасибо!")
+        finally:
+            await bot.close_session()
+            await runner.cleanup()
+        return reviews, complete, sent, bot.rate_limiter.throttled
+
+    reviews, complete, sent, throttled = asyncio.run(scenario())
+    assert [r.id for r in reviews] == ["fb1"] and complete
+    assert sent
+    assert throttled == 2
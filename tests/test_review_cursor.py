@@ -0,0 +1,204 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from aiohttp import web
+
+from benchmark import FakeServices
+from database import REVIEW_STATUS_FAILED, finish_review, get_failed_review_ids, get_review_cursor, update_review_cursor
+from tests.helpers import fake_generate
+from models import Review, parse_wb_date
+from wb_bot import WBFeedbackBot, is_before_watermark
+
+
+def feedback(feedback_id, created, answer=None, text="Хорошо"):
+    """Отзыв в формате JSON API Wildberries"""
+    return {"id": feedback_id, "createdDate": created, "answer": answer, "text": text, "productValuation": 5}
+
+
+def review(*args, **kwargs):
+    return Review.from_feedback(feedback(*args, **kwargs))
+
+
+def recent(minutes):
+    """Дата отзыва в формате WB на заданное число минут в прошлом"""
+    return (datetime.utcnow() - timedelta(minutes=minutes)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+async def serve_feedbacks(bot, pages, failing_skips=()):
+    """Запуск локального стенда /feedbacks, отдающего неотвеченные отзывы постранично"""
+    async def feedbacks(request):
+        skip = int(request.query["skip"])
+        if skip in failing_skips:
+            return web.Response(status=500)
+        if request.query["isAnswered"] == "true":
+            return web.json_response({"data": {"feedbacks": []}})
+        take = int(request.query["take"])
+        return web.json_response({"data": {"feedbacks": pages[skip:skip + take]}})
+
+    app = web.Application()
+    app.router.add_get("/api/v1/feedbacks", feedbacks)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    bot.config["WB_API_URL"] = f"http://127.0.0.1:{port}/api/v1"
+    return runner
+
+
+def test_parse_wb_date_keeps_microseconds_and_drops_timezone():
+    assert parse_wb_date("2025-01-01T10:44:25.6Z") == datetime(2025, 1, 1, 10, 44, 25, 600000)
+    assert parse_wb_date("2025-01-01T13:00:00+03:00") == datetime(2025, 1, 1, 10, 0, 0)
+    assert parse_wb_date("") is None
+    assert parse_wb_date("not a date") is None
+
+
+def test_tie_timestamp_only_known_ids_are_seen():
+    watermark = (datetime(2025, 1, 1, 10, 0, 0), ["a", "b"])
+    assert is_before_watermark(review("a", "2025-01-01T10:00:00Z"), watermark)
+    assert is_before_watermark(review("b", "2025-01-01T10:00:00Z"), watermark)
+    assert not is_before_watermark(review("c", "2025-01-01T10:00:00Z"), watermark)
+    assert is_before_watermark(review("z", "2025-01-01T09:59:59Z"), watermark)
+    assert not is_before_watermark(review("n", "2025-01-01T10:00:01Z"), watermark)
+
+
+def test_cursor_keeps_all_ids_at_newest_timestamp(config, store):
+    bot = WBFeedbackBot(config, store)
+    bot.save_watermark([review("a", "2025-01-01T10:00:00Z"), review("b", "2025-01-01T10:00:00Z"),
+                        review("old", "2025-01-01T09:00:00Z")], [])
+    assert get_review_cursor(store["id"]) == (datetime(2025, 1, 1, 10, 0, 0), ["a", "b"])
+
+    # Новый отзыв с той же датой дополняет список, а не заменяет его
+    bot.watermark = get_review_cursor(store["id"])
+    bot.save_watermark([review("c", "2025-01-01T10:00:00Z")], [])
+    assert get_review_cursor(store["id"]) == (datetime(2025, 1, 1, 10, 0, 0), ["a", "b", "c"])
+
+
+def test_cursor_rewinds_before_failed_review(config, store):
+    bot = WBFeedbackBot(config, store)
+    failed = review("failed", recent(30))
+    bot.save_watermark([review("new", recent(10)), failed, review("old", recent(50))], [failed])
+
+    last_created, last_ids = get_review_cursor(store["id"])
+    assert last_ids == []
+    assert not is_before_watermark(failed, (last_created, last_ids))
+    assert is_before_watermark(review("old", recent(50)), (last_created, last_ids))
+
+
+def test_stale_failure_does_not_pin_cursor(config, store):
+    bot = WBFeedbackBot(config, store)
+    stale = review("stale", "2020-01-01T00:00:00Z")
+    bot.save_watermark([review("new", "2025-01-01T10:00:00Z"), stale], [stale])
+    assert get_review_cursor(store["id"]) == (datetime(2025, 1, 1, 10, 0, 0), ["new"])
+
+
+def test_stale_failure_behind_cursor_is_retried_by_id(config, store, monkeypatch):
+    services = FakeServices(reviews_per_store=3)
+    reviews = services._store_reviews(SimpleNamespace(headers={"Authorization": f"Bearer {store['wb_api_key']}"}))
+    # Курсор уже прошел все отзывы; fb0-1 и fb0-0 упали в прошлых циклах,
+    # на fb0-0 с тех пор ответили вручную
+    update_review_cursor(store["id"], parse_wb_date(reviews[0]["createdDate"]), [reviews[0]["id"]])
+    finish_review(store["id"], "fb0-1", REVIEW_STATUS_FAILED)
+    finish_review(store["id"], "fb0-0", REVIEW_STATUS_FAILED)
+    reviews[2]["answer"] = {"text": "Спасибо"}
+
+    async def scenario():
+        runner = web.AppRunner(services.app())
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        url = f"http://127.0.0.1:{runner.addresses[0][1]}"
+        monkeypatch.setenv("OPENAI_BASE_URL", f"{url}/v1")
+        config["WB_API_URL"] = f"{url}/api/v1"
+        bot = WBFeedbackBot(config, store)
+        try:
+            return await bot.process_reviews()
+        finally:
+            await runner.cleanup()
+
+    stats = asyncio.run(scenario())
+    assert stats["success"] == 1 and services.calls["wb_answer"] == 1
+    assert reviews[1]["answer"] and not reviews[0]["answer"]
+    assert get_failed_review_ids(store["id"], 10) == []
+
+
+def test_partial_fetch_is_reported(config, store):
+    async def scenario():
+        bot = WBFeedbackBot(config, store)
+        pages = [feedback(f"fb{i}", f"2025-01-01T10:00:0{9 - i}Z") for i in range(5)]
+        runner = await serve_feedbacks(bot, pages, failing_skips={2})
+        try:
+            await bot.init_session()
+            reviews, complete = await bot._fetch_reviews(0, 2, is_answered=False)
+        finally:
+            await bot.close_session()
+            await runner.cleanup()
+        return reviews, complete
+
+    reviews, complete = asyncio.run(scenario())
+    assert [r.id for r in reviews] == ["fb0", "fb1"]
+    assert complete is False
+
+
+def test_fetch_stops_at_cursor(config, store):
+    update_review_cursor(store["id"], datetime(2025, 1, 1, 10, 0, 7), ["fb2"])
+
+    async def scenario():
+        bot = WBFeedbackBot(config, store)
+        pages = [feedback(f"fb{i}", f"2025-01-01T10:00:0{9 - i}Z") for i in range(5)]
+        runner = await serve_feedbacks(bot, pages, failing_skips={4})
+        try:
+            reviews = await bot.get_reviews()
+        finally:
+            await bot.close_session()
+            await runner.cleanup()
+        return reviews, bot.fetch_complete
+
+    reviews, complete = asyncio.run(scenario())
+    assert [r.id for r in reviews] == ["fb0", "fb1"]
+    assert complete is True
+
+
+def test_partial_fetch_keeps_old_cursor(config, store):
+    update_review_cursor(store["id"], datetime(2025, 1, 1, 10, 0, 0), ["fb4"])
+
+    async def scenario():
+        bot = WBFeedbackBot(config, store)
+        bot.generate_ai_response = fake_generate
+
+        async def send_response(feedback_id, text):
+            return True
+        bot.send_response = send_response
+
+        pages = [feedback(f"fb{i}", f"2025-01-01T10:00:0{9 - i}Z") for i in range(5)]
+        runner = await serve_feedbacks(bot, pages, failing_skips={2})
+        try:
+            await bot.process_reviews()
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(scenario())
+    assert get_review_cursor(store["id"]) == (datetime(2025, 1, 1, 10, 0, 0), ["fb4"])
+
+
+def test_skipped_review_does_not_hold_cursor(config, store):
+    async def scenario():
+        bot = WBFeedbackBot(config, store)
+        bot.generate_ai_response = fake_generate
+
+        async def send_response(feedback_id, text):
+            return True
+        bot.send_response = send_response
+
+        empty = feedback("empty", recent(30), text="")
+        empty["productValuation"] = None
+        pages = [feedback("new", recent(10)), empty]
+        runner = await serve_feedbacks(bot, pages)
+        try:
+            await bot.process_reviews()
+        finally:
+            await runner.cleanup()
+        return pages
+
+    pages = asyncio.run(scenario())
+    assert get_review_cursor(store["id"]) == (parse_wb_date(pages[0]["createdDate"]), ["new"])
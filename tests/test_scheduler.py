@@ -0,0 +1,100 @@
+import asyncio
+
+from scheduler import StoreScheduler
+
+
+def make_scheduler(config, stores, run_store=None, clock=None):
+    async def noop(store):
+        return {'processed': 0, 'skipped': 0}
+    return StoreScheduler(config, lambda: stores, run_store or noop, clock=clock or (lambda: 0.0))
+
+
+def test_first_runs_are_spread_over_the_interval(config):
+    stores = [{'id': i, 'name': f"shop{i}"} for i in range(200)]
+    scheduler = make_scheduler(config, stores)
+    scheduler.refresh()
+    dues = sorted(schedule.due for schedule in scheduler.schedules.values())
+    interval = config["CHECK_INTERVAL_MINUTES"] * 60
+    assert 0 <= dues[0] < interval * 0.1 and interval * 0.9 < dues[-1] <= interval
+
+
+def test_fixed_rate_and_skip_while_running(config):
+    config["SCHEDULER_JITTER"] = 0
+    now = [0.0]
+    gate = asyncio.Event()
+    runs = []
+
+    async def run_store(store):
+        runs.append(now[0])
+        await gate.wait()
+        return {'processed': 5, 'skipped': 0}
+
+    async def scenario():
+        scheduler = make_scheduler(config, [{'id': 1, 'name': "shop"}], run_store, clock=lambda: now[0])
+        scheduler.refresh()
+        schedule = scheduler.schedules[1]
+        first = schedule.due
+
+        now[0] = first + 10
+        scheduler.start_due()
+        await asyncio.sleep(0)
+        # Следующий запуск отсчитывается от планового времени, а не от окончания обработки
+        assert schedule.next_run == first + 300
+
+        now[0] = first + 300
+        assert scheduler.start_due() == []
+        assert schedule.skipped == 1
+
+        gate.set()
+        await asyncio.sleep(0)
+        now[0] = first + 600
+        assert len(scheduler.start_due()) == 1
+        await asyncio.sleep(0)
+        return runs
+
+    assert len(asyncio.run(scenario())) == 2
+
+
+def test_interval_adapts_to_review_velocity(config):
+    scheduler = make_scheduler(config, [{'id': 1, 'name': "shop"}])
+    scheduler.refresh()
+    schedule = scheduler.schedules[1]
+
+    for _ in range(10):
+        scheduler.adapt_interval(schedule, {'processed': 3, 'skipped': 3})
+    assert schedule.interval == config["SCHEDULER_MAX_INTERVAL_MINUTES"] * 60
+
+    for _ in range(10):
+        scheduler.adapt_interval(schedule, {'processed': 40, 'skipped': 0})
+    assert schedule.interval == config["SCHEDULER_MIN_INTERVAL_MINUTES"] * 60
+
+    # Ошибка обработки не меняет период
+    scheduler.adapt_interval(schedule, None)
+    assert schedule.interval == config["SCHEDULER_MIN_INTERVAL_MINUTES"] * 60
+
+
+def test_shutdown_waits_for_stores_removed_from_schedule(config):
+    stores = [{'id': 1, 'name': "shop"}]
+    now = [0.0]
+    gate = asyncio.Event()
+
+    async def run_store(store):
+        await gate.wait()
+        return {'processed': 0, 'skipped': 0}
+
+    async def scenario():
+        scheduler = make_scheduler(config, stores, run_store, clock=lambda: now[0])
+        scheduler.refresh()
+        now[0] = scheduler.schedules[1].due
+        (task,) = scheduler.start_due()
+        stores.clear()
+        scheduler.refresh()
+        assert 1 not in scheduler.schedules
+
+        stop = asyncio.Event()
+        stop.set()
+        asyncio.get_running_loop().call_later(0.05, gate.set)
+        await scheduler.run(stop)
+        return task.done()
+
+    assert asyncio.run(scenario())
@@ -0,0 +1,34 @@
+from datetime import datetime, timedelta
+
+import database
+from sharding import ShardMembership, shard_owner
+
+
+def test_rendezvous_hashing_moves_only_stores_of_removed_worker():
+    workers = ["w1", "w2", "w3", "w4"]
+    before = {store_id: shard_owner(store_id, workers) for store_id in range(2000)}
+    counts = [list(before.values()).count(worker) for worker in workers]
+    assert min(counts) > 400
+
+    after = {store_id: shard_owner(store_id, ["w1", "w2", "w4"]) for store_id in range(2000)}
+    moved = {store_id for store_id in before if before[store_id] != after[store_id]}
+    assert moved == {store_id for store_id, owner in before.items() if owner == "w3"}
+
+
+def test_stores_are_split_and_rebalanced_when_worker_dies(config):
+    stores = [{'id': i, 'name': f"shop{i}"} for i in range(100)]
+    first = ShardMembership(config, "w1")
+    second = ShardMembership(config, "w2")
+    first.heartbeat()
+    second.heartbeat()
+
+    owned_first = {s['id'] for s in first.filter_stores(stores)}
+    owned_second = {s['id'] for s in second.filter_stores(stores)}
+    assert owned_first and owned_second
+    assert owned_first | owned_second == set(range(100)) and not owned_first & owned_second
+
+    # Второй воркер перестал обновлять регистрацию
+    with database.session_scope() as session:
+        session.query(database.WorkerHeartbeat).filter_by(worker_id="w2").update(
+            {database.WorkerHeartbeat.heartbeat_at: datetime.utcnow() - timedelta(minutes=5)})
+    assert {s['id'] for s in first.filter_stores(stores)} == set(range(100))
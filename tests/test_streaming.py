@@ -0,0 +1,93 @@
+import asyncio
+
+from aiohttp import web
+
+from tests.helpers import fake_generate
+from wb_bot import WBFeedbackBot
+
+
+def test_first_answer_is_sent_before_later_pages_download(config, store):
+    config["PREFETCH_PAGES"] = 0
+    first_answer_sent = asyncio.Event()
+    order = []
+
+    async def feedbacks(request):
+        skip, take = int(request.query["skip"]), int(request.query["take"])
+        if request.query["isAnswered"] == "true":
+            return web.json_response({"data": {"feedbacks": []}})
+        if skip > 0:
+            # Вторая страница отдается только после первого ответа: без потоковой
+            # обработки цикл бы здесь завис
+            await asyncio.wait_for(first_answer_sent.wait(), timeout=5)
+        order.append(f"page{skip}")
+        items = [{"id": f"fb{i}", "text": "Отлично"} for i in range(3)]
+        return web.json_response({"data": {"feedbacks": items[skip:skip + take]}})
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get("/api/v1/feedbacks", feedbacks)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        config["WB_API_URL"] = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/api/v1"
+
+        bot = WBFeedbackBot(config, store)
+        bot.generate_ai_response = fake_generate
+
+        async def send_response(feedback_id, text):
+            order.append(f"answer:{feedback_id}")
+            first_answer_sent.set()
+            return True
+        bot.send_response = send_response
+
+        try:
+            await asyncio.wait_for(bot.process_reviews(), timeout=10)
+        finally:
+            await runner.cleanup()
+        return bot.fetch_complete
+
+    assert asyncio.run(scenario())
+    # Генерация идет несколькими воркерами, поэтому первым может уйти любой ответ первой страницы
+    first_answer = next(index for index, event in enumerate(order) if event.startswith("answer:"))
+    assert first_answer < order.index("page2")
+    assert {"answer:fb0", "answer:fb1", "answer:fb2"} <= set(order)
+
+
+def test_review_stream_is_closed_when_pipeline_fails(config, store):
+    async def feedbacks(request):
+        skip, take = int(request.query["skip"]), int(request.query["take"])
+        if request.query["isAnswered"] == "true":
+            return web.json_response({"data": {"feedbacks": []}})
+        # Бесконечный список: загрузка останавливается только закрытием потока
+        return web.json_response({"data": {"feedbacks": [
+            {"id": f"fb{skip + i}", "text": "Отлично"} for i in range(take)
+        ]}})
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get("/api/v1/feedbacks", feedbacks)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        config["WB_API_URL"] = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/api/v1"
+
+        bot = WBFeedbackBot(config, store)
+
+        async def run_pipeline(reviews, stats, failed_reviews):
+            async for _ in reviews:
+                raise RuntimeError("сбой конвейера")
+        bot.run_pipeline = run_pipeline
+
+        try:
+            result = await bot.process_reviews()
+            fetchers = [task for task in asyncio.all_tasks()
+                        if task.get_coro().__qualname__.split(".")[-1] in ("pump", "_fetch_page")]
+        finally:
+            await runner.cleanup()
+        return result, fetchers
+
+    result, fetchers = asyncio.run(scenario())
+    assert result is None
+    assert fetchers == []
@@ -0,0 +1,65 @@
+import asyncio
+import json
+import sys
+
+from run_bots import ChildProcess, Supervisor
+
+
+def supervisor_config(tmp_path):
+    return {
+        "REVIEW_WORKERS": 1,
+        "SUPERVISOR_RESTART_BASE_SECONDS": 0.01,
+        "SUPERVISOR_RESTART_MAX_SECONDS": 0.05,
+        "SUPERVISOR_STABLE_SECONDS": 10,
+        "SUPERVISOR_DRAIN_SECONDS": 5,
+        "SUPERVISOR_STATUS_SECONDS": 0.1,
+        "SUPERVISOR_STATUS_DIR": str(tmp_path),
+        "METRICS_PORT": 0,
+    }
+
+
+def test_crashed_child_is_restarted_with_backoff(tmp_path):
+    config = supervisor_config(tmp_path)
+    child = ChildProcess("crash", [sys.executable, "-c", "import sys; sys.exit(3)"], config)
+
+    async def scenario():
+        task = asyncio.create_task(child.supervise())
+        await asyncio.sleep(1)
+        await child.stop(1)
+        await task
+
+    asyncio.run(scenario())
+    assert child.restarts >= 3
+
+
+def test_stop_drains_children_and_aggregates_status(tmp_path):
+    config = supervisor_config(tmp_path)
+    graceful = ("import signal, sys, time\n"
+                "signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))\n"
+                "time.sleep(30)\n")
+    status_files = []
+    children = []
+    for index, answered in enumerate((5, 7)):
+        status_file = tmp_path / f"worker_{index}.json"
+        status_file.write_text(json.dumps({"totals": {"reviews": 10, "answered": answered}}))
+        status_files.append(status_file)
+        children.append(ChildProcess(f"worker_{index}", [sys.executable, "-c", graceful], config,
+                                     status_file=str(status_file)))
+
+    async def scenario():
+        supervisor = Supervisor(config, children)
+        asyncio.get_running_loop().call_later(0.5, supervisor.stop_event.set)
+        await supervisor.run()
+
+    asyncio.run(scenario())
+    assert [child.last_exit_code for child in children] == [0, 0]
+    assert all(child.restarts == 0 for child in children)
+    status = json.loads((tmp_path / "supervisor_status.json").read_text())
+    assert status["totals"] == {"reviews": 20, "answered": 12}
+    assert not status["healthy"]
+
+
+def test_workers_get_separate_metrics_ports(tmp_path):
+    config = {**supervisor_config(tmp_path), "REVIEW_WORKERS": 2, "METRICS_PORT": 9100}
+    workers = Supervisor(config).children[1:]
+    assert [child.env["METRICS_PORT"] for child in workers] == ["9100", "9101"]
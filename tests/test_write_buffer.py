@@ -0,0 +1,97 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import database
+import write_buffer
+from answer_cache import AnswerCache
+from database import REVIEW_STATUS_ANSWERED, REVIEW_STATUS_SKIPPED, claim_review, get_processed_review_ids
+from write_buffer import WriteBehindBuffer
+
+
+def get_statistics(store_id):
+    with database.session_scope() as session:
+        stats = session.query(database.StoreStatistics).filter_by(store_id=store_id).one()
+        return stats.total_reviews, stats.answered_reviews, stats.last_check_time
+
+
+def test_statistics_are_cumulative(config, store):
+    buffer = WriteBehindBuffer(config)
+    first, second = datetime(2024, 1, 1, 10), datetime(2024, 1, 1, 11)
+    buffer.add_statistics(store["id"], 5, 3, second)
+    buffer.add_statistics(store["id"], 2, 1, first)
+    assert buffer.pending() == 1
+    buffer.flush()
+    assert get_statistics(store["id"]) == (7, 4, second)
+
+    buffer.add_statistics(store["id"], 1, 1, second)
+    buffer.flush()
+    assert get_statistics(store["id"]) == (8, 5, second)
+    assert buffer.metrics()["flushes"] == 2
+
+
+def test_review_results_are_upserted(config, store):
+    buffer = WriteBehindBuffer(config)
+    assert claim_review(store["id"], "fb1", timedelta(minutes=30))
+    buffer.add_review_result(store["id"], "fb1", REVIEW_STATUS_ANSWERED, "Спасибо!")
+    buffer.add_review_result(store["id"], "fb2", REVIEW_STATUS_SKIPPED)
+    assert get_processed_review_ids(store["id"]) == set()
+
+    buffer.flush()
+    assert get_processed_review_ids(store["id"]) == {"fb1", "fb2"}
+    with database.session_scope() as session:
+        record = session.query(database.ProcessedReview).filter_by(feedback_id="fb1").one()
+        assert record.answer_hash is not None
+
+
+def test_cache_hits_are_counted_in_one_write(config, store):
+    buffer = WriteBehindBuffer(config)
+    cache = AnswerCache(config, buffer)
+    database.save_cached_answers(store["id"], "key", ["Спасибо!", "Благодарим!"])
+
+    async def lookups():
+        return [await cache.get("key") for _ in range(3)]
+
+    assert all(asyncio.run(lookups()))
+    assert buffer.pending() == 1
+    buffer.flush()
+    with database.session_scope() as session:
+        assert session.query(database.CachedAnswer).filter_by(cache_key="key").one().hits == 3
+
+
+def test_failed_flush_keeps_records(config, store, monkeypatch):
+    buffer = WriteBehindBuffer(config)
+    buffer.add_statistics(store["id"], 1, 1, datetime.now())
+    buffer.add_review_result(store["id"], "fb1", REVIEW_STATUS_SKIPPED)
+
+    def broken(*args):
+        raise RuntimeError("database is down")
+    monkeypatch.setattr(write_buffer, "finish_reviews", broken)
+    buffer.flush()
+    assert buffer.pending() == 2
+    assert buffer.metrics()["flush_errors"] == 1
+
+    monkeypatch.undo()
+    buffer.flush()
+    assert buffer.pending() == 0
+    assert get_processed_review_ids(store["id"]) == {"fb1"}
+
+
+def test_background_flush_and_flush_on_close(config, store):
+    config = {**config, "WRITE_BUFFER_FLUSH_SECONDS": 0.01}
+
+    async def scenario():
+        buffer = WriteBehindBuffer(config)
+        buffer.start()
+        buffer.add_review_result(store["id"], "fb1", REVIEW_STATUS_SKIPPED)
+        for _ in range(100):
+            if not buffer.pending():
+                break
+            await asyncio.sleep(0.01)
+        assert get_processed_review_ids(store["id"]) == {"fb1"}
+
+        # Остаток записывается при остановке, не дожидаясь следующего периода
+        buffer.add_review_result(store["id"], "fb2", REVIEW_STATUS_SKIPPED)
+        await buffer.close()
+        assert get_processed_review_ids(store["id"]) == {"fb1", "fb2"}
+
+    asyncio.run(scenario())
@@ -1,18 +1,68 @@
 import os
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-import requests
 import logging
-from typing import Dict, List, Optional, Any
+from typing import AsyncIterator, Deque, Dict, Iterable, List, Optional, Any, Set, Tuple, Union
+from collections import deque
 import json
 from pathlib import Path
-import jwt
-from datetime import datetime, timezone
 import asyncio
+import contextlib
+import signal
+import random
+import time
 import aiohttp
-from concurrent.futures import ThreadPoolExecutor
-from database import Store, get_user_stores, update_store_statistics, session_scope
+from database import (
+    Store,
+    get_user_stores,
+    session_scope,
+    backfill_store_key_info,
+    get_review_cursor,
+    update_review_cursor,
+    get_processed_review_ids,
+    get_failed_review_ids,
+    claim_review,
+    finish_review,
+    finish_llm_batch,
+    get_pending_llm_batches,
+    save_llm_batch,
+    update_llm_batch_status,
+    prune_cycle_metrics,
+    prune_processed_reviews,
+    get_store_tokens_since,
+    rollup_bucket_start,
+    ROLLUP_DAY,
+    REVIEW_STATUS_ANSWERED,
+    REVIEW_STATUS_SKIPPED,
+    REVIEW_STATUS_FAILED
+)
 import openai
+from answer_cache import AnswerCache
+from api_keys import introspect_api_key
+from batch_backlog import FINAL_BATCH_STATUSES, fetch_batch_results, submit_batch
+from clients import ClientRegistry
+from llm_backends import LLMRouter
+from llm_batching import pack_batches, parse_batch_answers
+from llm_requests import RequestBuilder
+from rate_limiter import RateLimiterRegistry
+from scheduler import StoreScheduler
+from sharding import ShardMembership
+from metrics import (
+    REGISTRY,
+    ALL_STORES_SECONDS,
+    LLM_IN_FLIGHT,
+    LLM_SECONDS,
+    LLM_TOKENS_TOTAL,
+    QUEUE_DEPTH,
+    RATE_LIMIT_WAIT_SECONDS,
+    REVIEWS_TOTAL,
+    STORE_CYCLE_SECONDS,
+    WB_PAGE_SECONDS,
+    WB_SEND_SECONDS,
+    MetricsServer,
+)
+from models import Review, loads
+from write_buffer import WriteBehindBuffer
 
 # Настройка логирования
 def setup_logging() -> None:
@@ -51,8 +101,21 @@ def load_config() -> Dict[str, Any]:
     load_dotenv()
     
     config = {
-        "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY"),
-        "WB_API_URL": "https://feedbacks-api.wildberries.ru/api/v1",
+        "OPENAI_API_KEY": os.getenv("OPENAI_API_KEY", ""),
+        "OPENAI_MODEL": os.getenv("OPENAI_MODEL", "gpt-3.5-turbo"),
+        "DEEPSEEK_API_KEY": os.getenv("DEEPSEEK_API_KEY", ""),
+        "DEEPSEEK_BASE_URL": os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com"),
+        "DEEPSEEK_MODEL": os.getenv("DEEPSEEK_MODEL", "deepseek-chat"),
+        "LOCAL_LLM_BASE_URL": os.getenv("LOCAL_LLM_BASE_URL", ""),
+        "LOCAL_LLM_API_KEY": os.getenv("LOCAL_LLM_API_KEY", ""),
+        "LOCAL_LLM_MODEL": os.getenv("LOCAL_LLM_MODEL", "local"),
+        "LLM_BACKENDS": [name.strip() for name in os.getenv("LLM_BACKENDS", "openai").split(",") if name.strip()],
+        "LLM_STORE_BACKENDS": json.loads(os.getenv("LLM_STORE_BACKENDS", "{}")),
+        "LLM_BACKEND_FAILURES": int(os.getenv("LLM_BACKEND_FAILURES", "3")),
+        "LLM_BACKEND_COOLDOWN_SECONDS": float(os.getenv("LLM_BACKEND_COOLDOWN_SECONDS", "30")),
+        "LLM_HEDGE_ENABLED": os.getenv("LLM_HEDGE_ENABLED", "true").lower() == "true",
+        "LLM_HEDGE_MIN_SAMPLES": int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20")),
+        "WB_API_URL": os.getenv("WB_API_URL", "https://feedbacks-api.wildberries.ru/api/v1"),
         "REVIEWS_PER_PAGE": int(os.getenv("REVIEWS_PER_PAGE")),
         "CHECK_INTERVAL_MINUTES": int(os.getenv("CHECK_INTERVAL_MINUTES", "5")),
         "MAX_RETRIES": int(os.getenv("MAX_RETRIES", "3")),
@@ -61,7 +124,55 @@ def load_config() -> Dict[str, Any]:
         "BATCH_SIZE": int(os.getenv("BATCH_SIZE", "50")),
         "OPENAI_TIMEOUT_SECONDS": int(os.getenv("OPENAI_TIMEOUT_SECONDS", "30")),
         "WB_TIMEOUT_SECONDS": int(os.getenv("WB_TIMEOUT_SECONDS", "5")),
-        "RATE_LIMIT_DELAY_SECONDS": float(os.getenv("RATE_LIMIT_DELAY_SECONDS", "1.0"))
+        "RATE_LIMIT_DELAY_SECONDS": float(os.getenv("RATE_LIMIT_DELAY_SECONDS", "1.0")),
+        "INCREMENTAL_FETCH": os.getenv("INCREMENTAL_FETCH", "true").lower() == "true",
+        "CURSOR_RETRY_HOURS": int(os.getenv("CURSOR_RETRY_HOURS", "24")),
+        "FAILED_RETRY_LIMIT": int(os.getenv("FAILED_RETRY_LIMIT", "20")),
+        "REVIEW_CLAIM_TIMEOUT_MINUTES": int(os.getenv("REVIEW_CLAIM_TIMEOUT_MINUTES", "30")),
+        "LLM_MAX_CONCURRENCY": int(os.getenv("LLM_MAX_CONCURRENCY", "20")),
+        "LLM_STORE_CONCURRENCY": int(os.getenv("LLM_STORE_CONCURRENCY", "5")),
+        "LLM_STORE_CONCURRENCY_OVERRIDES": json.loads(os.getenv("LLM_STORE_CONCURRENCY_OVERRIDES", "{}")),
+        "HTTP_POOL_LIMIT": int(os.getenv("HTTP_POOL_LIMIT", "100")),
+        "HTTP_POOL_LIMIT_PER_HOST": int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "50")),
+        "HTTP_DNS_CACHE_SECONDS": int(os.getenv("HTTP_DNS_CACHE_SECONDS", "300")),
+        "HTTP_KEEPALIVE_SECONDS": int(os.getenv("HTTP_KEEPALIVE_SECONDS", "60")),
+        "WB_RATE_LIMIT_PER_SECOND": float(os.getenv("WB_RATE_LIMIT_PER_SECOND", "3")),
+        "WB_RATE_LIMIT_BURST": int(os.getenv("WB_RATE_LIMIT_BURST", "6")),
+        "WB_RATE_LIMIT_MIN_PER_SECOND": float(os.getenv("WB_RATE_LIMIT_MIN_PER_SECOND", "0.2")),
+        "RETRY_MAX_DELAY_SECONDS": float(os.getenv("RETRY_MAX_DELAY_SECONDS", "30")),
+        "PREFETCH_PAGES": int(os.getenv("PREFETCH_PAGES", "2")),
+        "ANSWER_CACHE_ENABLED": os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true",
+        "ANSWER_CACHE_TTL_HOURS": int(os.getenv("ANSWER_CACHE_TTL_HOURS", "168")),
+        "ANSWER_CACHE_MAX_ENTRIES": int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "10000")),
+        "ANSWER_CACHE_MEMORY_ENTRIES": int(os.getenv("ANSWER_CACHE_MEMORY_ENTRIES", "1000")),
+        "ANSWER_CACHE_VARIANTS": int(os.getenv("ANSWER_CACHE_VARIANTS", "3")),
+        "ANSWER_CACHE_MAX_TEXT_LENGTH": int(os.getenv("ANSWER_CACHE_MAX_TEXT_LENGTH", "100")),
+        "SCHEDULER_MIN_INTERVAL_MINUTES": float(os.getenv("SCHEDULER_MIN_INTERVAL_MINUTES", "1")),
+        "SCHEDULER_MAX_INTERVAL_MINUTES": float(os.getenv("SCHEDULER_MAX_INTERVAL_MINUTES", "30")),
+        "SCHEDULER_JITTER": float(os.getenv("SCHEDULER_JITTER", "0.1")),
+        "SCHEDULER_BUSY_REVIEWS": int(os.getenv("SCHEDULER_BUSY_REVIEWS", "20")),
+        "SCHEDULER_REFRESH_MINUTES": float(os.getenv("SCHEDULER_REFRESH_MINUTES", "1")),
+        "SHARDING_ENABLED": os.getenv("SHARDING_ENABLED", "false").lower() == "true",
+        "WORKER_ID": os.getenv("WORKER_ID", ""),
+        "WORKER_HEARTBEAT_SECONDS": float(os.getenv("WORKER_HEARTBEAT_SECONDS", "15")),
+        "WORKER_LEASE_SECONDS": float(os.getenv("WORKER_LEASE_SECONDS", "60")),
+        "WORKER_STATUS_FILE": os.getenv("WORKER_STATUS_FILE", ""),
+        "WRITE_BUFFER_FLUSH_SECONDS": float(os.getenv("WRITE_BUFFER_FLUSH_SECONDS", "5")),
+        "WRITE_BUFFER_MAX_PENDING": int(os.getenv("WRITE_BUFFER_MAX_PENDING", "1000")),
+        "CYCLE_METRICS_RETENTION_DAYS": int(os.getenv("CYCLE_METRICS_RETENTION_DAYS", "30")),
+        "PROCESSED_REVIEWS_RETENTION_DAYS": int(os.getenv("PROCESSED_REVIEWS_RETENTION_DAYS", "90")),
+        "METRICS_HOST": os.getenv("METRICS_HOST", "127.0.0.1"),
+        "METRICS_PORT": int(os.getenv("METRICS_PORT", "0")),
+        "METRICS_MAX_STORE_LABELS": int(os.getenv("METRICS_MAX_STORE_LABELS", "100")),
+        "LLM_FEW_SHOT_EXAMPLES": json.loads(os.getenv("LLM_FEW_SHOT_EXAMPLES", "[]")),
+        "LLM_STORE_DAILY_TOKENS": int(os.getenv("LLM_STORE_DAILY_TOKENS", "0")),
+        "LLM_STORE_DAILY_TOKENS_OVERRIDES": json.loads(os.getenv("LLM_STORE_DAILY_TOKENS_OVERRIDES", "{}")),
+        "LLM_BATCH_SIZE": int(os.getenv("LLM_BATCH_SIZE", "1")),
+        "LLM_BATCH_MAX_TOKENS": int(os.getenv("LLM_BATCH_MAX_TOKENS", "4000")),
+        "LLM_BACKLOG_ENABLED": os.getenv("LLM_BACKLOG_ENABLED", "false").lower() == "true",
+        "LLM_BACKLOG_MIN_AGE_HOURS": float(os.getenv("LLM_BACKLOG_MIN_AGE_HOURS", "24")),
+        "LLM_BACKLOG_MAX_REQUESTS": int(os.getenv("LLM_BACKLOG_MAX_REQUESTS", "10000")),
+        "LLM_BACKLOG_CHUNK_SIZE": int(os.getenv("LLM_BACKLOG_CHUNK_SIZE", "1000"))
     }
     
     # Проверка обязательных параметров
@@ -72,52 +183,156 @@ def load_config() -> Dict[str, Any]:
     return config
 
 def check_api_key_expiration(api_key: str) -> bool:
-    """Проверка срока действия API ключа Wildberries"""
-    try:
-        # Декодируем JWT токен без проверки подписи
-        decoded = jwt.decode(api_key, options={"verify_signature": False})
-        
-        # Получаем время истечения срока действия
-        exp_timestamp = decoded.get('exp')
-        if not exp_timestamp:
-            logging.error("В API ключе отсутствует время истечения срока действия")
-            return False
-            
-        # Преобразуем timestamp в datetime
-        exp_datetime = datetime.fromtimestamp(exp_timestamp, tz=timezone.utc)
-        current_datetime = datetime.now(timezone.utc)
-        
-        # Проверяем, не истек ли срок
-        if current_datetime > exp_datetime:
-            logging.error(f"API ключ истек {exp_datetime}")
-            return False
-            
-        # Вычисляем оставшееся время
-        time_left = exp_datetime - current_datetime
-        logging.debug(f"API ключ действителен еще {time_left}")
-        return True
-        
-    except Exception as e:
-        logging.error(f"Ошибка при проверке API ключа: {e}")
+    """Проверка срока действия API ключа Wildberries (разбор ключа кэшируется)"""
+    info = introspect_api_key(api_key)
+    if info is None:
+        return False
+    if not info.is_valid():
+        logging.error(f"API ключ истек {info.expires_at}")
         return False
+    return True
+
+def is_before_watermark(review: Review, watermark: Tuple[datetime, List[str]]) -> bool:
+    """Проверка, что отзыв не новее курсора (уже был получен в прошлых циклах)"""
+    if review.created is None:
+        return False
+    last_created, last_ids = watermark
+    return review.created < last_created or (review.created == last_created and review.id in last_ids)
+
+class ReviewFetchError(Exception):
+    """Страницу отзывов не удалось получить после всех попыток"""
+
+class CursorTracker:
+    """
+    Данные для нового курсора, накапливаемые по потоку отзывов:
+    самая новая дата с id отзывов и самый старый неотвеченный отзыв с ошибкой
+    """
+    def __init__(self, retry_since: datetime):
+        # Ошибки по отзывам старше retry_since курсор не удерживают
+        self.retry_since = retry_since
+        self.newest: Optional[datetime] = None
+        self.newest_ids: Set[str] = set()
+        self.oldest_failed: Optional[datetime] = None
+
+    def observe(self, review: Review) -> None:
+        created = review.created
+        if created is None:
+            return
+        if self.newest is None or created > self.newest:
+            self.newest = created
+            self.newest_ids = {review.id}
+        elif created == self.newest:
+            self.newest_ids.add(review.id)
+
+    def fail(self, review: Review) -> None:
+        if review.answered:
+            return
+        created = review.created
+        if created is None or created < self.retry_since:
+            return
+        if self.oldest_failed is None or created < self.oldest_failed:
+            self.oldest_failed = created
+
+class ListingGate:
+    """
+    Запросы страниц неотвеченных отзывов и отправка ответов не пересекаются.
+    Каждый ответ убирает отзыв из списка неотвеченных, и страницы за ним
+    сдвигаются; пока идет запрос страницы, наши ответы список не меняют, поэтому
+    смещение, поправленное на число отправленных ответов, точное. Ожидающий
+    запрос страницы пропускается вперед новых отправок.
+    """
+    def __init__(self):
+        self._condition = asyncio.Condition()
+        self._listing = 0
+        self._listing_waiting = 0
+        self._posting = 0
+
+    @contextlib.asynccontextmanager
+    async def listing(self, active: bool = True) -> AsyncIterator[None]:
+        if not active:
+            yield
+            return
+        async with self._condition:
+            self._listing_waiting += 1
+            try:
+                await self._condition.wait_for(lambda: not self._posting)
+            finally:
+                self._listing_waiting -= 1
+            self._listing += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._listing -= 1
+                self._condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def posting(self) -> AsyncIterator[None]:
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self._listing and not self._listing_waiting)
+            self._posting += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._posting -= 1
+                self._condition.notify_all()
+
+# Глобальное ограничение параллельных запросов к LLM (одно на event loop)
+_llm_semaphore: Optional[asyncio.Semaphore] = None
+_llm_semaphore_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def get_llm_semaphore(config: Dict[str, Any]) -> asyncio.Semaphore:
+    """Получение общего для всех магазинов семафора генерации ответов"""
+    global _llm_semaphore, _llm_semaphore_loop
+    loop = asyncio.get_running_loop()
+    if _llm_semaphore is None or _llm_semaphore_loop is not loop:
+        _llm_semaphore = asyncio.Semaphore(config["LLM_MAX_CONCURRENCY"])
+        _llm_semaphore_loop = loop
+    return _llm_semaphore
 
 class WBFeedbackBot:
-    def __init__(self, config: Dict[str, Any], store_data: Dict[str, Any]):
+    def __init__(self, config: Dict[str, Any], store_data: Dict[str, Any],
+                 clients: Optional[ClientRegistry] = None):
         self.config = config
         self.store = store_data
-        self.session: Optional[aiohttp.ClientSession] = None
+        # Общие клиенты воркера; без них бот создает и закрывает собственные
+        self.clients = clients
+        self.session: Optional[aiohttp.ClientSession] = clients.http if clients else None
+        # id отзывов, обработка которых завершена: по журналу для каждой полученной страницы
+        # и по результатам текущего цикла. Пропускаются без захвата и запросов к API
+        self.processed_ids: Set[str] = set()
+        # Курсор инкрементальной загрузки: (дата, id отзывов с этой датой) из прошлых циклов
+        self.watermark: Optional[Tuple[datetime, List[str]]] = None
+        # Обе выборки дошли до курсора или до конца списка без ошибок
+        self.fetch_complete = False
         
-        # Используем ThreadPoolExecutor для синхронных вызовов
-        self.executor = ThreadPoolExecutor(max_workers=self.config["MAX_CONCURRENT_REQUESTS"])
         # Семафор для ограничения параллельных HTTP-запросов к WB
         self.wb_semaphore = asyncio.Semaphore(self.config["MAX_CONCURRENT_REQUESTS"])
+        # Отправка ответов сдвигает страницы неотвеченных отзывов: id отзывов с полученных
+        # страниц и число отправленных на них ответов для поправки смещения
+        self.listing_gate = ListingGate()
+        self.listed_ids: Set[str] = set()
+        self.listing_shift = 0
+        # Лимит запросов в секунду, общий для всех методов API и магазинов одного продавца
+        rate_limiters = clients.rate_limiters if clients else RateLimiterRegistry(self.config)
+        self.rate_limiter = rate_limiters.get(self.store.get('wb_api_key', ''))
+        # Статистика, итоговые статусы отзывов и попадания в кэш ответов пишутся в базу пакетами
+        self.write_buffer = clients.write_buffer if clients else WriteBehindBuffer(self.config)
+        self.answer_cache = clients.answer_cache if clients else AnswerCache(self.config, self.write_buffer)
+        self.request_builder = clients.request_builder if clients else RequestBuilder(self.config)
+        # Запросы к LLM за цикл обработки: число, суммарная задержка и токены
+        self.llm_usage = {'llm_calls': 0, 'llm_latency_ms': 0, 'prompt_tokens': 0, 'completion_tokens': 0,
+                          'cached_tokens': 0}
+        # Токены магазина за текущие сутки до начала цикла; None - без дневного бюджета
+        self.tokens_today: Optional[int] = None
+        # Отзывы, отложенные в цикле из-за исчерпанного бюджета токенов
+        self.budget_deferred = 0
+        # Значение метки store в метриках (с ограничением числа магазинов)
+        self.store_label = REGISTRY.store_label(self.store['id'])
         
-        # Инициализация OpenAI клиента
-        openai.api_key = self.config["OPENAI_API_KEY"]
-        self.openai_client = openai.OpenAI(
-            api_key=self.config["OPENAI_API_KEY"],
-            timeout=self.config["OPENAI_TIMEOUT_SECONDS"]
-        )
+        # Бэкенды LLM: выбор по задержке и исправности, дублирование медленных запросов
+        self.llm = clients.llm if clients else LLMRouter(self.config)
     
     async def init_session(self):
         """Инициализация aiohttp сессии"""
@@ -125,16 +340,33 @@ class WBFeedbackBot:
             self.session = aiohttp.ClientSession()
 
     async def close_session(self):
-        """Закрытие aiohttp сессии"""
+        """
+        Закрытие собственных aiohttp сессии и клиентов LLM и запись собственного
+        буфера в базу (общие клиенты не закрываются)
+        """
+        if self.clients:
+            return
+        await self.write_buffer.close()
         if self.session:
             await self.session.close()
             self.session = None
+        await self.llm.close()
 
-    async def get_reviews(self) -> List[Dict[str, Any]]:
+    async def get_reviews(self) -> List[Review]:
         """Асинхронное получение всех отзывов с Wildberries"""
-        all_reviews: List[Dict[str, Any]] = []
+        all_reviews = [review async for review in self.iter_reviews()]
+        logging.debug(f"Завершено получение отзывов для магазина {self.store['name']}. Всего найдено: {len(all_reviews)}")
+        return all_reviews
+
+    async def iter_reviews(self) -> AsyncIterator[Review]:
+        """
+        Потоковое получение отзывов: неотвеченные и отвеченные загружаются параллельно,
+        страницы выдаются по мере загрузки через ограниченную очередь, поэтому
+        в памяти одновременно находится лишь несколько страниц.
+        """
         skip = 0
-        take = self.config["REVIEWS_PER_PAGE"]  
+        take = self.config["REVIEWS_PER_PAGE"]
+        self.fetch_complete = False
 
         logging.debug(f"Начало получения отзывов для магазина {self.store['name']}...")
         
@@ -142,173 +374,547 @@ class WBFeedbackBot:
         if not self.session:
             await self.init_session()
 
-        # Сначала получаем неотвеченные отзывы
-        logging.debug("Получение неотвеченных отзывов...")
-        unanswered_reviews = await self._fetch_reviews(skip, take, is_answered=False)
-        if unanswered_reviews:
-            all_reviews.extend(unanswered_reviews)
-            logging.debug(f"Получено {len(unanswered_reviews)} неотвеченных отзывов")
+        self.listed_ids = set()
+        self.listing_shift = 0
 
-        # Затем получаем отвеченные отзывы
-        logging.debug("Получение отвеченных отзывов...")
-        answered_reviews = await self._fetch_reviews(skip, take, is_answered=True)
-        if answered_reviews:
-            all_reviews.extend(answered_reviews)
-            logging.debug(f"Получено {len(answered_reviews)} отвеченных отзывов")
+        # В инкрементальном режиме загружаем только отзывы новее сохраненного курсора
+        if self.config["INCREMENTAL_FETCH"] and self.store.get('id') is not None:
+            self.watermark = await asyncio.to_thread(get_review_cursor, self.store['id'])
+            if self.watermark:
+                logging.debug(f"Инкрементальная загрузка отзывов новее {self.watermark[0]}")
 
-        logging.debug(f"Завершено получение отзывов для магазина {self.store['name']}. Всего найдено: {len(all_reviews)}")
-        return all_reviews
+        pages: asyncio.Queue = asyncio.Queue(maxsize=2)
+        complete: Dict[bool, bool] = {}
+
+        async def pump(is_answered: bool) -> None:
+            complete[is_answered] = False
+            try:
+                async for page in self._iter_review_pages(skip, take, is_answered):
+                    await pages.put(page)
+                complete[is_answered] = True
+            except ReviewFetchError as e:
+                logging.error(str(e))
+            except Exception as e:
+                logging.error(f"Ошибка при загрузке отзывов магазина {self.store['name']}: {str(e)}", exc_info=True)
+            # Признак окончания выборки (при отмене задачи не нужен)
+            await pages.put(None)
+
+        logging.debug("Получение неотвеченных и отвеченных отзывов...")
+        pumps = [asyncio.create_task(pump(False)), asyncio.create_task(pump(True))]
+        finished = 0
+        try:
+            while finished < len(pumps):
+                page = await pages.get()
+                if page is None:
+                    finished += 1
+                    continue
+                await self.load_processed_ids(page)
+                for review in page:
+                    yield review
+        finally:
+            for task in pumps:
+                task.cancel()
+            # Дожидаемся отмены, чтобы опережающие запросы страниц не продолжали работу
+            await asyncio.gather(*pumps, return_exceptions=True)
 
-    async def _fetch_reviews(self, skip: int, take: int, is_answered: bool) -> List[Dict[str, Any]]:
-        """Вспомогательный метод для получения отзывов с пагинацией"""
-        reviews: List[Dict[str, Any]] = []
-        current_skip = skip
+        self.fetch_complete = all(complete.values())
 
-        while True:
-            for attempt in range(self.config["MAX_RETRIES"]):
-                try:
-                    if not self.session:
-                        await self.init_session()
-                        
-                    reviews_url = f"{self.config['WB_API_URL']}/feedbacks"
+    async def load_processed_ids(self, page: List[Review]) -> None:
+        """Загрузка из журнала завершенных отзывов страницы (отвеченные пропускаются и так)"""
+        feedback_ids = [review.id for review in page if not review.answered and review.id]
+        if feedback_ids and self.store.get('id') is not None:
+            self.processed_ids.update(
+                await asyncio.to_thread(get_processed_review_ids, self.store['id'], feedback_ids)
+            )
+
+    async def _fetch_page(self, skip: int, take: int, is_answered: bool) -> Optional[List[Review]]:
+        """Получение одной страницы отзывов с замером времени. None - если страницу получить не удалось"""
+        started = time.monotonic()
+        page = await self._request_page(skip, take, is_answered)
+        WB_PAGE_SECONDS.observe(
+            time.monotonic() - started, store=self.store_label, outcome='ok' if page is not None else 'error'
+        )
+        return page
+
+    async def _request_page(self, skip: int, take: int, is_answered: bool) -> Optional[List[Review]]:
+        """
+        Получение одной страницы отзывов с повторными попытками. None - если страницу получить не удалось.
+        skip у неотвеченных - позиция в списке на начало цикла: из нее вычитаются отправленные с тех пор ответы
+        """
+        for attempt in range(self.config["MAX_RETRIES"]):
+            try:
+                if not self.session:
+                    await self.init_session()
+                    
+                reviews_url = f"{self.config['WB_API_URL']}/feedbacks"
+                await self.acquire_rate_limit()
+                async with self.listing_gate.listing(not is_answered), self.wb_semaphore:
                     reviews_params = {
-                        "skip": current_skip,
+                        "skip": skip if is_answered else max(0, skip - self.listing_shift),
                         "take": take,
                         "order": "dateDesc",
                         "isAnswered": str(is_answered).lower()
                     }
-                    
-                    logging.debug(f"Запрос отзывов для магазина {self.store['name']}: skip={current_skip}, take={take}, isAnswered={is_answered}")
-                    
-                    async with self.wb_semaphore:
-                        async with self.session.get(
-                            reviews_url,
-                            params=reviews_params,
-                            headers={"Authorization": f"Bearer {self.store['wb_api_key']}"},
-                            timeout=self.config["WB_TIMEOUT_SECONDS"]
-                        ) as response:
-                            logging.debug(f"Статус ответа: {response.status}")
+                    logging.debug(
+                        f"Запрос отзывов для магазина {self.store['name']}: skip={reviews_params['skip']}, "
+                        f"take={take}, isAnswered={is_answered}"
+                    )
+                    async with self.session.get(
+                        reviews_url,
+                        params=reviews_params,
+                        headers={"Authorization": f"Bearer {self.store['wb_api_key']}"},
+                        timeout=self.config["WB_TIMEOUT_SECONDS"]
+                    ) as response:
+                        logging.debug(f"Статус ответа: {response.status}")
+                        self.rate_limiter.on_response(response.status, response.headers)
+                        
+                        # Паузу после 429 выдерживает лимитер перед следующей попыткой
+                        if response.status == 429:
+                            continue
                             
-                            if response.status == 429:
-                                retry_after = int(response.headers.get("Retry-After", "5"))
-                                logging.warning(f"Превышен лимит запросов. Ожидание {retry_after} секунд...")
-                                await asyncio.sleep(retry_after)
+                        response.raise_for_status()
+                        response_data = loads(await response.read())
+                        
+                        if not response_data:
+                            logging.error("Получен пустой ответ от API")
+                            if attempt < self.config["MAX_RETRIES"] - 1:
+                                await asyncio.sleep(self.config["RETRY_DELAY_SECONDS"])
                                 continue
-                                
-                            response.raise_for_status()
-                            response_data = await response.json()
-                            
-                            if not response_data:
-                                logging.error("Получен пустой ответ от API")
-                                if attempt < self.config["MAX_RETRIES"] - 1:
-                                    await asyncio.sleep(self.config["RETRY_DELAY_SECONDS"])
-                                    continue
-                                return reviews
-                                
-                            if 'data' not in response_data:
-                                logging.error(f"В ответе отсутствует поле 'data': {response_data}")
-                                if attempt < self.config["MAX_RETRIES"] - 1:
-                                    await asyncio.sleep(self.config["RETRY_DELAY_SECONDS"])
-                                    continue
-                                return reviews
+                            return None
                             
-                            feedbacks = response_data['data'].get('feedbacks', [])
-                            
-                            if feedbacks:
-                                reviews.extend(feedbacks)
-                                logging.debug(f"Добавлено {len(feedbacks)} отзывов. Всего: {len(reviews)}")
-                            else:
-                                logging.debug("Нет новых отзывов для обработки.")
-                            
-                            current_skip += take
-                            
-                            if len(feedbacks) < take:
-                                logging.debug("Получено меньше отзывов, чем запрошено. Прекращаем пагинацию.")
-                                return reviews
-                            
-                            break
-                            
-                except aiohttp.ClientError as e:
-                    logging.error(f"Ошибка сети при запросе (попытка {attempt + 1}/{self.config['MAX_RETRIES']}): {e}")
-                    if attempt < self.config["MAX_RETRIES"] - 1:
-                        await asyncio.sleep(self.config["RETRY_DELAY_SECONDS"])
-                        continue
-                    return reviews
-                    
-                except asyncio.TimeoutError:
-                    logging.error(f"Таймаут при запросе (попытка {attempt + 1}/{self.config['MAX_RETRIES']})")
-                    if attempt < self.config["MAX_RETRIES"] - 1:
-                        await asyncio.sleep(self.config["RETRY_DELAY_SECONDS"])
-                        continue
-                    return reviews
-                    
-                except Exception as e:
-                    logging.error(f"Неожиданная ошибка при запросе (попытка {attempt + 1}/{self.config['MAX_RETRIES']}): {str(e)}", exc_info=True)
-                    if attempt < self.config["MAX_RETRIES"] - 1:
-                        await asyncio.sleep(self.config["RETRY_DELAY_SECONDS"])
-                        continue
-                    return reviews
+                        if 'data' not in response_data:
+                            logging.error(f"В ответе отсутствует поле 'data': {response_data}")
+                            if attempt < self.config["MAX_RETRIES"] - 1:
+                                await asyncio.sleep(self.config["RETRY_DELAY_SECONDS"])
+                                continue
+                            return None
+                        
+                        # Из тяжелого JSON отзыва сразу оставляем только нужные поля
+                        page = [Review.from_feedback(feedback) for feedback in response_data['data'].get('feedbacks') or []]
+                        if not is_answered:
+                            self.listed_ids.update(review.id for review in page)
+                        return page
+                        
+            except aiohttp.ClientError as e:
+                logging.error(f"Ошибка сети при запросе (попытка {attempt + 1}/{self.config['MAX_RETRIES']}): {e}")
+                
+            except asyncio.TimeoutError:
+                logging.error(f"Таймаут при запросе (попытка {attempt + 1}/{self.config['MAX_RETRIES']})")
+                
+            except Exception as e:
+                logging.error(f"Неожиданная ошибка при запросе (попытка {attempt + 1}/{self.config['MAX_RETRIES']}): {str(e)}", exc_info=True)
+            
+            if attempt < self.config["MAX_RETRIES"] - 1:
+                await asyncio.sleep(self.config["RETRY_DELAY_SECONDS"])
+        
+        logging.error(f"Не удалось получить страницу отзывов магазина {self.store['name']}: skip={skip}, isAnswered={is_answered}")
+        return None
 
-        return reviews
+    async def _iter_review_pages(self, skip: int, take: int, is_answered: bool) -> AsyncIterator[List[Review]]:
+        """
+        Постраничное получение отзывов одной выборки (только новее курсора).
+        После первой полной страницы следующие PREFETCH_PAGES страниц запрашиваются
+        заранее, пока разбирается текущая; лишние запросы отменяются на короткой
+        странице или на курсоре. Если страницу получить не удалось, выбрасывается
+        ReviewFetchError: выборка не дошла до курсора или до конца списка.
+        """
+        pending: Deque[asyncio.Task] = deque()
+        next_skip = skip
+        # Поправка смещения на отправленные ответы может вернуть уже выданные отзывы
+        yielded: Set[str] = set()
+        # Пока не ясно, понадобится ли вторая страница, опережающих запросов нет
+        window = 1
 
-    async def process_review(self, review: Dict) -> Optional[Dict]:
-        """Асинхронная обработка одного отзыва"""
-        feedback_id = review.get('id')
+        def schedule() -> None:
+            nonlocal next_skip
+            while len(pending) < window:
+                pending.append(asyncio.create_task(self._fetch_page(next_skip, take, is_answered)))
+                next_skip += take
+
+        try:
+            schedule()
+            while pending:
+                feedbacks = await pending.popleft()
+                if feedbacks is None:
+                    raise ReviewFetchError(
+                        f"Загрузка отзывов магазина {self.store['name']} прервана (isAnswered={is_answered})"
+                    )
+                page_size = len(feedbacks)
+                
+                # Отзывы идут от новых к старым: всё, что не новее курсора, уже получено ранее
+                reached_watermark = False
+                if self.watermark:
+                    new_feedbacks = [f for f in feedbacks if not is_before_watermark(f, self.watermark)]
+                    reached_watermark = len(new_feedbacks) < page_size
+                    feedbacks = new_feedbacks
+                if not is_answered:
+                    feedbacks = [f for f in feedbacks if f.id not in yielded]
+                    yielded.update(f.id for f in feedbacks)
+                
+                if feedbacks:
+                    logging.debug(f"Получено {len(feedbacks)} отзывов (isAnswered={is_answered})")
+                    yield feedbacks
+                else:
+                    logging.debug("Нет новых отзывов для обработки.")
+                
+                if reached_watermark:
+                    logging.debug("Достигнут курсор прошлой проверки. Прекращаем пагинацию.")
+                    return
+                
+                if page_size < take:
+                    logging.debug("Получено меньше отзывов, чем запрошено. Прекращаем пагинацию.")
+                    return
+                
+                window = 1 + self.config["PREFETCH_PAGES"]
+                schedule()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _fetch_reviews(self, skip: int, take: int, is_answered: bool) -> Tuple[List[Review], bool]:
+        """
+        Получение всех страниц одной выборки списком.
+        Возвращает отзывы и признак того, что выборка дошла до курсора или до конца списка.
+        """
+        reviews: List[Review] = []
+        try:
+            async for page in self._iter_review_pages(skip, take, is_answered):
+                reviews.extend(page)
+        except ReviewFetchError as e:
+            logging.error(str(e))
+            return reviews, False
+        return reviews, True
+
+    async def prepare_review(self, review: Review) -> Optional[Dict]:
+        """
+        Подготовка отзыва к генерации ответа: пропуск уже обработанных отзывов,
+        извлечение текста и захват отзыва в журнале
+        """
+        feedback_id = review.id
         
         if not feedback_id:
             logging.error("Отсутствует ID отзыва")
             return None
+        
+        store_id = self.store['id']
+        
+        # Уже обработанные отзывы пропускаем до любых сетевых вызовов
+        if feedback_id in self.processed_ids:
+            logging.debug(f"Пропуск отзыва {feedback_id}: уже обработан")
+            return {'id': feedback_id, 'skipped': True}
+        
+        # На отзыв уже ответили (вручную или в прошлых циклах)
+        if review.answered:
+            self.processed_ids.add(feedback_id)
+            return {'id': feedback_id, 'skipped': True}
+        
+        review_text = review.text
             
+        # Если нет текста, но есть оценка - используем её как текст
+        if not review_text and review.product_valuation:
+            review_text = f"Оценка: {review.product_valuation} звезд"
+        
+        if not review_text:
+            logging.warning(f"Пропуск отзыва {feedback_id}: отсутствует текст отзыва")
+            self.write_buffer.add_review_result(store_id, feedback_id, REVIEW_STATUS_SKIPPED)
+            self.processed_ids.add(feedback_id)
+            return {'id': feedback_id, 'skipped': True}
+        
+        # Захватываем отзыв, чтобы параллельный воркер не ответил на него повторно
+        claim_timeout = timedelta(minutes=self.config["REVIEW_CLAIM_TIMEOUT_MINUTES"])
+        if not await asyncio.to_thread(claim_review, store_id, feedback_id, claim_timeout):
+            logging.debug(f"Пропуск отзыва {feedback_id}: обрабатывается другим воркером")
+            return {'id': feedback_id, 'skipped': True}
+        
+        return {
+            'id': feedback_id,
+            'text': review_text,
+            'valuation': review.product_valuation
+        }
+
+    async def release_review(self, feedback_id: str) -> None:
+        """
+        Снятие захвата отзыва после ошибки, чтобы он был обработан повторно.
+        Пишется сразу, минуя буфер: до записи отзыв нельзя захватить заново
+        """
         try:
-            # Проверяем все возможные поля с текстом отзыва
-            review_text = review.get('text', '')
-            if not review_text:
-                review_text = review.get('pros', '')
-            if not review_text:
-                review_text = review.get('cons', '')
-            if not review_text:
-                review_text = review.get('comment', '')
-                
-            # Если нет текста, но есть оценка - используем её как текст
-            if not review_text and review.get('productValuation'):
-                review_text = f"Оценка: {review.get('productValuation')} звезд"
-            
-            if not review_text:
-                logging.warning(f"Пропуск отзыва {feedback_id}: отсутствует текст отзыва")
-                return None
-                
-            # Получаем оценку продукта
-            product_valuation = review.get('productValuation')
-            
-            # Генерируем ответ с помощью AI
-            response_text = self.generate_ai_response(review_text, product_valuation)
+            await asyncio.to_thread(finish_review, self.store['id'], feedback_id, REVIEW_STATUS_FAILED)
+        except Exception as e:
+            logging.error(f"Не удалось снять захват отзыва {feedback_id}: {str(e)}")
+
+    async def answer_review(self, prepared: Dict, response_text: str) -> Optional[Dict]:
+        """Отправка сгенерированного ответа и запись результата в журнал"""
+        feedback_id = prepared['id']
+        
+        started = time.monotonic()
+        success = await self.send_response(feedback_id, response_text)
+        WB_SEND_SECONDS.observe(time.monotonic() - started, store=self.store_label, outcome='ok' if success else 'error')
+        
+        if not success:
+            logging.error(f"Не удалось отправить ответ на отзыв {feedback_id}")
+            await self.release_review(feedback_id)
+            return None
+        
+        self.write_buffer.add_review_result(self.store['id'], feedback_id, REVIEW_STATUS_ANSWERED, response_text)
+        self.processed_ids.add(feedback_id)
+        logging.info(f"Успешно обработан отзыв {feedback_id}")
+        return {
+            'id': feedback_id,
+            'text': prepared['text'],
+            'response': response_text,
+            'valuation': prepared['valuation'],
+            'timestamp': datetime.now().isoformat()
+        }
+
+    async def cached_answer(self, prepared: Dict) -> Tuple[Optional[str], Optional[str]]:
+        """Ключ кэша отзыва и ответ из кэша, если он есть"""
+        cache_key = self.answer_cache.key(self.store['prompt'], prepared['text'], prepared['valuation'])
+        if cache_key:
+            cached = await self.answer_cache.get(cache_key)
+            if cached:
+                logging.debug(f"Ответ на отзыв {prepared['id']} взят из кэша")
+                return cache_key, cached
+        return cache_key, None
+
+    def count_listing_shift(self, feedback_id: str) -> None:
+        """
+        Учет отправки ответа на отзыв с уже полученной страницы неотвеченных: такие
+        отзывы стоят раньше следующих страниц и при ответе сдвигают их. Отзыв
+        учитывается один раз, в том числе если отправка не удалась: лишний сдвиг
+        дает только повтор уже полученных отзывов, а не пропуск
+        """
+        if feedback_id in self.listed_ids:
+            self.listed_ids.discard(feedback_id)
+            self.listing_shift += 1
+
+    def count_llm_call(self, latency: float, ok: bool) -> None:
+        """Учет запроса к LLM в метриках цикла и Prometheus"""
+        self.llm_usage['llm_calls'] += 1
+        self.llm_usage['llm_latency_ms'] += round(latency * 1000)
+        LLM_SECONDS.observe(latency, store=self.store_label, outcome='ok' if ok else 'error')
+
+    def count_llm_tokens(self, response: Any) -> None:
+        """Учет токенов из usage ответа LLM"""
+        usage = response.usage
+        if not usage:
+            return
+        details = getattr(usage, 'prompt_tokens_details', None)
+        self.add_llm_tokens(usage.prompt_tokens or 0, usage.completion_tokens or 0,
+                            getattr(details, 'cached_tokens', None) or 0)
+
+    def add_llm_tokens(self, prompt_tokens: int, completion_tokens: int, cached_tokens: int) -> None:
+        """Учет токенов в метриках цикла и Prometheus"""
+        for kind, tokens in (('prompt', prompt_tokens), ('completion', completion_tokens), ('cached', cached_tokens)):
+            self.llm_usage[f'{kind}_tokens'] += tokens
+            if tokens:
+                LLM_TOKENS_TOTAL.inc(tokens, store=self.store_label, kind=kind)
+
+    def token_budget(self) -> int:
+        """Дневной бюджет токенов магазина (0 - без ограничения)"""
+        overrides = self.config["LLM_STORE_DAILY_TOKENS_OVERRIDES"]
+        return int(overrides.get(str(self.store['id']), self.config["LLM_STORE_DAILY_TOKENS"]))
+
+    def load_tokens_today(self) -> None:
+        """Загрузка расхода токенов магазина за текущие сутки (UTC) для проверки бюджета"""
+        if self.token_budget() > 0:
+            self.tokens_today = get_store_tokens_since(
+                self.store['id'], rollup_bucket_start(datetime.utcnow(), ROLLUP_DAY)
+            )
+
+    def budget_exhausted(self) -> bool:
+        """Дневной бюджет токенов магазина израсходован (с учетом текущего цикла)"""
+        if self.tokens_today is None:
+            return False
+        used = self.tokens_today + self.llm_usage['prompt_tokens'] + self.llm_usage['completion_tokens']
+        return used >= self.token_budget()
+
+    async def generate_for_review(self, prepared: Dict) -> Optional[str]:
+        """
+        Генерация ответа на подготовленный отзыв с учетом глобального лимита LLM.
+        Типовые отзывы отвечаются из кэша без запроса к LLM.
+        """
+        cache_key, cached = await self.cached_answer(prepared)
+        if cached:
+            return cached
+        return await self._generate_uncached(prepared, cache_key)
+
+    async def _generate_uncached(self, prepared: Dict, cache_key: Optional[str]) -> Optional[str]:
+        if self.budget_exhausted():
+            logging.warning(f"Дневной бюджет токенов магазина {self.store['name']} исчерпан, отзыв {prepared['id']} отложен")
+            self.budget_deferred += 1
+            await self.release_review(prepared['id'])
+            return None
+        
+        async with get_llm_semaphore(self.config):
+            started = time.monotonic()
+            LLM_IN_FLIGHT.inc()
+            try:
+                response_text = await self.generate_ai_response(prepared['text'], prepared['valuation'])
+            finally:
+                LLM_IN_FLIGHT.dec()
+            self.count_llm_call(time.monotonic() - started, bool(response_text))
+        
+        if not response_text:
+            logging.error(f"Не удалось сгенерировать ответ для отзыва {prepared['id']}")
+            await self.release_review(prepared['id'])
+        elif cache_key:
+            await self.answer_cache.put(self.store['id'], cache_key, response_text)
+        return response_text
+
+    async def generate_for_reviews(self, prepared_reviews: List[Dict]) -> Dict[str, Optional[str]]:
+        """
+        Генерация ответов на несколько подготовленных отзывов: {id отзыва: ответ или None}.
+        Отзывы без ответа в кэше отправляются пакетами по LLM_BATCH_SIZE штук в пределах
+        LLM_BATCH_MAX_TOKENS; отзывы, на которые пакет не вернул корректный ответ,
+        генерируются по одному
+        """
+        answers: Dict[str, Optional[str]] = {}
+        uncached: List[Tuple[Dict, Optional[str]]] = []
+        for prepared in prepared_reviews:
+            cache_key, cached = await self.cached_answer(prepared)
+            if cached:
+                answers[prepared['id']] = cached
+            else:
+                uncached.append((prepared, cache_key))
+
+        batches = pack_batches(
+            uncached, max(1, self.config["LLM_BATCH_SIZE"]), self.config["LLM_BATCH_MAX_TOKENS"],
+            text=lambda item: item[0]['text']
+        )
+        for batch in batches:
+            batch_answers: Dict[str, str] = {}
+            if len(batch) > 1:
+                batch_answers = await self.generate_batch(
+                    [prepared for prepared, _ in batch]
+                )
+            for prepared, cache_key in batch:
+                response_text = batch_answers.get(prepared['id'])
+                if response_text:
+                    if cache_key:
+                        await self.answer_cache.put(self.store['id'], cache_key, response_text)
+                else:
+                    response_text = await self._generate_uncached(prepared, cache_key)
+                answers[prepared['id']] = response_text
+        return answers
+
+    async def generate_batch(self, prepared_reviews: List[Dict]) -> Dict[str, str]:
+        """Пакетный запрос к LLM под общим лимитом; возвращает проверенные ответы по id отзыва"""
+        if self.budget_exhausted():
+            return {}
+        
+        async with get_llm_semaphore(self.config):
+            started = time.monotonic()
+            LLM_IN_FLIGHT.inc()
+            try:
+                answers = await self.generate_batch_response(prepared_reviews)
+            finally:
+                LLM_IN_FLIGHT.dec()
+            self.count_llm_call(time.monotonic() - started, bool(answers))
+        
+        missing = len(prepared_reviews) - len(answers)
+        if missing:
+            logging.warning(
+                f"Пакет из {len(prepared_reviews)} отзывов: {missing} без корректного ответа, "
+                f"генерируются по одному"
+            )
+        return answers
+
+    async def process_review(self, review: Review) -> Optional[Dict]:
+        """Асинхронная обработка одного отзыва"""
+        prepared = None
+        try:
+            prepared = await self.prepare_review(review)
+            if not prepared or prepared.get('skipped'):
+                return prepared
             
+            response_text = await self.generate_for_review(prepared)
             if not response_text:
-                logging.error(f"Не удалось сгенерировать ответ для отзыва {feedback_id}")
-                return None
-                
-            # Отправляем ответ
-            success = await self.send_response(feedback_id, response_text)
-            
-            if success:
-                logging.info(f"Успешно обработан отзыв {feedback_id}")
-                return {
-                    'id': feedback_id,
-                    'text': review_text,
-                    'response': response_text,
-                    'valuation': product_valuation,
-                    'timestamp': datetime.now().isoformat()
-                }
-            else:
-                logging.error(f"Не удалось отправить ответ на отзыв {feedback_id}")
                 return None
+            
+            return await self.answer_review(prepared, response_text)
                 
         except Exception as e:
-            logging.error(f"Ошибка при обработке отзыва {feedback_id}: {str(e)}", exc_info=True)
+            logging.error(f"Ошибка при обработке отзыва {review.id}: {str(e)}", exc_info=True)
+            if prepared and not prepared.get('skipped'):
+                await self.release_review(prepared['id'])
             return None
 
+    async def acquire_rate_limit(self) -> None:
+        """Ожидание лимита запросов к WB с учетом времени ожидания в метриках"""
+        waited = await self.rate_limiter.acquire()
+        RATE_LIMIT_WAIT_SECONDS.observe(waited, store=self.store_label)
+
+    def retry_delay(self, attempt: int) -> float:
+        """Экспоненциальная задержка перед повторной попыткой с полным джиттером"""
+        ceiling = min(
+            self.config["RETRY_MAX_DELAY_SECONDS"],
+            self.config["RETRY_DELAY_SECONDS"] * 2 ** (attempt - 1)
+        )
+        return random.uniform(0, ceiling)
+
+    async def get_feedback(self, feedback_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Получение отзыва по id. None - если получить не удалось,
+        пустой словарь - если такого отзыва нет
+        """
+        url = f"{self.config['WB_API_URL']}/feedback"
+        try:
+            await self.acquire_rate_limit()
+            async with self.session.get(
+                url,
+                params={"id": feedback_id},
+                headers={"Authorization": f"Bearer {self.store['wb_api_key']}"},
+                timeout=aiohttp.ClientTimeout(total=self.config["WB_TIMEOUT_SECONDS"])
+            ) as response:
+                self.rate_limiter.on_response(response.status, response.headers)
+                if response.status != 200:
+                    return None
+                response_data = await response.json()
+                return (response_data or {}).get('data') or {}
+        except Exception as e:
+            logging.warning(f"Не удалось получить отзыв {feedback_id}: {str(e)}")
+            return None
+
+    async def is_answered(self, feedback_id: str) -> Optional[bool]:
+        """Проверка наличия ответа на отзыв. None - если проверить не удалось"""
+        feedback = await self.get_feedback(feedback_id)
+        if feedback is None:
+            return None
+        return bool(feedback.get('answer'))
+
+    async def load_failed_reviews(self) -> List[Review]:
+        """
+        Повторная загрузка по id неотвеченных отзывов с ошибкой из журнала.
+        Курсор не удерживают отзывы старше CURSOR_RETRY_HOURS, и в выборку
+        новее курсора они больше не попадают. Отзывы, на которые уже ответили
+        или которых больше нет, закрываются в журнале; не полученные остаются
+        до следующего цикла
+        """
+        store_id = self.store['id']
+        failed_ids = await asyncio.to_thread(get_failed_review_ids, store_id, self.config["FAILED_RETRY_LIMIT"])
+        if failed_ids and not self.session:
+            await self.init_session()
+        reviews = []
+        for feedback_id in failed_ids:
+            feedback = await self.get_feedback(feedback_id)
+            if feedback is None:
+                continue
+            review = Review.from_feedback(feedback) if feedback else None
+            if review is None or review.answered:
+                self.write_buffer.add_review_result(store_id, feedback_id, REVIEW_STATUS_SKIPPED)
+                self.processed_ids.add(feedback_id)
+                continue
+            reviews.append(review)
+        if reviews:
+            logging.info(f"Повторная обработка отзывов с ошибкой магазина {self.store['name']}: {len(reviews)}")
+        return reviews
+
     async def send_response(self, feedback_id: str, text: str) -> bool:
-        """Отправляет ответ на отзыв через API Wildberries"""
+        """
+        Отправляет ответ на отзыв через API Wildberries.
+        После неоднозначной ошибки (таймаут, 5xx) ответ мог дойти, поэтому перед
+        повторной отправкой проверяется, не появился ли он у отзыва.
+        """
         url = f"{self.config['WB_API_URL']}/feedbacks/answer"
         
         headers = {
@@ -321,60 +927,62 @@ class WBFeedbackBot:
             "text": text
         }
         
-        for attempt in range(1, 4):
+        max_attempts = self.config["MAX_RETRIES"]
+        timeout = aiohttp.ClientTimeout(total=self.config["WB_TIMEOUT_SECONDS"])
+        maybe_delivered = False
+        
+        for attempt in range(1, max_attempts + 1):
+            if maybe_delivered:
+                answered = await self.is_answered(feedback_id)
+                if answered:
+                    logging.info(f"✅ Ответ на отзыв {feedback_id} уже опубликован предыдущей попыткой")
+                    return True
+            
             try:
-                logging.debug(f"Отправка ответа на отзыв {feedback_id} (попытка {attempt}/3)")
-                async with self.session.post(url, json=data, headers=headers) as response:
-                    if response.status in [200, 204]:
-                        logging.info(f"✅ Ответ успешно отправлен на отзыв {feedback_id}")
-                        return True
-                    else:
-                        logging.error(f"Ошибка сети при отправке ответа (попытка {attempt}): {response.status}, {response.reason}")
+                logging.debug(f"Отправка ответа на отзыв {feedback_id} (попытка {attempt}/{max_attempts})")
+                await self.acquire_rate_limit()
+                # Ответ убирает отзыв из списка неотвеченных: отправка не пересекается
+                # с запросом страницы этого списка и учитывается в смещении следующих страниц
+                async with self.listing_gate.posting():
+                    self.count_listing_shift(feedback_id)
+                    async with self.session.post(url, json=data, headers=headers, timeout=timeout) as response:
+                        self.rate_limiter.on_response(response.status, response.headers)
+                        if response.status in [200, 204]:
+                            logging.info(f"✅ Ответ успешно отправлен на отзыв {feedback_id}")
+                            return True
+                        elif response.status == 429:
+                            # Паузу выдерживает лимитер перед следующей попыткой
+                            logging.warning(f"Превышен лимит запросов при отправке ответа на отзыв {feedback_id} (попытка {attempt})")
+                            continue
+                        elif 400 <= response.status < 500:
+                            logging.error(f"Ответ на отзыв {feedback_id} отклонен: {response.status}, {response.reason}")
+                            return False
+                        else:
+                            maybe_delivered = True
+                            logging.error(f"Ошибка сервера при отправке ответа (попытка {attempt}): {response.status}, {response.reason}")
+            except (asyncio.TimeoutError, aiohttp.ServerDisconnectedError) as e:
+                maybe_delivered = True
+                logging.error(f"Таймаут при отправке ответа (попытка {attempt}): {type(e).__name__}")
             except Exception as e:
                 logging.error(f"Ошибка сети при отправке ответа (попытка {attempt}): {str(e)}")
             
-            if attempt < 3:
-                await asyncio.sleep(1)
+            if attempt < max_attempts:
+                await asyncio.sleep(self.retry_delay(attempt))
         
         logging.error(f"Не удалось отправить ответ на отзыв {feedback_id}")
         return False
     
-    def generate_ai_response(self, review_text: str, product_valuation: Optional[int]) -> Optional[str]:
+    async def generate_ai_response(self, review_text: str, product_valuation: Optional[int]) -> Optional[str]:
         """Генерация ответа с помощью AI с обработкой ошибок"""
         try:
-            # Формируем контекст для AI
-            context = {
-                "review": review_text,
-                "valuation": product_valuation,
-                "store_name": self.store['name'],
-                "prompt": self.store['prompt']
-            }
-            
             logging.debug(f"Генерация ответа для отзыва: {review_text[:100]}...")
             
-            # Формируем запрос к API
-            request_data = {
-                "model": "gpt-3.5-turbo",
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": self.store['prompt']
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Отзыв: {review_text}\nОценка: {product_valuation if product_valuation else 'не указана'}"
-                    }
-                ],
-                "temperature": 0.7,
-                "max_tokens": 500
-            }
-            
-            # Отправляем запрос к API
-            response = self.openai_client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=request_data["messages"],
+            response = await self.llm.create(
+                self.store['id'],
+                self.request_builder.review_request(self.store['prompt'], review_text, product_valuation),
                 timeout=self.config["OPENAI_TIMEOUT_SECONDS"]
             )
+            self.count_llm_tokens(response)
             
             # Извлекаем сгенерированный ответ
             if not response.choices:
@@ -383,11 +991,11 @@ class WBFeedbackBot:
                 
             return response.choices[0].message.content
             
-        except requests.exceptions.Timeout:
+        except openai.APITimeoutError:
             logging.error("Таймаут при запросе к API")
             return None
             
-        except requests.exceptions.RequestException as e:
+        except openai.APIError as e:
             logging.error(f"Ошибка при запросе к API: {str(e)}")
             return None
             
@@ -399,55 +1007,440 @@ class WBFeedbackBot:
             logging.error(f"Неожиданная ошибка при генерации ответа: {str(e)}", exc_info=True)
             return None
 
-    async def process_reviews(self) -> None:
-        """Обработка всех отзывов с ведением статистики"""
+    async def generate_batch_response(self, prepared_reviews: List[Dict]) -> Dict[str, str]:
+        """Ответы на пакет отзывов одним запросом к AI: {id отзыва: ответ}, без ошибочных"""
         try:
-            logging.info(f"Начало обработки отзывов для магазина {self.store['name']}")
+            logging.debug(f"Генерация ответов на пакет из {len(prepared_reviews)} отзывов")
+            response = await self.llm.create(
+                self.store['id'],
+                self.request_builder.batch_request(self.store['prompt'], prepared_reviews),
+                timeout=self.config["OPENAI_TIMEOUT_SECONDS"]
+            )
+            self.count_llm_tokens(response)
             
-            # Получаем все отзывы
-            reviews = await self.get_reviews()
-            if not reviews:
-                logging.info(f"Нет новых отзывов для магазина {self.store['name']}")
+            if not response.choices:
+                logging.error("В ответе API отсутствует поле choices")
+                return {}
+            
+            return parse_batch_answers(
+                response.choices[0].message.content, [prepared['id'] for prepared in prepared_reviews]
+            )
+            
+        except openai.APITimeoutError:
+            logging.error("Таймаут при пакетном запросе к API")
+            return {}
+            
+        except openai.APIError as e:
+            logging.error(f"Ошибка при пакетном запросе к API: {str(e)}")
+            return {}
+            
+        except Exception as e:
+            logging.error(f"Неожиданная ошибка при пакетной генерации ответов: {str(e)}", exc_info=True)
+            return {}
+
+    def backlog_cutoff(self) -> Optional[datetime]:
+        """
+        Отзывы, созданные раньше этого момента, отвечаются через Batch API; None - режим
+        выключен или магазину не доступен OpenAI
+        """
+        if not self.config["LLM_BACKLOG_ENABLED"] or self.llm.batch_route(self.store['id']) is None:
+            return None
+        return datetime.utcnow() - timedelta(hours=self.config["LLM_BACKLOG_MIN_AGE_HOURS"])
+
+    async def submit_backlog(self, items: List[Tuple[Review, Dict]]) -> List[Tuple[Review, Dict]]:
+        """
+        Отправка накопившихся отзывов пакетами Batch API (до LLM_BACKLOG_MAX_REQUESTS
+        в пакете). Возвращает отзывы, которые отправить не удалось
+        """
+        unsent: List[Tuple[Review, Dict]] = []
+        route = self.llm.batch_route(self.store['id'])
+        size = max(1, self.config["LLM_BACKLOG_MAX_REQUESTS"])
+        for start in range(0, len(items), size):
+            chunk = items[start:start + size]
+            try:
+                batch = await submit_batch(
+                    route.backend.client,
+                    [(prepared['id'], {**self.request_builder.review_request(
+                        self.store['prompt'], prepared['text'], prepared['valuation']
+                    ), 'model': route.model}) for _, prepared in chunk],
+                    metadata={'store_id': str(self.store['id'])}
+                )
+                save_llm_batch(self.store['id'], batch.id, batch.status, [{
+                    'feedback_id': prepared['id'],
+                    'review_text': prepared['text'],
+                    'valuation': prepared['valuation'],
+                    'created_date': review.created
+                } for review, prepared in chunk])
+            except Exception as e:
+                logging.error(f"Не удалось отправить пакет отзывов магазина {self.store['name']}: {str(e)}", exc_info=True)
+                unsent.extend(chunk)
+                continue
+            logging.info(f"Отправлен пакет {batch.id}: {len(chunk)} отзывов магазина {self.store['name']}")
+        return unsent
+
+    async def collect_backlog(self) -> Tuple[List[Tuple[Review, Dict, str]], List[Tuple[Review, Dict]]]:
+        """
+        Проверка ожидающих пакетов Batch API магазина. Возвращает готовые ответы
+        (отзыв, подготовленный отзыв, ответ) и отзывы завершенных пакетов без ответа,
+        которые нужно сгенерировать по одному
+        """
+        ready: List[Tuple[Review, Dict, str]] = []
+        retry: List[Tuple[Review, Dict]] = []
+        pending = get_pending_llm_batches(self.store['id'])
+        client = self.llm.batch_client
+        if pending and client is None:
+            logging.warning(f"Пакеты Batch API магазина {self.store['name']} не проверены: бэкенд openai выключен")
+            return ready, retry
+        for llm_batch_id, batch_id, status in pending:
+            try:
+                batch = await client.batches.retrieve(batch_id)
+                if batch.status not in FINAL_BATCH_STATUSES:
+                    if batch.status != status:
+                        update_llm_batch_status(llm_batch_id, batch.status)
+                    continue
+                results = await fetch_batch_results(client, batch)
+                rows = finish_llm_batch(llm_batch_id, batch.status)
+            except Exception as e:
+                logging.error(f"Ошибка при проверке пакета {batch_id}: {str(e)}", exc_info=True)
+                continue
+            
+            self.llm_usage['llm_calls'] += 1
+            self.add_llm_tokens(results.prompt_tokens, results.completion_tokens, results.cached_tokens)
+            for row in rows:
+                review = Review(row['feedback_id'], row['review_text'], row['valuation'], row['created_date'], False)
+                prepared = {'id': row['feedback_id'], 'text': row['review_text'], 'valuation': row['valuation']}
+                response_text = results.answers.get(row['feedback_id'])
+                if response_text:
+                    ready.append((review, prepared, response_text))
+                else:
+                    retry.append((review, prepared))
+            logging.info(
+                f"Пакет {batch_id} магазина {self.store['name']} завершен ({batch.status}): "
+                f"ответов {len(results.answers)} из {len(rows)}"
+            )
+        return ready, retry
+
+    def cursor_tracker(self) -> CursorTracker:
+        """Трекер курсора с окном повторных попыток CURSOR_RETRY_HOURS"""
+        return CursorTracker(datetime.utcnow() - timedelta(hours=self.config["CURSOR_RETRY_HOURS"]))
+
+    def save_watermark(self, reviews: Iterable[Review], failed_reviews: Iterable[Review]) -> None:
+        """Сохранение курсора по списку полученных отзывов и отзывов с ошибкой"""
+        tracker = self.cursor_tracker()
+        for review in reviews:
+            tracker.observe(review)
+        for review in failed_reviews:
+            tracker.fail(review)
+        self.persist_watermark(tracker)
+
+    def persist_watermark(self, tracker: CursorTracker) -> None:
+        """
+        Сохранение курсора по самому новому полученному отзыву.
+        Курсор не сдвигается дальше самого старого неотвеченного отзыва с ошибкой,
+        чтобы он был получен повторно в следующем цикле. Отзывы старше
+        CURSOR_RETRY_HOURS курсор не удерживают: они остаются в журнале
+        с ошибкой и запрашиваются повторно по id (load_failed_reviews).
+        """
+        if tracker.newest is None:
+            return
+        
+        newest_ids = set(tracker.newest_ids)
+        if self.watermark and self.watermark[0] == tracker.newest:
+            newest_ids.update(self.watermark[1])
+        new_watermark = (tracker.newest, sorted(newest_ids))
+        
+        if tracker.oldest_failed is not None:
+            # Курсор строго раньше упавшего отзыва, чтобы тот снова попал в выборку
+            new_watermark = (tracker.oldest_failed - timedelta(microseconds=1), [])
+        
+        # Курсор никогда не сдвигается назад
+        if self.watermark and new_watermark[0] < self.watermark[0]:
+            return
+        
+        update_review_cursor(self.store['id'], new_watermark[0], new_watermark[1])
+        logging.debug(f"Курсор отзывов магазина {self.store['name']} сдвинут до {new_watermark[0]}")
+
+    def store_concurrency(self) -> int:
+        """Число параллельных генераций ответов для магазина"""
+        overrides = self.config["LLM_STORE_CONCURRENCY_OVERRIDES"]
+        return int(overrides.get(str(self.store['id']), self.config["LLM_STORE_CONCURRENCY"]))
+
+    def record_result(self, review: Review, result: Optional[Dict], stats: Dict[str, int],
+                      failed_reviews: List[Review]) -> None:
+        """Учет результата обработки отзыва в статистике цикла"""
+        stats['processed'] += 1
+        if result and result.get('skipped'):
+            stats['skipped'] += 1
+            REVIEWS_TOTAL.inc(store=self.store_label, result='skipped')
+        elif result and result.get('batched'):
+            stats['batched'] = stats.get('batched', 0) + 1
+            REVIEWS_TOTAL.inc(store=self.store_label, result='batched')
+        elif result:
+            stats['success'] += 1
+            REVIEWS_TOTAL.inc(store=self.store_label, result='answered')
+        else:
+            REVIEWS_TOTAL.inc(store=self.store_label, result='error')
+            stats['errors'] += 1
+            failed_reviews.append(review)
+            logging.error(f"Не удалось обработать отзыв {review.id}")
+
+    async def run_pipeline(self, reviews: Union[Iterable[Review], AsyncIterator[Review]],
+                           stats: Dict[str, int], failed_reviews: List[Review]) -> None:
+        """
+        Конвейер обработки отзывов: подготовка -> генерация -> отправка.
+        Отзывы можно передать потоком: обработка первых начинается, пока следующие еще загружаются.
+        Генерацию выполняют несколько воркеров магазина (не больше общего лимита LLM),
+        отправку - BATCH_SIZE воркеров под общим лимитом запросов к WB.
+        При LLM_BATCH_SIZE > 1 воркер генерации забирает сразу все ожидающие отзывы
+        (до LLM_BATCH_SIZE) и отвечает на них пакетным запросом.
+        При LLM_BACKLOG_ENABLED отзывы старше LLM_BACKLOG_MIN_AGE_HOURS отправляются
+        в Batch API по мере накопления LLM_BACKLOG_CHUNK_SIZE штук, а готовые ответы
+        прошлых пакетов - на отправку в начале конвейера.
+        Очереди ограничены, поэтому генерация не убегает далеко вперед отправки.
+        """
+        workers = max(1, self.store_concurrency())
+        posters_count = max(1, self.config["BATCH_SIZE"])
+        batch_size = max(1, self.config["LLM_BATCH_SIZE"])
+        generate_queue: asyncio.Queue = asyncio.Queue(maxsize=workers * 2 * batch_size)
+        post_queue: asyncio.Queue = asyncio.Queue(maxsize=posters_count)
+        # Отзывы старше backlog_cutoff копятся и отправляются в Batch API частями по ходу потока,
+        # чтобы захваченные отзывы не ждали конца выборки
+        backlog_cutoff = self.backlog_cutoff()
+        backlog_chunk = max(1, self.config["LLM_BACKLOG_CHUNK_SIZE"])
+        backlog: List[Tuple[Review, Dict]] = []
+
+        def report_depth() -> None:
+            QUEUE_DEPTH.set(generate_queue.qsize(), store=self.store_label, queue='generate')
+            QUEUE_DEPTH.set(post_queue.qsize(), store=self.store_label, queue='post')
+
+        def take_batch(first: Review) -> Tuple[List[Review], bool]:
+            """Первый отзыв и уже ожидающие в очереди, до LLM_BATCH_SIZE; True - получен конец очереди"""
+            batch = [first]
+            while len(batch) < batch_size:
+                try:
+                    review = generate_queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if review is None:
+                    return batch, True
+                batch.append(review)
+            return batch, False
+
+        async def generate(batch: List[Review]) -> None:
+            prepared_reviews: List[Tuple[Review, Dict]] = []
+            for review in batch:
+                try:
+                    prepared = await self.prepare_review(review)
+                except Exception as e:
+                    logging.error(f"Ошибка при обработке отзыва {review.id}: {str(e)}", exc_info=True)
+                    self.record_result(review, None, stats, failed_reviews)
+                    continue
+                if not prepared or prepared.get('skipped'):
+                    self.record_result(review, prepared, stats, failed_reviews)
+                    continue
+                if backlog_cutoff is not None and review.created is not None and review.created < backlog_cutoff:
+                    backlog.append((review, prepared))
+                    continue
+                prepared_reviews.append((review, prepared))
+            await answer(prepared_reviews)
+            if len(backlog) >= backlog_chunk:
+                await submit_backlog()
+
+        async def submit_backlog() -> None:
+            """Отправка накопленных отзывов в Batch API; не отправленные генерируются сразу"""
+            nonlocal backlog
+            chunk, backlog = backlog, []
+            if not chunk:
                 return
-                
-            logging.info(f"Получено {len(reviews)} отзывов для обработки")
+            unsent = await self.submit_backlog(chunk)
+            unsent_ids = {prepared['id'] for _, prepared in unsent}
+            for review, prepared in chunk:
+                if prepared['id'] not in unsent_ids:
+                    self.record_result(review, {'id': prepared['id'], 'batched': True}, stats, failed_reviews)
+            await answer_all(unsent)
+
+        async def answer(prepared_reviews: List[Tuple[Review, Dict]]) -> None:
+            if not prepared_reviews:
+                return
+
+            try:
+                answers = await self.generate_for_reviews([prepared for _, prepared in prepared_reviews])
+            except Exception as e:
+                logging.error(f"Ошибка при генерации ответов: {str(e)}", exc_info=True)
+                for review, prepared in prepared_reviews:
+                    await self.release_review(prepared['id'])
+                    self.record_result(review, None, stats, failed_reviews)
+                return
+
+            for review, prepared in prepared_reviews:
+                response_text = answers.get(prepared['id'])
+                if not response_text:
+                    self.record_result(review, None, stats, failed_reviews)
+                    continue
+                await post_queue.put((review, prepared, response_text))
+
+        async def answer_all(prepared_reviews: List[Tuple[Review, Dict]]) -> None:
+            """Генерация вне очереди (отзывы из пакетов Batch API) тем же числом воркеров"""
+            async def worker(part: List[Tuple[Review, Dict]]) -> None:
+                for start in range(0, len(part), batch_size):
+                    await answer(part[start:start + batch_size])
+            await asyncio.gather(*(worker(prepared_reviews[index::workers]) for index in range(workers)))
+
+        async def generator() -> None:
+            while True:
+                review = await generate_queue.get()
+                if review is None:
+                    report_depth()
+                    return
+                batch, finished = take_batch(review)
+                report_depth()
+                await generate(batch)
+                if finished:
+                    return
+
+        async def poster() -> None:
+            while True:
+                item = await post_queue.get()
+                report_depth()
+                if item is None:
+                    return
+                review, prepared, response_text = item
+                try:
+                    result = await self.answer_review(prepared, response_text)
+                except Exception as e:
+                    logging.error(f"Ошибка при отправке ответа на отзыв {review.id}: {str(e)}", exc_info=True)
+                    await self.release_review(prepared['id'])
+                    result = None
+                self.record_result(review, result, stats, failed_reviews)
+
+        generators = [asyncio.create_task(generator()) for _ in range(workers)]
+        posters = [asyncio.create_task(poster()) for _ in range(posters_count)]
+        try:
+            # Готовые ответы из пакетов Batch API отправляются вместе с новыми
+            ready, retry = await self.collect_backlog()
+            if ready or retry:
+                await self.init_session()
+            for item in ready:
+                await post_queue.put(item)
+            await answer_all(retry)
+            
+            if hasattr(reviews, '__aiter__'):
+                async for review in reviews:
+                    await generate_queue.put(review)
+            else:
+                for review in reviews:
+                    await generate_queue.put(review)
+            for _ in generators:
+                await generate_queue.put(None)
+            await asyncio.gather(*generators)
+            await submit_backlog()
+            for _ in posters:
+                await post_queue.put(None)
+            await asyncio.gather(*posters)
+        finally:
+            for task in generators + posters:
+                task.cancel()
+            report_depth()
+
+    async def process_reviews(self) -> Optional[Dict[str, int]]:
+        """Обработка всех отзывов с ведением статистики. Возвращает статистику или None при ошибке"""
+        started = time.monotonic()
+        try:
+            logging.info(f"Начало обработки отзывов для магазина {self.store['name']}")
+            started_at = datetime.utcnow()
             
             # Статистика обработки
             stats = {
-                'total': len(reviews),
+                'total': 0,
                 'processed': 0,
                 'success': 0,
                 'errors': 0,
                 'skipped': 0
             }
             
-            # Обрабатываем отзывы
-            for review in reviews:
+            # При исчерпанном дневном бюджете токенов отзывы остаются до следующих суток
+            await asyncio.to_thread(self.load_tokens_today)
+            if self.budget_exhausted():
+                logging.warning(
+                    f"Дневной бюджет токенов магазина {self.store['name']} исчерпан "
+                    f"({self.tokens_today} из {self.token_budget()}), цикл пропущен"
+                )
+                return stats
+            
+            # Неотвеченные отзывы, ответ на которые не удалось отправить
+            failed_reviews: List[Review] = []
+            # Данные для курсора собираются по ходу потока, сами отзывы не накапливаются
+            tracker = self.cursor_tracker()
+            
+            # Отзывы с ошибкой, которые курсор уже не удерживает, запрашиваются по id
+            retried: List[Review] = []
+            if self.config["INCREMENTAL_FETCH"] and self.config["FAILED_RETRY_LIMIT"] > 0:
+                retried = await self.load_failed_reviews()
+            
+            async def observed_reviews() -> AsyncIterator[Review]:
+                for review in retried:
+                    stats['total'] += 1
+                    yield review
+                retried_ids = {review.id for review in retried}
+                reviews = self.iter_reviews()
                 try:
-                    result = await self.process_review(review)
-                    stats['processed'] += 1
-                    
-                    if result:
-                        stats['success'] += 1
-                        logging.info(f"Успешно обработан отзыв {review.get('id')}")
-                    else:
-                        stats['errors'] += 1
-                        logging.error(f"Не удалось обработать отзыв {review.get('id')}")
-                        
-                except Exception as e:
-                    stats['errors'] += 1
-                    logging.error(f"Ошибка при обработке отзыва {review.get('id')}: {str(e)}", exc_info=True)
-                    
-            # Обновляем статистику в базе данных
+                    async for review in reviews:
+                        tracker.observe(review)
+                        if review.id in retried_ids:
+                            continue
+                        stats['total'] += 1
+                        yield review
+                finally:
+                    await reviews.aclose()
+            
+            # Обрабатываем отзывы конвейером по мере загрузки: генерация -> отправка.
+            # Если конвейер упал, поток закрывается сразу: загрузка страниц останавливается
+            stream = observed_reviews()
             try:
-                update_store_statistics(
-                    store_id=self.store['id'],
-                    total_reviews=stats['total'],
-                    answered_reviews=stats['success'],
-                    last_check_time=datetime.now()
+                await self.run_pipeline(stream, stats, failed_reviews)
+            finally:
+                await stream.aclose()
+            
+            if not stats['total'] and not stats['processed']:
+                logging.info(f"Нет новых отзывов для магазина {self.store['name']}")
+                return stats
+            
+            for review in failed_reviews:
+                tracker.fail(review)
+            
+            # Сдвигаем курсор, только если выборка не оборвалась на ошибке:
+            # иначе непрочитанные страницы оказались бы старше нового курсора и потерялись
+            if self.config["INCREMENTAL_FETCH"] and not self.fetch_complete:
+                logging.warning(f"Загрузка отзывов магазина {self.store['name']} прервана, курсор не сдвигается")
+            elif self.config["INCREMENTAL_FETCH"] and self.budget_deferred:
+                # Отложенные отзывы любой давности должны снова попасть в выборку в следующие сутки
+                logging.warning(
+                    f"Бюджет токенов магазина {self.store['name']} исчерпан в ходе цикла "
+                    f"(отложено отзывов: {self.budget_deferred}), курсор не сдвигается"
                 )
-            except Exception as e:
-                logging.error(f"Ошибка при обновлении статистики: {str(e)}", exc_info=True)
+            elif self.config["INCREMENTAL_FETCH"]:
+                try:
+                    await asyncio.to_thread(self.persist_watermark, tracker)
+                except Exception as e:
+                    logging.error(f"Ошибка при сохранении курсора отзывов: {str(e)}", exc_info=True)
+                    
+            # Прирост статистики записывается в базу вместе с журналом отзывов
+            self.write_buffer.add_statistics(
+                store_id=self.store['id'],
+                total_reviews=stats['total'],
+                answered_reviews=stats['success'],
+                last_check_time=datetime.now()
+            )
+            self.write_buffer.add_cycle_metrics({
+                'store_id': self.store['id'],
+                'started_at': started_at,
+                'finished_at': datetime.utcnow(),
+                'fetched': stats['total'],
+                'answered': stats['success'],
+                'skipped': stats['skipped'],
+                'errors': stats['errors'],
+                **self.llm_usage
+            })
                 
             # Логируем итоговую статистику
             logging.info(
@@ -457,103 +1450,216 @@ class WBFeedbackBot:
                 f"Ошибок: {stats['errors']}\n"
                 f"Пропущено: {stats['skipped']}"
             )
+            return stats
             
         except Exception as e:
             logging.error(f"Критическая ошибка при обработке отзывов: {str(e)}", exc_info=True)
+            return None
             
         finally:
+            STORE_CYCLE_SECONDS.observe(time.monotonic() - started, store=self.store_label)
             # Закрываем сессию
             await self.close_session()
         
-async def process_all_stores():
+def load_active_stores() -> List[Dict[str, Any]]:
+    """Загрузка магазинов с действительным API ключом в виде словарей для ботов"""
+    backfill_store_key_info()
+    stores_data: List[Dict[str, Any]] = []
+    with session_scope() as session:
+        # Срок действия ключа хранится в индексируемой колонке, ключи не разбираются заново
+        stores = session.query(Store).filter(Store.key_expires_at > datetime.utcnow()).all()
+        
+        if not stores:
+            logging.info("Нет магазинов для обработки")
+            return stores_data
+            
+        logging.info(f"Найдено {len(stores)} магазинов с действительным API ключом")
+        
+        for store in stores:
+            # Создаем копию необходимых данных для бота
+            stores_data.append({
+                'id': store.id,
+                'name': store.name,
+                'wb_api_key': store.wb_api_key,
+                'prompt': store.prompt
+            })
+    return stores_data
+
+def prune_cycle_history(config: Dict[str, Any]) -> None:
+    """Удаление метрик циклов и часовых агрегатов старше CYCLE_METRICS_RETENTION_DAYS"""
+    removed = prune_cycle_metrics(datetime.utcnow() - timedelta(days=config["CYCLE_METRICS_RETENTION_DAYS"]))
+    if removed:
+        logging.info(f"Удалено устаревших метрик циклов: {removed}")
+
+def prune_review_ledger(config: Dict[str, Any]) -> None:
+    """
+    Удаление завершенных записей журнала отзывов старше PROCESSED_REVIEWS_RETENTION_DAYS
+    (0 - хранить всегда). На такие отзывы уже ответили, либо они давно позади курсора
+    """
+    if config["PROCESSED_REVIEWS_RETENTION_DAYS"] <= 0:
+        return
+    removed = prune_processed_reviews(datetime.utcnow() - timedelta(days=config["PROCESSED_REVIEWS_RETENTION_DAYS"]))
+    if removed:
+        logging.info(f"Удалено устаревших записей журнала отзывов: {removed}")
+
+async def process_all_stores(clients: Optional[ClientRegistry] = None):
     """Параллельная обработка отзывов для всех магазинов"""
-    tasks = []  # Инициализируем список задач
+    # Загружаем конфигурацию
+    config = load_config()
+    started = time.monotonic()
+    
+    # Без общего реестра клиентов создаем временный на один цикл
+    own_clients = clients is None
+    if own_clients:
+        clients = ClientRegistry(config)
+        await clients.start()
+    
     try:
-        # Загружаем конфигурацию
-        config = load_config()
+        stores_data = load_active_stores()
         
-        # Получаем все магазины в рамках одной сессии
-        with session_scope() as session:
-            stores = session.query(Store).all()
+        # Создаем задачи для каждого магазина
+        tasks = []
+        for store_data in stores_data:
+            bot = WBFeedbackBot(config, store_data, clients)
+            task = asyncio.create_task(bot.process_reviews())
+            tasks.append((store_data['name'], task))
             
-            if not stores:
-                logging.info("Нет магазинов для обработки")
-                return
-                
-            logging.info(f"Найдено {len(stores)} магазинов для обработки")
+        if not tasks:
+            logging.warning("Нет активных задач для обработки")
+            return
             
-            # Создаем задачи для каждого магазина
-            for store in stores:
-                # Проверяем валидность API ключа
-                if not check_api_key_expiration(store.wb_api_key):
-                    logging.warning(f"Пропуск магазина {store.name}: недействительный API ключ")
-                    continue
-                    
-                # Создаем копию необходимых данных для бота
-                store_data = {
-                    'id': store.id,
-                    'name': store.name,
-                    'wb_api_key': store.wb_api_key,
-                    'prompt': store.prompt
-                }
-                
-                bot = WBFeedbackBot(config, store_data)
-                task = asyncio.create_task(bot.process_reviews())
-                tasks.append((store.name, task))
-                
-            if not tasks:
-                logging.warning("Нет активных задач для обработки")
-                return
+        # Запускаем все задачи параллельно
+        logging.info(f"Запуск обработки для {len(tasks)} магазинов")
+        results = await asyncio.gather(*[task for _, task in tasks], return_exceptions=True)
+        
+        # Анализируем результаты
+        success_count = 0
+        error_count = 0
+        
+        for (store_name, _), result in zip(tasks, results):
+            if isinstance(result, Exception):
+                error_count += 1
+                logging.error(f"Ошибка при обработке магазина {store_name}: {str(result)}", exc_info=True)
+            else:
+                success_count += 1
                 
-            # Запускаем все задачи параллельно
-            logging.info(f"Запуск обработки для {len(tasks)} магазинов")
-            results = await asyncio.gather(*[task for _, task in tasks], return_exceptions=True)
-            
-            # Анализируем результаты
-            success_count = 0
-            error_count = 0
-            
-            for (store_name, _), result in zip(tasks, results):
-                if isinstance(result, Exception):
-                    error_count += 1
-                    logging.error(f"Ошибка при обработке магазина {store_name}: {str(result)}", exc_info=True)
-                else:
-                    success_count += 1
-                    
-            logging.info(
-                f"Обработка всех магазинов завершена:\n"
-                f"Успешно обработано: {success_count}\n"
-                f"Ошибок: {error_count}"
-            )
+        logging.info(
+            f"Обработка всех магазинов завершена:\n"
+            f"Успешно обработано: {success_count}\n"
+            f"Ошибок: {error_count}"
+        )
+        clients.answer_cache.evict()
+        prune_cycle_history(config)
+        prune_review_ledger(config)
+        logging.info(f"Пул соединений: {clients.metrics()}")
             
     except Exception as e:
         logging.error(f"Критическая ошибка при обработке магазинов: {str(e)}", exc_info=True)
         
     finally:
-        # Закрываем все сессии только если есть задачи
-        if tasks:
-            for store_name, task in tasks:
-                try:
-                    bot = WBFeedbackBot(config, {'name': store_name})
-                    await bot.close_session()
-                except Exception as e:
-                    logging.error(f"Ошибка при закрытии сессии для магазина {store_name}: {str(e)}")
+        ALL_STORES_SECONDS.observe(time.monotonic() - started)
+        if own_clients:
+            await clients.close()
 
-async def run_periodic_processing():
-    """Периодический запуск обработки отзывов"""
+async def run_periodic_processing(stop: Optional[asyncio.Event] = None):
+    """
+    Обработка отзывов по расписанию магазинов до установки события stop.
+    При SHARDING_ENABLED воркер обрабатывает только свою долю магазинов.
+    """
     config = load_config()
-    check_interval = config["CHECK_INTERVAL_MINUTES"] * 60
+    stop = stop or asyncio.Event()
+    
+    # Общие для всех магазинов и циклов сетевые клиенты
+    clients = ClientRegistry(config)
+    await clients.start()
+    
+    membership = ShardMembership(config)
+    membership.heartbeat()
+    heartbeat_task = asyncio.create_task(membership.run_heartbeat(stop))
+    
+    # Накопительные счетчики воркера для супервизора
+    totals = {'runs': 0, 'failed_runs': 0, 'reviews': 0, 'answered': 0, 'errors': 0, 'stores': 0}
     
-    while True:
+    # Метрики для Prometheus (METRICS_PORT=0 - эндпоинт выключен)
+    REGISTRY.max_store_labels = config["METRICS_MAX_STORE_LABELS"]
+    REGISTRY.add_collector('wb_bot_clients', 'Состояние общих клиентов воркера', clients.metrics)
+    REGISTRY.add_collector('wb_bot_worker', 'Накопительные счетчики воркера', lambda: totals)
+    metrics_server = None
+    if config["METRICS_PORT"]:
+        metrics_server = MetricsServer(REGISTRY, config["METRICS_HOST"], config["METRICS_PORT"])
         try:
-            logging.info("Запуск периодической обработки отзывов")
-            await process_all_stores()
-            
-        except Exception as e:
-            logging.error(f"Ошибка при периодической обработке: {str(e)}", exc_info=True)
-            
-        logging.info(f"Ожидание {config['CHECK_INTERVAL_MINUTES']} минут перед следующей проверкой...")
-        await asyncio.sleep(check_interval)
+            await metrics_server.start()
+        except OSError as e:
+            logging.error(f"Не удалось запустить эндпоинт метрик: {str(e)}")
+            metrics_server = None
+    
+    def report(state: str) -> None:
+        write_worker_status(config["WORKER_STATUS_FILE"], {
+            'worker_id': membership.worker_id,
+            'pid': os.getpid(),
+            'state': state,
+            'updated_at': datetime.utcnow().isoformat(),
+            'totals': totals,
+            'clients': clients.metrics()
+        })
+    
+    def load_stores() -> List[Dict[str, Any]]:
+        # Обслуживание общих кэшей при каждом обновлении списка магазинов
+        clients.answer_cache.evict()
+        prune_cycle_history(config)
+        prune_review_ledger(config)
+        logging.info(f"Пул соединений: {clients.metrics()}")
+        stores = membership.filter_stores(load_active_stores())
+        totals['stores'] = len(stores)
+        report('running')
+        return stores
+    
+    async def run_store(store_data: Dict[str, Any]) -> Optional[Dict[str, int]]:
+        stats = await WBFeedbackBot(config, store_data, clients).process_reviews()
+        totals['runs'] += 1
+        if stats is None:
+            totals['failed_runs'] += 1
+        else:
+            totals['reviews'] += stats['total']
+            totals['answered'] += stats['success']
+            totals['errors'] += stats['errors']
+        return stats
+    
+    try:
+        await StoreScheduler(config, load_stores, run_store).run(stop)
+    finally:
+        stop.set()
+        await heartbeat_task
+        report('stopped')
+        if metrics_server:
+            await metrics_server.stop()
+        REGISTRY.remove_collector('wb_bot_clients')
+        REGISTRY.remove_collector('wb_bot_worker')
+        await clients.close()
+
+def write_worker_status(path: str, status: Dict[str, Any]) -> None:
+    """Атомарная запись состояния воркера в JSON-файл (пустой путь - не записывать)"""
+    if not path:
+        return
+    try:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(status, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.error(f"Ошибка при записи состояния воркера: {str(e)}")
+
+async def run_worker() -> None:
+    """Запуск воркера с плавной остановкой по SIGTERM/SIGINT: начатые магазины дорабатываются"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: остается KeyboardInterrupt
+            pass
+    await run_periodic_processing(stop)
 
 if __name__ == "__main__":
     # Настраиваем логирование
@@ -561,7 +1667,7 @@ if __name__ == "__main__":
     
     try:
         # Запускаем периодическую обработку
-        asyncio.run(run_periodic_processing())
+        asyncio.run(run_worker())
     except KeyboardInterrupt:
         logging.info("Получен сигнал завершения работы")
     except Exception as e:
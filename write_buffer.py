@@ -0,0 +1,179 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Any, List, NamedTuple, Optional, Tuple
+
+from database import add_store_statistics, finish_reviews, save_cycle_metrics, session_scope, touch_cached_answers
+
+
+class Batch(NamedTuple):
+    """Записи, забранные из буфера для одной записи в базу"""
+    statistics: List[Dict[str, Any]]
+    reviews: List[Dict[str, Any]]
+    cycles: List[Dict[str, Any]]
+    cache_hits: Dict[str, int]
+
+
+class WriteBehindBuffer:
+    """
+    Отложенная запись статистики магазинов, метрик циклов, результатов обработки
+    отзывов и попаданий в кэш ответов. Прирост статистики, метрики циклов, итоговые
+    статусы отзывов и счетчики попаданий копятся в памяти и пишутся
+    в базу пакетами (upsert одним executemany) в отдельном потоке каждые
+    WRITE_BUFFER_FLUSH_SECONDS, при накоплении WRITE_BUFFER_MAX_PENDING записей
+    и при остановке. WRITE_BUFFER_FLUSH_SECONDS=0 - запись сразу (write-through).
+    Захват отзыва (claim_review) в буфер не попадает: он защищает от повторного ответа
+    """
+    def __init__(self, config: Dict[str, Any]):
+        self.config = config
+        self.interval = config["WRITE_BUFFER_FLUSH_SECONDS"]
+        # store_id -> накопленный прирост статистики
+        self._statistics: Dict[int, Dict[str, Any]] = {}
+        # (store_id, feedback_id) -> последний результат обработки отзыва
+        self._reviews: Dict[Tuple[int, str], Dict[str, Any]] = {}
+        # Метрики завершенных циклов обработки магазинов
+        self._cycles: List[Dict[str, Any]] = []
+        # Ключ кэша ответов -> число попаданий
+        self._cache_hits: Dict[str, int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._closing = False
+        self._counters = {'flushes': 0, 'flush_errors': 0, 'statistics_rows': 0, 'review_rows': 0, 'cycle_rows': 0,
+                          'cache_hit_rows': 0}
+
+    def add_statistics(self, store_id: int, total_reviews: int, answered_reviews: int,
+                       last_check_time: datetime) -> None:
+        """Учет прироста статистики магазина за цикл обработки"""
+        self._merge_statistics(store_id, total_reviews, answered_reviews, last_check_time)
+        self._added()
+
+    def _merge_statistics(self, store_id: int, total_reviews: int, answered_reviews: int,
+                          last_check_time: datetime) -> None:
+        row = self._statistics.setdefault(store_id, {
+            'store_id': store_id, 'total_reviews': 0, 'answered_reviews': 0, 'last_check_time': last_check_time
+        })
+        row['total_reviews'] += total_reviews
+        row['answered_reviews'] += answered_reviews
+        row['last_check_time'] = max(row['last_check_time'], last_check_time)
+
+    def add_review_result(self, store_id: int, feedback_id: str, status: str,
+                          answer_text: Optional[str] = None) -> None:
+        """Учет результата обработки отзыва для журнала processed_reviews"""
+        self._reviews[(store_id, feedback_id)] = {
+            'store_id': store_id, 'feedback_id': feedback_id, 'status': status, 'answer_text': answer_text
+        }
+        self._added()
+
+    def add_cycle_metrics(self, metrics: Dict[str, Any]) -> None:
+        """Учет метрик цикла обработки магазина (поля CycleMetric)"""
+        self._cycles.append(metrics)
+        self._added()
+
+    def add_cache_hit(self, cache_key: str) -> None:
+        """Учет попадания в кэш ответов для вытеснения давно не используемых записей"""
+        self._cache_hits[cache_key] = self._cache_hits.get(cache_key, 0) + 1
+        self._added()
+
+    def pending(self) -> int:
+        return len(self._statistics) + len(self._reviews) + len(self._cycles) + len(self._cache_hits)
+
+    def _added(self) -> None:
+        if self.interval <= 0:
+            self.flush()
+        elif self._wakeup is not None and self.pending() >= self.config["WRITE_BUFFER_MAX_PENDING"]:
+            self._wakeup.set()
+
+    def _take(self) -> Optional[Batch]:
+        if not self.pending():
+            return None
+        batch = Batch(list(self._statistics.values()), list(self._reviews.values()), self._cycles, self._cache_hits)
+        self._statistics, self._reviews, self._cycles, self._cache_hits = {}, {}, [], {}
+        return batch
+
+    def _restore(self, batch: Batch) -> None:
+        """Возврат несохраненных записей в буфер; новые результаты отзывов важнее старых"""
+        for row in batch.statistics:
+            self._merge_statistics(row['store_id'], row['total_reviews'], row['answered_reviews'], row['last_check_time'])
+        for row in batch.reviews:
+            self._reviews.setdefault((row['store_id'], row['feedback_id']), row)
+        self._cycles = batch.cycles + self._cycles
+        for cache_key, count in batch.cache_hits.items():
+            self._cache_hits[cache_key] = self._cache_hits.get(cache_key, 0) + count
+
+    def _write(self, batch: Batch) -> None:
+        # Одна транзакция: при ошибке пакет возвращается в буфер целиком, и счетчики не задваиваются
+        with session_scope() as session:
+            finish_reviews(batch.reviews, session)
+            add_store_statistics(batch.statistics, session)
+            save_cycle_metrics(batch.cycles, session)
+            touch_cached_answers(batch.cache_hits, session)
+
+    def _written(self, batch: Batch) -> None:
+        self._counters['flushes'] += 1
+        self._counters['statistics_rows'] += len(batch.statistics)
+        self._counters['review_rows'] += len(batch.reviews)
+        self._counters['cycle_rows'] += len(batch.cycles)
+        self._counters['cache_hit_rows'] += len(batch.cache_hits)
+        logging.debug(
+            f"Сброшено в базу: статистика {len(batch.statistics)}, отзывы {len(batch.reviews)}, "
+            f"циклы {len(batch.cycles)}, попадания в кэш {len(batch.cache_hits)}"
+        )
+
+    def _failed(self, batch: Batch, error: Exception) -> None:
+        self._counters['flush_errors'] += 1
+        logging.error(f"Ошибка при записи буфера в базу: {str(error)}", exc_info=True)
+        self._restore(batch)
+
+    def flush(self) -> None:
+        """Синхронная запись накопленного (при остановке и без фоновой задачи)"""
+        batch = self._take()
+        if batch is None:
+            return
+        try:
+            self._write(batch)
+        except Exception as e:
+            self._failed(batch, e)
+            return
+        self._written(batch)
+
+    async def flush_async(self) -> None:
+        """Запись накопленного в отдельном потоке, не блокируя event loop"""
+        batch = self._take()
+        if batch is None:
+            return
+        try:
+            await asyncio.to_thread(self._write, batch)
+        except Exception as e:
+            self._failed(batch, e)
+            return
+        self._written(batch)
+
+    async def _run(self) -> None:
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush_async()
+
+    def start(self) -> None:
+        """Запуск периодической записи"""
+        if self._task is None and self.interval > 0:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Остановка периодической записи и запись остатка"""
+        if self._task is not None:
+            # Начатая запись завершается, а не прерывается
+            self._closing = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+            self._closing = False
+            self._wakeup = None
+        self.flush()
+
+    def metrics(self) -> Dict[str, int]:
+        return {**self._counters, 'pending': self.pending()}